@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -47,6 +48,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so the SQL of every other middleware is profiled too
+    'lego.metrics.MetricsMiddleware',
     "corsheaders.middleware.CorsMiddleware",
 
     'django.middleware.security.SecurityMiddleware',
@@ -89,6 +92,17 @@ DATABASES = {
     }
 }
 
+# PostgreSQL when POSTGRES_HOST is set, e.g. the db service of docker-compose.yml
+if os.environ.get('POSTGRES_HOST'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'postgres'),
+        'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ['POSTGRES_HOST'],
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -141,6 +155,40 @@ REST_FRAMEWORK = {
     ]
 }
 
+# On-disk cache for external catalog downloads (Rebrickable, color tables)
+LEGO_HTTP_CACHE = {
+    'DIR': BASE_DIR / '.http_cache',
+    'TTL': 60 * 60,
+    'MAX_SIZE': 2 * 1024 ** 3,
+}
+
+# Limits applied to /lego/graphql operations before they are executed
+LEGO_GRAPHQL = {
+    'MAX_DEPTH': 10,
+    'MAX_COST': 50000,
+    # parsed/validated documents and query results kept per server process
+    'DOCUMENT_CACHE_SIZE': 1024,
+    'RESPONSE_CACHE_SIZE': 1024,
+    'RESPONSE_CACHE_TTL': 5 * 60,
+    # input colors accepted by a single nearestColors query
+    'MAX_COLOR_BATCH': 10000,
+    # inventory items accepted by a single buildableSets query
+    'MAX_INVENTORY_SIZE': 100000,
+    # sets compared by a single setDiff query
+    'MAX_DIFF_SETS': 20,
+    # ids translated by a single translateIds query
+    'MAX_TRANSLATE_BATCH': 10000,
+}
+
+# Request profiling of lego.metrics, served on /metrics
+LEGO_METRICS = {
+    # requests slower than this are logged with their slowest resolvers and most repeated SQL
+    'SLOW_REQUEST_SECONDS': 1.0,
+    'SLOW_REQUEST_REPORT_SIZE': 5,
+    # client networks allowed to read /metrics, other clients get 403
+    'ALLOWED_NETWORKS': ['127.0.0.0/8', '::1/128'],
+}
+
 GRAPHENE = {
     "SCHEMA": "cookbook.schema.schema"
 }
@@ -15,8 +15,10 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from lego.views import metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('lego/', include('lego.urls')),
+    path('metrics', metrics),
 ]
@@ -1,8 +1,18 @@
 from django.contrib import admin
 from lego.models import LegoSet, LegoPiece, LegoPieces, LegoColor
+from lego.signals import catalog_updated
+
+
+class LegoPiecesAdmin(admin.ModelAdmin):
+
+    def delete_queryset(self, request, queryset):
+        # bulk deletes skip LegoPieces.delete, the sets of the deleted lines are refreshed here
+        lego_sets = set(queryset.values_list('lego_set_id', flat=True))
+        super().delete_queryset(request, queryset)
+        catalog_updated.send(sender=LegoPieces, lego_sets=lego_sets, lego_pieces=[])
 
 
 admin.site.register(LegoSet)
 admin.site.register(LegoPiece)
-admin.site.register(LegoPieces)
+admin.site.register(LegoPieces, LegoPiecesAdmin)
 admin.site.register(LegoColor)
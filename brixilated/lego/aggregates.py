@@ -0,0 +1,124 @@
+from typing import Iterable, List, Optional
+
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from lego.models import LegoPartUsage, LegoPartUsageSet, LegoPieces, LegoSet, LegoSetColor
+
+# sets aggregated per query
+BATCH_SIZE = 500
+
+# the part usage index is rebuilt from scratch when more than 1 / FULL_REFRESH_RATIO of the sets changed
+FULL_REFRESH_RATIO = 10
+
+# columns of the color breakdown and part usage rows, in the order their queries select them
+SET_COLOR_FIELDS = ['lego_set', 'lego_color', 'quantity']
+USAGE_SET_FIELDS = ['lego_set', 'lego_piece', 'lego_color', 'quantity']
+USAGE_FIELDS = ['lego_piece', 'lego_color', 'set_count', 'total_quantity']
+
+
+def update_set_aggregates(lego_sets: Optional[Iterable[int]] = None, set_model=LegoSet, pieces_model=LegoPieces,
+                          set_color_model=LegoSetColor) -> int:
+    """
+    Recomputes the part list aggregates and color breakdown of lego_sets (every set when None)
+    with one UPDATE and one INSERT ... SELECT per batch of sets, rows never pass through Python.
+    The models are arguments so migrations can pass their historical models. Returns the number
+    of sets updated.
+    """
+    lines = pieces_model.objects.filter(lego_set_id=OuterRef('pk')).order_by().values('lego_set_id')
+
+    def aggregate(expression):
+        return Coalesce(Subquery(lines.annotate(value=expression).values('value')), 0)
+
+    aggregates = {
+        'total_pieces': aggregate(Sum('quantity')),
+        'unique_pieces': aggregate(Count('pk')),
+        'unique_parts': aggregate(Count('lego_piece', distinct=True)),
+        'total_weight': aggregate(Sum(F('quantity') * F('lego_piece__weight'))),
+    }
+    colors = pieces_model.objects.order_by().values_list('lego_set_id', 'lego_color_id') \
+        .annotate(quantity=Sum('quantity'))
+
+    if lego_sets is None:
+        with transaction.atomic():
+            set_color_model.objects.all().delete()
+            _insert_select(set_color_model, SET_COLOR_FIELDS, colors)
+            return set_model.objects.update(**aggregates)
+
+    pks = sorted(set(lego_sets))
+    updated = 0
+    for i in range(0, len(pks), BATCH_SIZE):
+        batch = pks[i:i + BATCH_SIZE]
+        with transaction.atomic():
+            updated += set_model.objects.filter(pk__in=batch).update(**aggregates)
+            set_color_model.objects.filter(lego_set_id__in=batch).delete()
+            _insert_select(set_color_model, SET_COLOR_FIELDS, colors.filter(lego_set_id__in=batch))
+    return updated
+
+
+def _insert_select(model, fields: List[str], queryset) -> int:
+    # INSERT INTO ... SELECT of a values_list queryset selecting fields in order, rows never pass through Python
+    sql, params = queryset.query.sql_with_params()
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(model._meta.get_field(field).column) for field in fields)
+    with connection.cursor() as cursor:
+        cursor.execute(f'INSERT INTO {table} ({columns}) {sql}', params)
+        return cursor.rowcount
+
+
+def update_part_usage(lego_sets: Optional[Iterable[int]] = None, pieces_model=LegoPieces,
+                      usage_model=LegoPartUsage, usage_set_model=LegoPartUsageSet) -> int:
+    """
+    Refreshes the part usage index for the part lists of lego_sets (every set when None): the
+    (set, piece, color) rows of those part lists, then the set count and total quantity of every
+    piece they used before or use now, in every color. The rows kept for deleted sets tell which
+    pieces they used. Returns the number of (piece, color) rows written.
+    """
+    lines = pieces_model.objects.order_by().values_list('lego_set_id', 'lego_piece_id', 'lego_color_id') \
+        .annotate(quantity=Sum('quantity'))
+    # (set, piece, color) rows are unique, so every row of a pair is one set
+    totals = usage_set_model.objects.order_by().values_list('lego_piece_id', 'lego_color_id') \
+        .annotate(set_count=Count('pk'), total_quantity=Sum('quantity'))
+
+    if lego_sets is not None:
+        lego_sets = set(lego_sets)
+        if len(lego_sets) > BATCH_SIZE and len(lego_sets) * FULL_REFRESH_RATIO > \
+                usage_set_model.objects.order_by().values('lego_set_id').distinct().count():
+            lego_sets = None
+
+    with transaction.atomic():
+        if lego_sets is None:
+            usage_set_model.objects.all().delete()
+            usage_model.objects.all().delete()
+            _insert_select(usage_set_model, USAGE_SET_FIELDS, lines)
+            return _insert_select(usage_model, USAGE_FIELDS, totals)
+
+        lego_sets = sorted(set(lego_sets))
+        pieces = set()
+        for i in range(0, len(lego_sets), BATCH_SIZE):
+            batch = lego_sets[i:i + BATCH_SIZE]
+            stale = usage_set_model.objects.filter(lego_set_id__in=batch)
+            pieces.update(stale.order_by().values_list('lego_piece_id', flat=True).distinct())
+            stale.delete()
+            pieces.update(pieces_model.objects.filter(lego_set_id__in=batch).order_by()
+                          .values_list('lego_piece_id', flat=True).distinct())
+            _insert_select(usage_set_model, USAGE_SET_FIELDS, lines.filter(lego_set_id__in=batch))
+
+        pieces = sorted(pieces)
+        written = 0
+        for i in range(0, len(pieces), BATCH_SIZE):
+            batch = pieces[i:i + BATCH_SIZE]
+            usage_model.objects.filter(lego_piece_id__in=batch).delete()
+            written += _insert_select(usage_model, USAGE_FIELDS, totals.filter(lego_piece_id__in=batch))
+        return written
+
+
+def sets_with_pieces(lego_pieces: Iterable[int]) -> List[int]:
+    # sets using any of the pieces, whose weights are part of their aggregates
+    lego_pieces = sorted(set(lego_pieces))
+    lego_sets = set()
+    for i in range(0, len(lego_pieces), BATCH_SIZE):
+        lego_sets.update(LegoPieces.objects.filter(lego_piece_id__in=lego_pieces[i:i + BATCH_SIZE])
+                         .order_by().values_list('lego_set_id', flat=True).distinct())
+    return sorted(lego_sets)
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class LegoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'lego'
+
+    def ready(self):
+        # connect cache invalidation receivers
+        from lego import signals  # noqa: F401
+        # instrument the database connections for lego.metrics
+        from lego import metrics  # noqa: F401
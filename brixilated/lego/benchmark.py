@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+
+from lego.aggregates import update_part_usage, update_set_aggregates
+from lego.cache import LRUCache
+from lego.data.load_data import (load_lego_colors_csv, load_lego_pieces_csv, load_lego_set_csv,
+                                 sync_lego_pieces_csv, sync_lego_set_csv)
+from lego.models import LegoColor, LegoPiece, LegoPieces, LegoSet
+from lego.views import CachedGraphQLView
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PERCENTILES = [50, 90, 99]
+
+
+class QueryCounter:
+    # counts the statements run through the connection without keeping their SQL, unlike CaptureQueriesContext
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def peak_rss_mb() -> Optional[float]:
+    # peak resident set size of the process so far, kilobytes on Linux and bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    # wall time statistics of the samples, in seconds
+    summary = {'calls': len(samples), 'mean': round(float(np.mean(samples)), 6)}
+    for percentile, value in zip(PERCENTILES, np.percentile(samples, PERCENTILES)):
+        summary[f'p{percentile}'] = round(float(value), 6)
+    return summary
+
+
+@contextmanager
+def measure(results: Dict[str, dict], name: str) -> Iterator[List[float]]:
+    """
+    Records the wall time, SQL statements and peak RSS of the block under results[name]. The
+    block may append the duration of each of its calls to the yielded list for percentiles.
+    """
+    counter = QueryCounter()
+    samples = []
+    start = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        yield samples
+    result = {'wall_time': round(time.perf_counter() - start, 6), 'queries': counter.count}
+    if samples:
+        result.update(summarize(samples))
+    result['peak_rss_mb'] = peak_rss_mb()
+    results[name] = result
+
+
+def timed(function: Callable, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def run_loaders(catalog: str, sync_sample: int = 100) -> Dict[str, dict]:
+    """
+    Loads the catalog generated by lego.data.synthetic.generate_catalog into an empty database
+    with the loaders of lego.data.load_data, then times their no-op re-runs and the full rebuilds
+    of the set aggregates and part usage index.
+    """
+    colors_csv = os.path.join(catalog, 'lego_colors.csv')
+    pieces_dir = os.path.join(catalog, 'default_lego_pieces')
+    pieces_csvs = [os.path.join(pieces_dir, name) for name in sorted(os.listdir(pieces_dir)) if name.endswith('.csv')]
+    sets_dir = os.path.join(catalog, 'default_lego_sets')
+    set_csvs = [os.path.join(sets_dir, name) for name in sorted(os.listdir(sets_dir)) if name.endswith('.csv')]
+
+    results = {}
+    with measure(results, 'load_lego_colors_csv'):
+        load_lego_colors_csv(colors_csv)
+    with measure(results, 'load_lego_colors_csv.upsert'):
+        load_lego_colors_csv(colors_csv, upsert=True)
+    with measure(results, 'load_lego_pieces_csv') as samples:
+        samples.extend(timed(load_lego_pieces_csv, csv_file) for csv_file in pieces_csvs)
+    with measure(results, 'load_lego_pieces_csv.upsert') as samples:
+        samples.extend(timed(load_lego_pieces_csv, csv_file, True) for csv_file in pieces_csvs)
+    with measure(results, 'sync_lego_pieces_csv') as samples:
+        samples.extend(timed(sync_lego_pieces_csv, csv_file) for csv_file in pieces_csvs)
+    with measure(results, 'load_lego_set_csv') as samples:
+        samples.extend(timed(load_lego_set_csv, csv_file) for csv_file in set_csvs)
+    # re-syncing unchanged part lists, spread over the whole catalog
+    step = max(len(set_csvs) // max(sync_sample, 1), 1)
+    with measure(results, 'sync_lego_set_csv') as samples:
+        samples.extend(timed(sync_lego_set_csv, csv_file) for csv_file in set_csvs[::step][:sync_sample])
+    with measure(results, 'update_set_aggregates'):
+        update_set_aggregates()
+    with measure(results, 'update_part_usage'):
+        update_part_usage()
+    return results
+
+
+def representative_queries(seed: int = 0) -> Dict[str, dict]:
+    # GraphQL requests covering the custom resolvers, built from the loaded catalog
+    rng = np.random.default_rng(seed)
+    set_pks = list(LegoSet.objects.order_by('-total_pieces').values_list('pk', flat=True)[:5])
+    inventory = [{'legoPiece': piece, 'legoColor': color, 'quantity': quantity} for piece, color, quantity in
+                 LegoPieces.objects.filter(lego_set_id__in=set_pks[:2]).values_list('lego_piece_id', 'lego_color_id',
+                                                                                   'quantity')]
+    ldraw_ids = list(LegoPiece.objects.exclude(ldraw_id=None).order_by('?').values_list('ldraw_id', flat=True)[:1000])
+    part_name = LegoPiece.objects.order_by('pk').values_list('part_name', flat=True).first() or 'Brick'
+    return {
+        'legoSets': {'query': '''{
+          legoSets(first: 50, orderBy: TOTAL_PIECES_DESC) {
+            name totalPieces uniqueParts
+            LegoPieces(first: 20) { edges { node { quantity legoPiece { partName } legoColor { name } } } }
+          }
+        }'''},
+        'allLegoPieces': {'query': '''{
+          allLegoPieces(first: 100) { edges { node { quantity elementId legoPiece { ldrawId } legoColor { name } } } }
+        }'''},
+        'searchParts': {'query': '''query ($query: String!) {
+          searchParts(query: $query, first: 20) { partName ldrawId }
+        }''', 'variables': {'query': part_name}},
+        'nearestColors': {'query': '''query ($colors: [ColorInput!]!) {
+          nearestColors(colors: $colors, k: 3) { colorIds distances }
+        }''', 'variables': {'colors': [{'rgb': rgb} for rgb in rng.integers(0, 256, (100, 3)).tolist()]}},
+        'buildableSets': {'query': '''query ($inventory: [InventoryItemInput!]!) {
+          buildableSets(inventory: $inventory, first: 20) {
+            buildableCount sets { legoSet { name } percentComplete shortfalls(first: 5) { missing } }
+          }
+        }''', 'variables': {'inventory': inventory}},
+        'setDiff': {'query': '''query ($legoSets: [Int!]!) {
+          setDiff(legoSets: $legoSets) { quantities summaries { added removed changed pieceDelta } }
+        }''', 'variables': {'legoSets': set_pks}},
+        'translateIds': {'query': '''query ($ids: [String!]!) {
+          translateIds(kind: PART, source: LDRAW, target: BRICKLINK, ids: $ids) { ids unresolved }
+        }''', 'variables': {'ids': ldraw_ids}},
+        'partUsage': {'query': '''{
+          partUsage(first: 50) { setCount totalQuantity legoPiece { partName } topSets(first: 5) { quantity } }
+        }'''},
+    }
+
+
+def run_queries(repeat: int = 20, seed: int = 0) -> Dict[str, dict]:
+    """
+    Sends every representative query repeat + 1 times through /lego/graphql with the response
+    cache disabled. The first request, which also builds the in-memory indexes, is reported as
+    cold; the percentiles and query counts are those of the others.
+    """
+    response_cache = CachedGraphQLView.response_cache
+    CachedGraphQLView.response_cache = LRUCache(max_size=0)
+    client = Client()
+
+    def send(body: str) -> None:
+        response = client.post('/lego/graphql', body, content_type='application/json')
+        content = response.json()
+        if response.status_code != 200 or content.get('errors'):
+            raise RuntimeError(f'GraphQL request failed: {content}')
+
+    results = {}
+    try:
+        for name, request in representative_queries(seed).items():
+            body = json.dumps(request)
+            cold = timed(send, body)
+            with measure(results, name) as samples:
+                samples.extend(timed(send, body) for _ in range(repeat))
+            results[name]['cold'] = round(cold, 6)
+            results[name]['queries'] = results[name]['queries'] // max(repeat, 1)
+    finally:
+        CachedGraphQLView.response_cache = response_cache
+    return results
+
+
+def run_benchmark(catalog: str, repeat: int = 20, sync_sample: int = 100, seed: int = 0) -> dict:
+    # the catalog must be loaded into an empty database, such as the test database
+    loaders = run_loaders(catalog, sync_sample)
+    return {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'database': connection.vendor,
+        'catalog': {
+            'path': os.path.abspath(catalog),
+            'colors': LegoColor.objects.count(),
+            'pieces': LegoPiece.objects.count(),
+            'sets': LegoSet.objects.count(),
+            'lines': LegoPieces.objects.count(),
+        },
+        'loaders': loaders,
+        'queries': run_queries(repeat, seed),
+    }
+
+
+def compare(baseline: dict, results: dict, threshold: float = 10) -> List[dict]:
+    """
+    Relative change of the wall time (or p50 when timed per call) of every step of results
+    against baseline, a previous run_benchmark output. A step is a regression when it is more
+    than threshold percent slower.
+    """
+    changes = []
+    for section in ('loaders', 'queries'):
+        for name, result in results.get(section, {}).items():
+            old = baseline.get(section, {}).get(name)
+            if old is None:
+                continue
+            metric = 'p50' if 'p50' in result and 'p50' in old else 'wall_time'
+            change = (result[metric] - old[metric]) / old[metric] * 100 if old[metric] else 0.0
+            changes.append({'section': section, 'name': name, 'metric': metric, 'baseline': old[metric],
+                            'current': result[metric], 'change': round(change, 1),
+                            'regression': change > threshold})
+    return changes
@@ -0,0 +1,235 @@
+import copy
+import threading
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db.models import Sum
+
+from lego.cache import get_catalog_changes, get_catalog_version
+from lego.color_index import delta_e2000, get_color_index
+from lego.models import LegoPieces
+
+# color key of the lines of custom pieces, which have no color
+NO_COLOR = -1
+
+# sets whose part lists are re-read per query
+SET_BATCH_SIZE = 500
+
+
+def _key(piece: np.ndarray, color: np.ndarray) -> np.ndarray:
+    # (piece, color) pairs packed into one int64 column key
+    return (np.asarray(piece, dtype=np.int64) << 32) | (np.asarray(color, dtype=np.int64) & 0xFFFFFFFF)
+
+
+class BuildabilityIndex(object):
+    """
+    Part lists of every LegoSet compiled into a sparse sets x (piece, color) matrix, stored as
+    coordinate arrays with one entry per set line. Every set is scored against an inventory in
+    a few vectorized passes over the entries. Instances are never modified once built, updates
+    return a new index so concurrent queries keep a consistent view.
+    """
+
+    def __init__(self, version: int = None):
+        self.version = version
+        self.set_ids = np.empty(0, dtype=np.int64)      # row -> LegoSet pk
+        self.set_rows = {}                              # LegoSet pk -> row
+        self.columns = {}                               # packed (piece, color) key -> column
+        self.col_piece = np.empty(0, dtype=np.int64)    # column -> LegoPiece pk
+        self.col_color = np.empty(0, dtype=np.int64)    # column -> LegoColor pk or NO_COLOR
+        self.rows = np.empty(0, dtype=np.int64)         # entry -> row
+        self.cols = np.empty(0, dtype=np.int64)         # entry -> column
+        self.quantities = np.empty(0, dtype=np.int64)   # entry -> pieces needed
+        self.totals = np.empty(0, dtype=np.int64)       # row -> pieces needed
+
+    @staticmethod
+    def read_part_lists(lego_sets: List[int] = None) -> np.ndarray:
+        # (set, piece, color, quantity) rows of the part lists, one per (set, piece, color)
+        queryset = LegoPieces.objects.order_by()
+        if lego_sets is None:
+            batches = [queryset]
+        else:
+            batches = [queryset.filter(lego_set_id__in=lego_sets[i:i + SET_BATCH_SIZE])
+                       for i in range(0, len(lego_sets), SET_BATCH_SIZE)]
+        lines = [(lego_set, piece, NO_COLOR if color is None else color, quantity)
+                 for batch in batches
+                 for lego_set, piece, color, quantity in batch.values_list('lego_set_id', 'lego_piece_id',
+                                                                           'lego_color_id')
+                                                              .annotate(quantity=Sum('quantity'))]
+        return np.array(lines, dtype=np.int64).reshape(-1, 4)
+
+    @classmethod
+    def build(cls, version: int = None) -> 'BuildabilityIndex':
+        return cls(version).updated(None, version)
+
+    def updated(self, lego_sets: Optional[Iterable[int]], version: int = None) -> 'BuildabilityIndex':
+        """A copy with the part lists of lego_sets (every set when None) re-read from the database."""
+        index = copy.copy(self)
+        index.version = version
+        if lego_sets is None:
+            index.__init__(version)
+            lines = self.read_part_lists()
+        else:
+            lego_sets = sorted(set(lego_sets))
+            lines = self.read_part_lists(lego_sets)
+            index.set_rows = dict(self.set_rows)
+            index.columns = dict(self.columns)
+            # drop the old lines of the re-read sets, sets without lines keep an empty row
+            stale = [self.set_rows[pk] for pk in lego_sets if pk in self.set_rows]
+            keep = ~np.isin(self.rows, stale)
+            index.rows, index.cols, index.quantities = self.rows[keep], self.cols[keep], self.quantities[keep]
+
+        new_sets = [pk for pk in np.unique(lines[:, 0]).tolist() if pk not in index.set_rows]
+        index.set_rows.update(zip(new_sets, range(len(index.set_rows), len(index.set_rows) + len(new_sets))))
+        index.set_ids = np.append(index.set_ids, np.array(new_sets, dtype=np.int64))
+
+        keys = _key(lines[:, 1], lines[:, 2])
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        new_keys = [key for key in unique_keys.tolist() if key not in index.columns]
+        index.columns.update(zip(new_keys, range(len(index.columns), len(index.columns) + len(new_keys))))
+        new_keys = np.array(new_keys, dtype=np.int64)
+        index.col_piece = np.append(index.col_piece, new_keys >> 32)
+        index.col_color = np.append(index.col_color, (new_keys & 0xFFFFFFFF).astype(np.int32).astype(np.int64))
+
+        key_columns = np.array([index.columns[key] for key in unique_keys.tolist()], dtype=np.int64)
+        set_rows = np.array([index.set_rows[pk] for pk in lines[:, 0].tolist()], dtype=np.int64)
+        index.rows = np.concatenate([index.rows, set_rows])
+        index.cols = np.concatenate([index.cols, key_columns[inverse]])
+        index.quantities = np.concatenate([index.quantities, lines[:, 3]])
+        index.totals = np.bincount(index.rows, index.quantities, minlength=len(index.set_ids)).astype(np.int64)
+        return index
+
+    def inventory_vector(self, inventory: Dict[Tuple[int, Optional[int]], int]) -> np.ndarray:
+        have = np.zeros(len(self.col_piece), dtype=np.int64)
+        for (piece, color), quantity in inventory.items():
+            column = self.columns.get(int(_key(piece, NO_COLOR if color is None else color)))
+            if column is not None:
+                have[column] += quantity
+        return have
+
+    @staticmethod
+    def similar_colors(tolerance: float) -> Dict[int, List[int]]:
+        # color pk -> pks of the other colors within a CIEDE2000 tolerance, closest first
+        color_index = get_color_index()
+        distances = delta_e2000(color_index.lab[:, None, :], color_index.lab[None, :, :])
+        pks = [color.pk for color in color_index.colors]
+        similar = {}
+        for i, pk in enumerate(pks):
+            others = np.flatnonzero(distances[i] <= tolerance)
+            others = others[others != i]
+            if len(others):
+                similar[pk] = [pks[j] for j in others[np.argsort(distances[i, others], kind='stable')].tolist()]
+        return similar
+
+    def substituted(self, inventory: Dict[Tuple[int, Optional[int]], int], exact: np.ndarray,
+                    tolerance: float) -> np.ndarray:
+        """
+        Pieces of every row covered by bricks of a similar color of the same piece. Within a set,
+        an inventory (piece, color) supplies what its own line, if any, left over; the lines short
+        of their color draw that remainder down in part list order, closest colors first, so one
+        brick is never counted for two lines.
+        """
+        similar = self.similar_colors(tolerance)
+        covered = np.zeros(len(self.set_ids), dtype=np.int64)
+        # columns of the lines a brick of the inventory can stand in for
+        targets = [self.columns.get(int(_key(piece, other))) for (piece, color), quantity in inventory.items()
+                   if quantity > 0 for other in similar.get(color, ())]
+        short = np.flatnonzero(np.isin(self.cols, [column for column in targets if column is not None]) &
+                               (exact < self.quantities))
+        if not len(short):
+            return covered
+
+        # bricks of the inventory used in their exact color by the sets with a line to fill
+        inventory_columns = {self.columns.get(int(_key(piece, NO_COLOR if color is None else color))): (piece, color)
+                             for piece, color in inventory}
+        inventory_columns.pop(None, None)
+        used = np.flatnonzero(np.isin(self.cols, list(inventory_columns)) & np.isin(self.rows, self.rows[short]) &
+                              (exact > 0))
+        remaining = {(row, inventory_columns[column]): int(inventory[inventory_columns[column]]) - quantity
+                     for row, column, quantity in zip(self.rows[used].tolist(), self.cols[used].tolist(),
+                                                      exact[used].tolist())}
+
+        for entry, row, column in zip(short.tolist(), self.rows[short].tolist(), self.cols[short].tolist()):
+            piece = int(self.col_piece[column])
+            missing = int(self.quantities[entry] - exact[entry])
+            for other in similar.get(int(self.col_color[column]), ()):
+                source = (piece, other)
+                if source not in inventory:
+                    continue
+                left = remaining.get((row, source), int(inventory[source]))
+                take = min(missing, left)
+                remaining[(row, source)] = left - take
+                covered[row] += take
+                missing -= take
+                if not missing:
+                    break
+        return covered
+
+    def score(self, inventory: Dict[Tuple[int, Optional[int]], int],
+              tolerance: float = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Pieces of every set (row) covered by an inventory of {(piece pk, color pk): quantity},
+        and the quantity of every entry covered in its exact color.
+        """
+        exact = np.minimum(self.inventory_vector(inventory)[self.cols], self.quantities)
+        covered = np.bincount(self.rows, exact, minlength=len(self.set_ids)).astype(np.int64)
+        if tolerance > 0 and len(exact):
+            covered += self.substituted(inventory, exact, tolerance)
+        return covered, exact
+
+    def rank(self, inventory: Dict[Tuple[int, Optional[int]], int], tolerance: float = 0, min_percent: float = 0,
+             buildable_only: bool = False, first: int = 20, offset: int = 0) -> Tuple[int, List[dict]]:
+        """
+        Number of fully buildable sets, and a page of sets ordered by percent complete (then size)
+        with the lines each one is short of in their exact color.
+        """
+        covered, exact = self.score(inventory, tolerance)
+        percent = np.divide(covered * 100.0, self.totals, out=np.zeros(len(self.totals)), where=self.totals > 0)
+        buildable = (self.totals > 0) & (covered >= self.totals)
+
+        selected = buildable if buildable_only else (self.totals > 0) & (percent >= min_percent)
+        rows = np.flatnonzero(selected)
+        rows = rows[np.lexsort((-self.totals[rows], -percent[rows]))][offset:offset + first]
+
+        short = np.flatnonzero(np.isin(self.rows, rows) & (exact < self.quantities))
+        shortfalls = {}
+        for entry, row in zip(short.tolist(), self.rows[short].tolist()):
+            column = self.cols[entry]
+            color = int(self.col_color[column])
+            shortfalls.setdefault(row, []).append({
+                'lego_piece_id': int(self.col_piece[column]),
+                'lego_color_id': None if color == NO_COLOR else color,
+                'quantity': int(self.quantities[entry]),
+                'missing': int(self.quantities[entry] - exact[entry]),
+            })
+
+        return int(buildable.sum()), [{
+            'lego_set_id': int(self.set_ids[row]),
+            'total_pieces': int(self.totals[row]),
+            'covered_pieces': int(covered[row]),
+            'percent_complete': float(percent[row]),
+            'buildable': bool(buildable[row]),
+            'shortfalls': shortfalls.get(row, []),
+        } for row in rows.tolist()]
+
+
+_buildability_index = None
+_buildability_index_lock = threading.Lock()
+
+
+def get_buildability_index() -> BuildabilityIndex:
+    # catches up with catalog changes, re-reading only the changed sets when they are known
+    global _buildability_index
+    version = get_catalog_version()
+    with _buildability_index_lock:
+        index = _buildability_index
+        if index is None:
+            index = BuildabilityIndex.build(version)
+        elif index.version != version:
+            changed = get_catalog_changes(index.version, version)
+            if changed is None:
+                index = BuildabilityIndex.build(version)
+            else:
+                index = index.updated(changed, version) if changed else copy.copy(index)
+                index.version = version
+        _buildability_index = index
+        return index
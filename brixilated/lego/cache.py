@@ -0,0 +1,96 @@
+import time
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Hashable, Iterable, Optional, Set
+
+from django.db.models import Max
+
+from lego.models import CatalogChange
+
+# how long the change record of every catalog version is kept for indexes catching up on it
+CATALOG_CHANGES_TIMEOUT = 24 * 60 * 60
+# seconds a process serves the catalog version it read before reading it again
+CATALOG_VERSION_TTL = 1.0
+
+# (version, monotonic expiry) last read or written by this process
+_catalog_version = (0, float('-inf'))
+
+
+class LRUCache(object):
+
+    def __init__(self, max_size: int = 1024, ttl: float = None):
+        # ttl in seconds, None keeps entries until they are evicted
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+def get_catalog_version() -> int:
+    """
+    Latest catalog version, the pk of the last CatalogChange. Stored in the database so the writes
+    of loader processes reach every server process; a process reuses the version it read for
+    CATALOG_VERSION_TTL seconds.
+    """
+    global _catalog_version
+    version, expires = _catalog_version
+    if time.monotonic() >= expires:
+        version = CatalogChange.objects.aggregate(version=Max('pk'))['version'] or 0
+        _catalog_version = (version, time.monotonic() + CATALOG_VERSION_TTL)
+    return version
+
+
+def bump_catalog_version(lego_sets: Optional[Iterable[int]] = None,
+                         lego_pieces: Optional[Iterable[int]] = None) -> int:
+    # lego_sets: pks of the sets whose part lists changed, lego_pieces: pks of the pieces written, None when unknown
+    global _catalog_version
+    change = CatalogChange.objects.create(lego_sets=None if lego_sets is None else sorted(set(lego_sets)),
+                                          lego_pieces=None if lego_pieces is None else sorted(set(lego_pieces)))
+    # the latest change is kept whatever its age, it holds the current version
+    CatalogChange.objects.filter(pk__lt=change.pk,
+                                 created__lt=change.created - timedelta(seconds=CATALOG_CHANGES_TIMEOUT)).delete()
+    _catalog_version = (change.pk, time.monotonic() + CATALOG_VERSION_TTL)
+    return change.pk
+
+
+def get_catalog_changes(since: int, version: int, kind: str = 'lego_sets') -> Optional[Set[int]]:
+    """
+    pks of the sets whose part lists changed (kind 'lego_sets') or of the pieces written (kind
+    'lego_pieces') after catalog version since up to version, or None when that is unknown
+    (e.g. cascading deletes or expired records) and a full rebuild is needed.
+    """
+    if version < since:
+        return None
+    records = list(CatalogChange.objects.filter(pk__gt=since, pk__lte=version).values_list(kind, flat=True))
+    # versions are missing once expired, or skipped by the database sequence
+    if len(records) != version - since or None in records:
+        return None
+    return {pk for record in records for pk in record}
@@ -0,0 +1,219 @@
+import re
+import math
+import threading
+import numpy as np
+from typing import Iterable, Optional, Sequence, Tuple
+
+from lego.cache import get_catalog_version
+from lego.models import LegoColor
+
+# queries compared against the palette at once, bounds the size of the (queries, colors) distance matrix
+QUERY_CHUNK_SIZE = 4096
+
+# CIEDE2000 is evaluated on this many closest palette colors by (cheap) CIE76 distance,
+# which agrees with an exhaustive CIEDE2000 search for >99.9% of colors
+PRESELECT = 32
+
+TAU = 2 * np.pi
+
+HEX_CODE = re.compile(r'^#?[0-9a-fA-F]{6}$')
+
+# sRGB (D65) to CIE XYZ, and the D65 reference white
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+_WHITE_D65 = np.array([0.95047, 1.00000, 1.08883])
+
+
+def hex_to_rgb(hex_codes: Iterable[str]) -> np.ndarray:
+    """'RRGGBB' or '#RRGGBB' strings to an (n, 3) array of 0-255 values."""
+    values = np.array([int(code.lstrip('#'), 16) for code in hex_codes], dtype=np.int64)
+    return np.stack([(values >> 16) & 0xFF, (values >> 8) & 0xFF, values & 0xFF], axis=-1).astype(float)
+
+
+def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """(..., 3) sRGB values in 0-255 to CIELAB (D65)."""
+    rgb = np.asarray(rgb, dtype=float) / 255.0
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ _RGB_TO_XYZ.T / _WHITE_D65
+
+    epsilon, kappa = 216 / 24389, 24389 / 27
+    f = np.where(xyz > epsilon, np.cbrt(xyz), (kappa * xyz + 16) / 116)
+    return np.stack([116 * f[..., 1] - 16,
+                     500 * (f[..., 0] - f[..., 1]),
+                     200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def delta_e76(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+    """Euclidean CIELAB distance between broadcastable (..., 3) arrays of colors."""
+    return np.sqrt(((lab1 - lab2) ** 2).sum(axis=-1))
+
+
+def delta_e2000(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+    """CIEDE2000 distance between broadcastable (..., 3) arrays of colors (hue angles in radians)."""
+    L1, a1, b1 = (lab1[..., i] for i in range(3))
+    L2, a2, b2 = (lab2[..., i] for i in range(3))
+
+    C_mean7 = ((np.hypot(a1, b1) + np.hypot(a2, b2)) / 2) ** 7
+    G = 0.5 * (1 - np.sqrt(C_mean7 / (C_mean7 + 25.0 ** 7)))
+    a1p, a2p = (1 + G) * a1, (1 + G) * a2
+    C1p, C2p = np.hypot(a1p, b1), np.hypot(a2p, b2)
+    h1p = np.arctan2(b1, a1p) % TAU
+    h2p = np.arctan2(b2, a2p) % TAU
+    CC = C1p * C2p
+
+    dLp = L2 - L1
+    dCp = C2p - C1p
+    dhp = h2p - h1p
+    dhp = np.where(dhp > np.pi, dhp - TAU, np.where(dhp < -np.pi, dhp + TAU, dhp))
+    dHp = 2 * np.sqrt(CC) * np.sin(dhp / 2)
+
+    Lp_mean = (L1 + L2) / 2
+    Cp_mean = (C1p + C2p) / 2
+    hp_sum = h1p + h2p
+    hp_mean = np.where(np.abs(h1p - h2p) > np.pi, np.where(hp_sum < TAU, hp_sum + TAU, hp_sum - TAU), hp_sum) / 2
+    hp_mean = np.where(CC == 0, hp_sum, hp_mean)
+
+    T = (1 - 0.17 * np.cos(hp_mean - math.radians(30)) + 0.24 * np.cos(2 * hp_mean)
+         + 0.32 * np.cos(3 * hp_mean + math.radians(6)) - 0.20 * np.cos(4 * hp_mean - math.radians(63)))
+    d_theta = math.radians(30) * np.exp(-(((hp_mean - math.radians(275)) / math.radians(25)) ** 2))
+    Cp_mean7 = Cp_mean ** 7
+    R_C = 2 * np.sqrt(Cp_mean7 / (Cp_mean7 + 25.0 ** 7))
+    L_offset = (Lp_mean - 50) ** 2
+    S_L = 1 + 0.015 * L_offset / np.sqrt(20 + L_offset)
+    S_C = 1 + 0.045 * Cp_mean
+    S_H = 1 + 0.015 * Cp_mean * T
+    R_T = -np.sin(2 * d_theta) * R_C
+
+    dC = dCp / S_C
+    dH = dHp / S_H
+    return np.sqrt((dLp / S_L) ** 2 + dC ** 2 + dH ** 2 + R_T * dC * dH)
+
+
+def to_lab(colors: Sequence[dict]) -> np.ndarray:
+    """
+    (n, 3) CIELAB array of colors given as dicts with one of 'hex' ('RRGGBB'), 'rgb' ([r, g, b]
+    in 0-255) or 'lab' ([L, a, b]), converting each kind in one vectorized step.
+    """
+    lab = np.empty((len(colors), 3))
+    positions = {'hex': [], 'rgb': [], 'lab': []}
+    values = {'hex': [], 'rgb': [], 'lab': []}
+    for i, color in enumerate(colors):
+        given = [key for key in positions if color.get(key) is not None]
+        if len(given) != 1:
+            raise ValueError(f'Color {i} must set exactly one of hex, rgb or lab')
+        key = given[0]
+        value = color[key]
+        if key == 'hex' and not HEX_CODE.match(value):
+            raise ValueError(f'Color {i} has an invalid hex code: {value}')
+        if key != 'hex' and len(value) != 3:
+            raise ValueError(f'Color {i} must have 3 {key} components')
+        positions[key].append(i)
+        values[key].append(value)
+
+    if positions['hex']:
+        lab[positions['hex']] = rgb_to_lab(hex_to_rgb(values['hex']))
+    if positions['rgb']:
+        lab[positions['rgb']] = rgb_to_lab(np.clip(np.array(values['rgb'], dtype=float), 0, 255))
+    if positions['lab']:
+        lab[positions['lab']] = np.array(values['lab'], dtype=float)
+    return lab
+
+
+METRICS = {
+    'cie76': delta_e76,
+    'ciede2000': delta_e2000,
+}
+
+
+class ColorIndex(object):
+    """
+    In-memory CIELAB palette of every LegoColor with a hex code, answering k-nearest color
+    queries with vectorized distance computations (the palette is a few hundred colors, so a
+    brute force search over it beats building a tree).
+    """
+
+    def __init__(self, colors: Sequence[LegoColor], version: int = None):
+        self.version = version
+        self.colors = [color for color in colors if color.hex_code and HEX_CODE.match(color.hex_code)]
+        self.lab = rgb_to_lab(hex_to_rgb(color.hex_code for color in self.colors)).reshape(-1, 3)
+        self.materials = np.array([color.material for color in self.colors], dtype=object)
+        # unknown years never exclude a color
+        self.year_start = np.array([color.year_start if color.year_start is not None else -np.inf
+                                    for color in self.colors], dtype=float)
+        self.year_end = np.array([color.year_end if color.year_end is not None else np.inf
+                                  for color in self.colors], dtype=float)
+
+    def candidates(self, materials: Iterable[str] = None, year_from: int = None,
+                   year_to: int = None) -> np.ndarray:
+        # indices of the palette colors matching the filters, year filters select colors active in the range
+        mask = np.ones(len(self.colors), dtype=bool)
+        if materials:
+            mask &= np.isin(self.materials, list(materials))
+        if year_from is not None:
+            mask &= self.year_end >= year_from
+        if year_to is not None:
+            mask &= self.year_start <= year_to
+        return np.flatnonzero(mask)
+
+    def nearest(self, lab: np.ndarray, k: int = 1, metric: str = 'ciede2000', materials: Iterable[str] = None,
+                year_from: int = None, year_to: int = None,
+                preselect: Optional[int] = PRESELECT) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k closest palette colors of every (n, 3) CIELAB query color, as (n, k) arrays of
+        palette indices (into self.colors) and distances, closest first. preselect=None makes
+        the CIEDE2000 search exhaustive.
+        """
+        lab = np.asarray(lab, dtype=float).reshape(-1, 3)
+        candidates = self.candidates(materials, year_from, year_to)
+        k = min(k, len(candidates))
+        if k == 0:
+            return np.empty((len(lab), 0), dtype=int), np.empty((len(lab), 0))
+
+        # repeated colors (e.g. image pixels) are only searched once
+        # (rows viewed as single opaque values, much faster than np.unique(axis=0))
+        rows = np.ascontiguousarray(lab, dtype=np.float32).view(np.dtype((np.void, 12))).ravel()
+        queries, inverse = np.unique(rows, return_inverse=True)
+        queries = queries.view(np.float32).reshape(-1, 3)
+        palette = self.lab[candidates].astype(np.float32)
+        palette_norms = (palette ** 2).sum(axis=1)
+        shortlist_size = len(candidates)
+        if metric == 'cie76':
+            shortlist_size = k
+        elif preselect:
+            shortlist_size = min(len(candidates), max(k, preselect))
+
+        indices = np.empty((len(queries), k), dtype=int)
+        distances = np.empty((len(queries), k))
+        for start in range(0, len(queries), QUERY_CHUNK_SIZE):
+            chunk = queries[start:start + QUERY_CHUNK_SIZE]
+            # squared CIE76 distances of the whole chunk as one matrix product
+            squared = (chunk ** 2).sum(axis=1)[:, None] + palette_norms[None, :] - 2 * chunk @ palette.T
+            shortlist = np.argpartition(squared, shortlist_size - 1, axis=1)[:, :shortlist_size]
+            if metric == 'cie76':
+                shortlist_distances = np.sqrt(np.maximum(np.take_along_axis(squared, shortlist, axis=1), 0))
+            else:
+                shortlist_distances = METRICS[metric](chunk[:, None, :], palette[shortlist])
+
+            nearest = np.argpartition(shortlist_distances, k - 1, axis=1)[:, :k]
+            nearest_distances = np.take_along_axis(shortlist_distances, nearest, axis=1)
+            order = np.argsort(nearest_distances, axis=1, kind='stable')
+            nearest = np.take_along_axis(np.take_along_axis(shortlist, nearest, axis=1), order, axis=1)
+            indices[start:start + len(chunk)] = candidates[nearest]
+            distances[start:start + len(chunk)] = np.take_along_axis(nearest_distances, order, axis=1)
+        return indices[inverse], distances[inverse]
+
+
+_color_index = None
+_color_index_lock = threading.Lock()
+
+
+def get_color_index() -> ColorIndex:
+    # rebuilt whenever the catalog version changes (see lego.signals)
+    global _color_index
+    version = get_catalog_version()
+    with _color_index_lock:
+        if _color_index is None or _color_index.version != version:
+            _color_index = ColorIndex(list(LegoColor.objects.exclude(hex_code__isnull=True).exclude(hex_code='')),
+                                      version)
+        return _color_index
@@ -1,5 +1,4 @@
 import os
-import requests
 from bs4 import BeautifulSoup
 import pandas as pd
 import datetime
@@ -7,6 +6,8 @@ import datetime
 from django.conf import settings
 from django.core.management.base import OutputWrapper
 
+from .http_cache import get_default_cache
+
 
 def fetch_colors(log: OutputWrapper = None) -> pd.DataFrame:
     url = 'http://ryanhowerter.net/colors.php'
@@ -18,7 +19,7 @@ def fetch_colors(log: OutputWrapper = None) -> pd.DataFrame:
     headers = {
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.12; rv:55.0) Gecko/20100101 Firefox/55.0',
     }
-    r = requests.get(url, headers=headers)
+    r = get_default_cache().get(url, headers=headers)
 
     if log:
         log.write('Parsing Lego Colors')
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import requests
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+
+
+class CachedResponse(object):
+
+    def __init__(self, url: str, status_code: int, headers: Dict[str, str], path: str = None,
+                 content: bytes = None, from_cache: bool = False, encoding: str = None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.path = path
+        # encoding of the original response, utf-8 when the server sent none
+        self.encoding = encoding
+        self.from_cache = from_cache
+        self._content = content
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status_code < 400
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None and self.path:
+            with open(self.path, 'rb') as f:
+                self._content = f.read()
+        return self._content
+
+    @property
+    def text(self) -> str:
+        return str(self.content, self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self) -> None:
+        if not self.ok:
+            raise requests.HTTPError(f'{self.status_code} Error for url: {self.url}')
+
+    def __repr__(self) -> str:
+        return f'<CachedResponse [{self.status_code}]{" (cached)" if self.from_cache else ""}>'
+
+
+class HTTPCache(object):
+
+    def __init__(self, cache_dir: str, ttl: float = 3600, max_size: int = 1024 ** 3,
+                 session: requests.Session = None):
+        # ttl in seconds before a stored entry is revalidated, max_size in bytes across all bodies
+        self.cache_dir = str(cache_dir)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.session = session or requests.Session()
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _paths(self, url: str):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return f'{base}.body', f'{base}.json'
+
+    def _read_meta(self, meta_path: str) -> Optional[dict]:
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path: str, meta: dict) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def _hit(self, url: str, body_path: str, meta_path: str, meta: dict) -> CachedResponse:
+        # access time of the metadata file drives LRU eviction
+        os.utime(meta_path)
+        return CachedResponse(url, meta['status_code'], meta['headers'], path=body_path, from_cache=True,
+                              encoding=meta.get('encoding'))
+
+    def get(self, url: str, headers: Dict[str, str] = None, timeout: int = 60,
+            session: requests.Session = None, before_request: Callable[[], None] = None) -> CachedResponse:
+        session = session or self.session
+        body_path, meta_path = self._paths(url)
+        meta = self._read_meta(meta_path) if os.path.exists(body_path) else None
+
+        # fresh entries are served without contacting the server
+        if meta and time.time() - meta['stored_at'] < self.ttl:
+            return self._hit(url, body_path, meta_path, meta)
+
+        request_headers = dict(headers or {})
+        if meta:
+            if meta.get('etag'):
+                request_headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                request_headers['If-Modified-Since'] = meta['last_modified']
+
+        # e.g. rate limiting, only applied when the network is actually used
+        if before_request:
+            before_request()
+
+        with session.get(url, headers=request_headers, timeout=timeout, stream=True) as r:
+            if r.status_code == 304 and meta:
+                meta['stored_at'] = time.time()
+                self._write_meta(meta_path, meta)
+                return self._hit(url, body_path, meta_path, meta)
+
+            if r.status_code != 200:
+                return CachedResponse(url, r.status_code, dict(r.headers), content=r.content, encoding=r.encoding)
+
+            # stream the body to disk so large downloads never sit in memory
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for block in r.iter_content(chunk_size=1024 * 1024):
+                    f.write(block)
+                    size += len(block)
+            os.replace(tmp_path, body_path)
+
+            meta = {
+                'url': url,
+                'status_code': r.status_code,
+                'headers': {key: value for key, value in r.headers.items()
+                            if key.lower() in ('content-type', 'etag', 'last-modified', 'retry-after')},
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+                'encoding': r.encoding,
+                'stored_at': time.time(),
+                'size': size,
+            }
+            self._write_meta(meta_path, meta)
+
+        # the body just written is read lazily by the caller, it is never evicted here even when
+        # larger than max_size, the next store drops it
+        self.evict(keep=meta_path)
+        return CachedResponse(url, meta['status_code'], meta['headers'], path=body_path, encoding=meta['encoding'])
+
+    def evict(self, keep: str = None) -> None:
+        # drop least recently used entries until the cache fits in max_size, except the keep metadata path
+        with self.lock:
+            entries = []
+            total = 0
+            for filename in os.listdir(self.cache_dir):
+                if not filename.endswith('.json'):
+                    continue
+                meta_path = os.path.join(self.cache_dir, filename)
+                meta = self._read_meta(meta_path)
+                if meta is None:
+                    continue
+                total += meta['size']
+                if meta_path == keep:
+                    continue
+                entries.append((os.path.getmtime(meta_path), meta_path, meta['size']))
+
+            for _, meta_path, size in sorted(entries):
+                if total <= self.max_size:
+                    break
+                for path in (meta_path[:-len('.json')] + '.body', meta_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+
+    def clear(self) -> None:
+        with self.lock:
+            for filename in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, filename))
+
+
+_default_cache = None
+
+
+def get_default_cache() -> HTTPCache:
+    global _default_cache
+    if _default_cache is None:
+        config = getattr(settings, 'LEGO_HTTP_CACHE', {})
+        _default_cache = HTTPCache(config.get('DIR', os.path.join(settings.BASE_DIR, '.http_cache')),
+                                   ttl=config.get('TTL', 3600),
+                                   max_size=config.get('MAX_SIZE', 1024 ** 3))
+    return _default_cache
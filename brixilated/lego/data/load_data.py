@@ -1,69 +1,186 @@
 import os
 import numpy as np
 import pandas as pd
-from functools import partial
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Type
+from django.db import models, transaction
+from django.db.models import Q
 from lego.models import LegoPiece, LegoPieces, LegoSet, LegoColor
 from django.core.management.base import OutputWrapper
 
 from .colors import fetch_colors
+from .sync import sync_objects
+from lego.id_maps import get_id_maps, resolve_ids
+from lego.signals import catalog_updated
 
 
-def load_lego_pieces_csv(csv_file: str, log: OutputWrapper = None) -> bool:
-    populate_pieces = lambda row: LegoPiece.objects.create(**row)
+# columns used to match existing colors/pieces, mirroring the old get_or_create lookups
+COLOR_KEY_FIELDS = ['bl_color_id', 'bl_color_name', 'ldraw_color_id', 'material']
+PIECE_KEY_FIELDS = ['part_name', 'weight', 'ldraw_id', 'bl_item_no', 'custom_piece']
 
+# rows per INSERT / values per IN (...) clause, kept below SQLite's variable limit
+BATCH_SIZE = 500
+
+
+def _chunks(values: list, size: int = BATCH_SIZE) -> Iterator[list]:
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _model_key(model: Type[models.Model], fields: List[str], values: Iterable) -> tuple:
+    # normalize values the same way the ORM does before they reach the database
+    return tuple(model._meta.get_field(field).get_prep_value(value) for field, value in zip(fields, values))
+
+
+def _fetch_existing(model: Type[models.Model], fields: List[str], keys: Iterable[tuple],
+                    lookup_field: str) -> Dict[tuple, models.Model]:
+    # narrow candidates with IN (...) on a single column, then match the full key in memory
+    lookup_idx = fields.index(lookup_field)
+    values = {key[lookup_idx] for key in keys}
+    filters = [Q(**{f'{lookup_field}__in': chunk}) for chunk in _chunks([v for v in values if v is not None])]
+    if None in values:
+        filters.append(Q(**{f'{lookup_field}__isnull': True}))
+
+    existing = {}
+    for query_filter in filters:
+        for obj in model.objects.filter(query_filter):
+            existing.setdefault(_model_key(model, fields, [getattr(obj, f) for f in fields]), obj)
+    return existing
+
+
+def _bulk_create_missing(model: Type[models.Model], fields: List[str], new_objs: Dict[tuple, models.Model],
+                         lookup_field: str) -> None:
+    if not new_objs:
+        return
+    model.objects.bulk_create(new_objs.values(), batch_size=BATCH_SIZE)
+
+    # backends that cannot return primary keys from bulk inserts need a second lookup
+    if any(obj.pk is None for obj in new_objs.values()):
+        created = _fetch_existing(model, fields, new_objs.keys(), lookup_field)
+        for key, obj in new_objs.items():
+            obj.pk = created[key].pk
+
+
+def upsert_objects(model: Type[models.Model], rows: List[dict], key_fields: List[str]) -> Dict[str, int]:
+    """
+    Inserts or updates an entry per row, matched on its non-null key fields. A row whose key
+    fields match different entries, or an entry with a different non-null value of another key
+    field, is a conflict and skipped. Rows matching an entry written by an earlier row are merged
+    into it. Every row is counted once: inserted, updated, unchanged, merged or conflicts.
+    """
+    existing = {field: {} for field in key_fields}
+    # one instance per entry, whichever key field fetched it
+    instances = {}
+    for field in key_fields:
+        values = list({row[field] for row in rows if row.get(field) is not None})
+        for chunk in _chunks(values):
+            for obj in model.objects.filter(**{f'{field}__in': chunk}):
+                obj = instances.setdefault(obj.pk, obj)
+                existing[field].setdefault(_model_key(model, [field], [getattr(obj, field)]), obj)
+
+    update_fields = [field for field in rows[0].keys() if field not in key_fields] if rows else []
+    update_fields += key_fields
+    inserts = {}
+    updates = {}
+    # entries written by earlier rows of the batch, by id()
+    written_objs = set()
+    unchanged = merged = conflicts = 0
+    for row in rows:
+        row_keys = {field: _model_key(model, [field], [row[field]]) for field in key_fields
+                    if row.get(field) is not None}
+        matches = {id(obj): obj for obj in (existing[field].get(key) for field, key in row_keys.items())
+                   if obj is not None}
+        obj = next(iter(matches.values())) if len(matches) == 1 else None
+        if len(matches) > 1 or obj is not None and any(
+                getattr(obj, field) is not None and _model_key(model, [field], [getattr(obj, field)]) != key
+                for field, key in row_keys.items()):
+            # e.g. a color whose LDraw id belongs to one entry and BrickLink id to another
+            conflicts += 1
+            continue
+
+        if obj is None:
+            obj = model(**row)
+            inserts[id(obj)] = obj
+        else:
+            fields = [field for field in row if row[field] is not None or field not in key_fields]
+            row_values = _model_key(model, fields, [row[f] for f in fields])
+            obj_values = _model_key(model, fields, [getattr(obj, f) for f in fields])
+            if id(obj) in written_objs:
+                # inserted or updated by an earlier row of the batch, the last row wins
+                merged += 1
+            elif row_values == obj_values:
+                unchanged += 1
+                continue
+            else:
+                updates[obj.pk] = obj
+            for field in fields:
+                setattr(obj, field, row[field])
+        written_objs.add(id(obj))
+
+        # later rows in the same file resolve to this entry
+        for field in key_fields:
+            if getattr(obj, field) is not None:
+                existing[field][_model_key(model, [field], [getattr(obj, field)])] = obj
+
+    with transaction.atomic():
+        model.objects.bulk_create(inserts.values(), batch_size=BATCH_SIZE)
+        if updates:
+            model.objects.bulk_update(updates.values(), update_fields, batch_size=BATCH_SIZE)
+    if inserts or updates:
+        # inserting or updating sets, pieces and colors leaves every part list as it is
+        written = [] if model is not LegoPiece else None if any(obj.pk is None for obj in inserts.values()) else \
+            [obj.pk for obj in inserts.values()] + list(updates)
+        catalog_updated.send(sender=model, lego_sets=None if model is LegoPieces else [], lego_pieces=written)
+
+    return {'inserted': len(inserts), 'updated': len(updates), 'unchanged': unchanged, 'merged': merged,
+            'conflicts': conflicts}
+
+
+def read_lego_pieces_csv(csv_file: str) -> pd.DataFrame:
     df = pd.read_csv(csv_file,
                      header=None,
-                     names=['part_number', 'name', 'category', 'description'])
+                     names=['ldraw_id', 'part_name', 'category', 'description'],
+                     dtype={'ldraw_id': str},
+                     # the Nature category code NA is not a missing value
+                     keep_default_na=False)
 
+    # pieces without an LDraw id store NULL, which the unique constraint allows more than once
+    df['ldraw_id'] = df['ldraw_id'].replace([''], [None])
     # replace nan in description with blank string
     df['description'] = df['description'].fillna('')
+    return df
 
-    # populate database
-    res_df = df.apply(populate_pieces, 1)
 
-    if log:
-        log.write(f'Loaded {res_df.shape[0]} Lego Pieces into the Database')
-    return True
+def load_lego_pieces_csv(csv_file: str, upsert: bool = False, log: OutputWrapper = None) -> bool:
+    return populate_pieces(read_lego_pieces_csv(csv_file), upsert, log)
 
 
-def populate_set(row: pd.Series, lego_set: LegoSet, log: OutputWrapper = None) -> LegoPieces:
-    custom_piece = row['element_id'] is None
-    color = None
-    if not custom_piece:
-        # get or create color
-        color_headers = ['bl_color_id', 'bl_color_name', 'ldraw_color_id', 'material']
-        df_colors = row[color_headers]
-        color, created = LegoColor.objects.get_or_create(**df_colors)
-        if created and log:
-            log.write(f'Lego Color: {row["bl_color_name"]}, LDrawID: {row["ldraw_color_id"]}'
-                      f' not found in database... New Entry Created.')
-
-    # get or create piece
-    piece_headers = ['part_name', 'weight', 'ldraw_id', 'bl_item_no']
-    df_piece = row[piece_headers]
-    piece, created = LegoPiece.objects.get_or_create(custom_piece=custom_piece, **df_piece)
-    if created and log:
-        log.write(f'Lego Piece: {row["part_name"]} with Part Number: {row["element_id"]} '
-                  f'and LDraw ID: {row["ldraw_id"]} not found in database... New Entry Created.')
-
-    pieces = LegoPieces.objects.create(lego_set=lego_set,
-                                       lego_piece=piece,
-                                       lego_color=color,
-                                       element_id=row['element_id'],
-                                       quantity=row['quantity'])
-    return pieces
+def populate_pieces(df: pd.DataFrame, upsert: bool = False, log: OutputWrapper = None) -> bool:
+    rows = df.to_dict('records')
 
+    # populate database
+    if upsert:
+        counts = upsert_objects(LegoPiece, rows, ['ldraw_id', 'bl_item_no'])
+        if log:
+            log.write(f'Upserted Lego Pieces: {counts["inserted"]} inserted, {counts["updated"]} updated, '
+                      f'{counts["unchanged"]} unchanged, {counts["merged"]} merged, '
+                      f'{counts["conflicts"]} conflicts')
+        return True
 
-def load_lego_set_csv(csv_file: str, log: OutputWrapper = None) -> bool:
-    # create set
-    lego_set_name = os.path.splitext(os.path.basename(csv_file))[0].replace('_Partlist', '')
-    lego_set = LegoSet.objects.create(name=lego_set_name,
-                                      is_complete_set=True)
+    with transaction.atomic():
+        created = LegoPiece.objects.bulk_create([LegoPiece(**row) for row in rows], batch_size=BATCH_SIZE)
+    written = None if any(piece.pk is None for piece in created) else [piece.pk for piece in created]
+    catalog_updated.send(sender=LegoPiece, lego_sets=[], lego_pieces=written)
 
     if log:
-        log.write(f'\nLego set created: {lego_set}')
+        log.write(f'Loaded {len(rows)} Lego Pieces into the Database')
+    return True
+
+
+def lego_set_name_from_csv(csv_file: str) -> str:
+    return os.path.splitext(os.path.basename(csv_file))[0].replace('_Partlist', '')
 
-    # populate set
+
+def read_lego_set_csv(csv_file: str) -> pd.DataFrame:
     df_set = pd.read_csv(csv_file, engine='python', skipfooter=3)
     df_set.rename(columns={
         "BLItemNo": "bl_item_no",
@@ -78,6 +195,9 @@ def load_lego_set_csv(csv_file: str, log: OutputWrapper = None) -> bool:
         "Weight": "weight"
     }, inplace=True)
 
+    # longer names do not fit the column on PostgreSQL
+    df_set['part_name'] = df_set['part_name'].str.slice(0, LegoPiece._meta.get_field('part_name').max_length)
+
     # translate material to code
     df_set['material'] = df_set['material'].apply(
         lambda x: LegoColor.LegoColorCategory[x.replace(' Colors', '').upper()])
@@ -85,23 +205,125 @@ def load_lego_set_csv(csv_file: str, log: OutputWrapper = None) -> bool:
     # replace NaN with None
     df_set = df_set.fillna(np.nan).replace([np.nan, ''], [None, None])
 
-    populate_lego_set = partial(populate_set, lego_set=lego_set, log=log)
-    res_df = df_set.apply(populate_lego_set, 1)
+    # custom pieces have no element id
+    df_set['custom_piece'] = df_set['element_id'].isna()
+    return df_set
+
+
+def _fetch_catalog(rows: List[dict]) -> Tuple[Dict[tuple, LegoColor], Dict[tuple, LegoPiece]]:
+    # resolve every color and piece referenced by the rows through the id maps, by LDraw id then BrickLink id
+    color_rows = [row for row in rows if not row['custom_piece']]
+    color_ids = [resolve_ids('color', scheme, [row[field] for row in color_rows])
+                 for scheme, field in (('ldraw', 'ldraw_color_id'), ('bricklink', 'bl_color_id'))]
+    piece_ids = [resolve_ids('part', scheme, [row[field] for row in rows])
+                 for scheme, field in (('ldraw', 'ldraw_id'), ('bricklink', 'bl_item_no'))]
+    id_maps = get_id_maps()
+
+    def lookup(row: dict, kind: str, fields: List[str], resolved: List[dict]) -> Optional[int]:
+        for field, pks in zip(fields, resolved):
+            pk = pks.get(id_maps[kind].normalize(field, row[field]))
+            if pk is not None:
+                return pk
+        return None
+
+    colors = {}
+    for row in color_rows:
+        pk = lookup(row, 'color', ['ldraw_color_id', 'bl_color_id'], color_ids)
+        if pk is not None:
+            colors[_model_key(LegoColor, COLOR_KEY_FIELDS, [row[f] for f in COLOR_KEY_FIELDS])] = LegoColor(pk=pk)
+    pieces = {}
+    for row in rows:
+        pk = lookup(row, 'part', ['ldraw_id', 'bl_item_no'], piece_ids)
+        if pk is not None:
+            pieces[_model_key(LegoPiece, PIECE_KEY_FIELDS, [row[f] for f in PIECE_KEY_FIELDS])] = LegoPiece(pk=pk)
+    return colors, pieces
 
-    if log:
-        num_parts = res_df.apply(lambda x: x.quantity).sum()
-        log.write('=============================================')
-        log.write(f'Loaded Lego Set into database:')
-        log.write(f'Lego Set Name: {lego_set.name}')
-        log.write(f'Lego Set Description: {lego_set.description}')
-        log.write(f'Total Number of Pieces: {num_parts}')
-        log.write(f'Unique Number of Pieces: {res_df.shape[0]}')
-        log.write('=============================================')
 
+def _resolve_row(row: dict, colors: Dict[tuple, LegoColor], pieces: Dict[tuple, LegoPiece],
+                 new_colors: Dict[tuple, LegoColor], new_pieces: Dict[tuple, LegoPiece],
+                 log: OutputWrapper = None) -> Tuple[LegoColor, LegoPiece]:
+    # unknown colors/pieces are queued in new_colors/new_pieces for a later bulk_create
+    color = None
+    if not row['custom_piece']:
+        key = _model_key(LegoColor, COLOR_KEY_FIELDS, [row[f] for f in COLOR_KEY_FIELDS])
+        color = colors.get(key)
+        if color is None:
+            color = colors[key] = new_colors[key] = LegoColor(**{f: row[f] for f in COLOR_KEY_FIELDS})
+            if log:
+                log.write(f'Lego Color: {row["bl_color_name"]}, LDrawID: {row["ldraw_color_id"]}'
+                          f' not found in database... New Entry Created.')
+
+    key = _model_key(LegoPiece, PIECE_KEY_FIELDS, [row[f] for f in PIECE_KEY_FIELDS])
+    piece = pieces.get(key)
+    if piece is None:
+        piece = pieces[key] = new_pieces[key] = LegoPiece(**{f: row[f] for f in PIECE_KEY_FIELDS})
+        if log:
+            log.write(f'Lego Piece: {row["part_name"]} with Part Number: {row["element_id"]} '
+                      f'and LDraw ID: {row["ldraw_id"]} not found in database... New Entry Created.')
+    return color, piece
+
+
+def populate_sets(lego_sets: List[Tuple[str, pd.DataFrame]], log: OutputWrapper = None) -> List[LegoSet]:
+    records = [(name, df_set.to_dict('records')) for name, df_set in lego_sets]
+    colors, pieces = _fetch_catalog([row for _, set_rows in records for row in set_rows])
+
+    new_colors = {}
+    new_pieces = {}
+    set_pieces = []
+    created_sets = []
+    for lego_set_name, set_rows in records:
+        lego_set = LegoSet(name=lego_set_name, is_complete_set=True)
+        created_sets.append(lego_set)
+        if log:
+            log.write(f'\nLego set created: {lego_set}')
+
+        # walk rows in file order so log output matches row-by-row loading
+        num_parts = 0
+        for row in set_rows:
+            color, piece = _resolve_row(row, colors, pieces, new_colors, new_pieces, log)
+            set_pieces.append(LegoPieces(lego_set=lego_set,
+                                         lego_piece=piece,
+                                         lego_color=color,
+                                         element_id=row['element_id'],
+                                         quantity=row['quantity']))
+            num_parts += row['quantity']
+
+        if log:
+            log.write('=============================================')
+            log.write(f'Loaded Lego Set into database:')
+            log.write(f'Lego Set Name: {lego_set.name}')
+            log.write(f'Lego Set Description: {lego_set.description}')
+            log.write(f'Total Number of Pieces: {num_parts}')
+            log.write(f'Unique Number of Pieces: {len(set_rows)}')
+            log.write('=============================================')
+
+    # write everything in one transaction
+    with transaction.atomic():
+        LegoSet.objects.bulk_create(created_sets, batch_size=BATCH_SIZE)
+        if any(lego_set.pk is None for lego_set in created_sets):
+            set_ids = dict(LegoSet.objects.filter(name__in=[s.name for s in created_sets]).values_list('name', 'pk'))
+            for lego_set in created_sets:
+                lego_set.pk = set_ids[lego_set.name]
+        _bulk_create_missing(LegoColor, COLOR_KEY_FIELDS, new_colors, 'ldraw_color_id')
+        _bulk_create_missing(LegoPiece, PIECE_KEY_FIELDS, new_pieces, 'ldraw_id')
+        LegoPieces.objects.bulk_create(set_pieces, batch_size=BATCH_SIZE)
+    catalog_updated.send(sender=LegoPieces, lego_sets=[lego_set.pk for lego_set in created_sets],
+                         lego_pieces=[piece.pk for piece in new_pieces.values()])
+
+    return created_sets
+
+
+def load_lego_sets_csv(csv_files: List[str], log: OutputWrapper = None) -> bool:
+    lego_sets = [(lego_set_name_from_csv(csv_file), read_lego_set_csv(csv_file)) for csv_file in csv_files]
+    populate_sets(lego_sets, log)
     return True
 
 
-def load_lego_colors_csv(csv_file: str, fetch_data: bool = False, log: OutputWrapper = None) -> bool:
+def load_lego_set_csv(csv_file: str, log: OutputWrapper = None) -> bool:
+    return load_lego_sets_csv([csv_file], log)
+
+
+def read_lego_colors_csv(csv_file: str, fetch_data: bool = False, log: OutputWrapper = None) -> pd.DataFrame:
 
     if csv_file is None:
         fetch_data = True
@@ -144,14 +366,103 @@ def load_lego_colors_csv(csv_file: str, fetch_data: bool = False, log: OutputWra
 
     # translate material to code
     df_colors['material'] = df_colors['material'].apply(lambda x: LegoColor.LegoColorCategory[x.upper()])
+    return df_colors
+
+
+def load_lego_colors_csv(csv_file: str, fetch_data: bool = False, upsert: bool = False,
+                         log: OutputWrapper = None) -> bool:
+    df_colors = read_lego_colors_csv(csv_file, fetch_data, log)
+    rows = df_colors.to_dict('records')
+
+    # upsert colors
+    if upsert:
+        counts = upsert_objects(LegoColor, rows, ['ldraw_color_id', 'bl_color_id'])
+        if log:
+            log.write('\n=============================================')
+            log.write(f'Upserted Lego Colors into database:')
+            log.write(f'Inserted lego Colors: {counts["inserted"]}')
+            log.write(f'Updated lego Colors: {counts["updated"]}')
+            log.write(f'Unchanged lego Colors: {counts["unchanged"]}')
+            log.write(f'Merged lego Colors: {counts["merged"]}')
+            log.write(f'Conflicting lego Colors: {counts["conflicts"]}')
+            log.write('=============================================')
+        return True
 
     # create colors
-    populate_colors = lambda row: LegoColor.objects.create(**row)
-    lego_colors = df_colors.apply(populate_colors, 1)
+    with transaction.atomic():
+        LegoColor.objects.bulk_create([LegoColor(**row) for row in rows], batch_size=BATCH_SIZE)
+    catalog_updated.send(sender=LegoColor, lego_sets=[], lego_pieces=[])
     if log:
         log.write('\n=============================================')
         log.write(f'Loaded Lego Colors into database:')
-        log.write(f'Loaded lego Colors: {lego_colors.shape[0]}')
+        log.write(f'Loaded lego Colors: {len(rows)}')
         log.write('=============================================')
 
     return True
+
+
+def _log_sync_counts(log: OutputWrapper, name: str, counts: Dict[str, int]) -> None:
+    if log:
+        message = f'Synced {name}: {counts["inserted"]} inserted, {counts["updated"]} updated, ' \
+                  f'{counts["deleted"]} deleted, {counts["unchanged"]} unchanged'
+        if counts['referenced']:
+            message += f', {counts["referenced"]} not deleted (still in part lists)'
+        log.write(message)
+
+
+def sync_lego_pieces_csv(csv_file: str, log: OutputWrapper = None) -> bool:
+    return sync_lego_pieces(read_lego_pieces_csv(csv_file), log)
+
+
+def sync_lego_pieces(df: pd.DataFrame, log: OutputWrapper = None) -> bool:
+    counts = sync_objects(LegoPiece, df, ['ldraw_id'], ['part_name', 'category', 'description'],
+                          delete_unhashed=False, referenced_by=[(LegoPieces, 'lego_piece')], batch_size=BATCH_SIZE)
+    _log_sync_counts(log, 'Lego Pieces', counts)
+    return True
+
+
+def sync_lego_colors_csv(csv_file: str, fetch_data: bool = False, log: OutputWrapper = None) -> bool:
+    df_colors = read_lego_colors_csv(csv_file, fetch_data, log)
+    key_fields = ['ldraw_color_id', 'bl_color_id']
+    fields = [field for field in df_colors.columns if field not in key_fields]
+    counts = sync_objects(LegoColor, df_colors, key_fields, fields, delete_unhashed=False,
+                          referenced_by=[(LegoPieces, 'lego_color')], batch_size=BATCH_SIZE)
+    _log_sync_counts(log, 'Lego Colors', counts)
+    return True
+
+
+def sync_lego_set_csv(csv_file: str, log: OutputWrapper = None) -> bool:
+    return sync_lego_set(lego_set_name_from_csv(csv_file), read_lego_set_csv(csv_file), log)
+
+
+def sync_lego_set(lego_set_name: str, df_set: pd.DataFrame, log: OutputWrapper = None) -> bool:
+    rows = df_set.to_dict('records')
+    colors, pieces = _fetch_catalog(rows)
+    new_colors = {}
+    new_pieces = {}
+    resolved = [_resolve_row(row, colors, pieces, new_colors, new_pieces, log) for row in rows]
+
+    with transaction.atomic():
+        lego_set, _ = LegoSet.objects.get_or_create(name=lego_set_name, defaults={'is_complete_set': True})
+        _bulk_create_missing(LegoColor, COLOR_KEY_FIELDS, new_colors, 'ldraw_color_id')
+        _bulk_create_missing(LegoPiece, PIECE_KEY_FIELDS, new_pieces, 'ldraw_id')
+
+        # one line per (piece, color), the set's part list is owned entirely by its csv
+        key_fields = ['lego_set_id', 'lego_piece_id', 'lego_color_id']
+        df_pieces = pd.DataFrame({
+            'lego_set_id': lego_set.pk,
+            'lego_piece_id': [piece.pk for _, piece in resolved],
+            'lego_color_id': pd.Series([color.pk if color else None for color, _ in resolved], dtype=object),
+            'element_id': [row['element_id'] for row in rows],
+            'quantity': [row['quantity'] for row in rows],
+        })
+        df_pieces = df_pieces.groupby(key_fields, dropna=False, as_index=False, sort=False).agg(
+            {'element_id': 'first', 'quantity': 'sum'})
+        counts = sync_objects(LegoPieces, df_pieces, key_fields, ['element_id', 'quantity'],
+                              queryset=LegoPieces.objects.filter(lego_set=lego_set), lego_sets=[lego_set.pk],
+                              batch_size=BATCH_SIZE)
+        if new_pieces:
+            catalog_updated.send(sender=LegoPiece, lego_sets=[], lego_pieces=[p.pk for p in new_pieces.values()])
+
+    _log_sync_counts(log, f'Lego Set {lego_set.name}', counts)
+    return True
@@ -0,0 +1,98 @@
+import argparse
+import os
+import django
+import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from django.core.management.base import OutputWrapper
+from django.db import connections, transaction
+
+# parsed rows committed per write transaction
+WRITE_BATCH_ROWS = 20000
+
+# files parsed ahead of the writer per worker, bounding the parsed rows held in memory
+PREFETCH_PER_WORKER = 4
+
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+
+def worker_count(value: str) -> int:
+    # argparse type of the --workers options, 0 for one worker per core
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = -1
+    if workers < 0:
+        raise argparse.ArgumentTypeError(f'expected 0 (one per core) or a positive number of workers, got {value!r}')
+    return workers
+
+
+def parse_files(read: Callable[[str], pd.DataFrame], csv_files: List[str],
+                workers: int) -> Iterator[Tuple[str, Optional[pd.DataFrame], Optional[Exception]]]:
+    """
+    Parses csv files with read in a pool of worker processes. Yields (file, parsed rows, None),
+    or (file, None, error) when read raised, in the order the files finish.
+    """
+    # forked workers must not inherit the open database connections, they never query
+    connections.close_all()
+    files = iter(csv_files)
+    with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+        pending = {}
+        while True:
+            for csv_file in files:
+                pending[executor.submit(read, csv_file)] = csv_file
+                if len(pending) >= workers * PREFETCH_PER_WORKER:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                csv_file = pending.pop(future)
+                try:
+                    yield csv_file, future.result(), None
+                except Exception as e:
+                    yield csv_file, None, e
+
+
+def ingest_files(read: Callable[[str], pd.DataFrame], write: Callable[[List[Tuple[str, pd.DataFrame]]], object],
+                 csv_files: List[str], workers: int = None, batch_rows: int = WRITE_BATCH_ROWS,
+                 log: OutputWrapper = None) -> Dict[str, Exception]:
+    """
+    Parses csv files in worker processes while this process, the only writer, commits them with
+    write in transactions of about batch_rows rows. A failed transaction is retried one file at
+    a time so errors are reported per file. Returns the error of every file that failed.
+    """
+    failures = {}
+    batch = []
+    rows = 0
+
+    def commit(files: List[Tuple[str, pd.DataFrame]]) -> None:
+        try:
+            with transaction.atomic():
+                write(files)
+        except Exception as e:
+            if len(files) == 1:
+                failures[files[0][0]] = e
+                return
+            for parsed in files:
+                commit([parsed])
+            return
+        if log:
+            for csv_file, _ in files:
+                log.write(f'Processed File: {csv_file}')
+
+    for csv_file, df, error in parse_files(read, csv_files, workers or default_workers()):
+        if error is not None:
+            failures[csv_file] = error
+            continue
+        batch.append((csv_file, df))
+        rows += len(df)
+        if rows >= batch_rows:
+            commit(batch)
+            batch, rows = [], 0
+    if batch:
+        commit(batch)
+    return failures
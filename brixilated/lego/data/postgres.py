@@ -0,0 +1,47 @@
+import io
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+import pandas as pd
+from django.db import connection
+
+
+def quoted_table(model) -> str:
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def quoted_column(model, field: str) -> str:
+    return connection.ops.quote_name(model._meta.get_field(field).column)
+
+
+@contextmanager
+def staging_table(cursor, name: str, columns: Dict[str, str]) -> Iterator[str]:
+    """
+    Temporary table of columns ({name: SQL type}) for the duration of the block. Temporary tables
+    are never WAL-logged and are private to the session, so concurrent imports cannot collide.
+    Must be used inside a transaction, a rollback drops the table with everything else.
+    """
+    table = connection.ops.quote_name(name)
+    definition = ', '.join(f'{connection.ops.quote_name(column)} {sql_type}' for column, sql_type in columns.items())
+    cursor.execute(f'CREATE TEMPORARY TABLE {table} ({definition})')
+    yield table
+    cursor.execute(f'DROP TABLE {table}')
+
+
+def copy_dataframe(cursor, table: str, df: pd.DataFrame) -> int:
+    # streams the rows of df into table with COPY FROM STDIN, missing values are NULL
+    if df.empty:
+        return 0
+    data = io.StringIO()
+    df.to_csv(data, header=False, index=False)
+    columns = ', '.join(connection.ops.quote_name(column) for column in df.columns)
+    sql = f'COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)'
+    if hasattr(cursor, 'copy_expert'):
+        # psycopg2
+        data.seek(0)
+        cursor.copy_expert(sql, data)
+    else:
+        # psycopg 3
+        with cursor.copy(sql) as copy:
+            copy.write(data.getvalue())
+    return len(df)
@@ -1,66 +1,147 @@
+import math
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import List
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 import requests
 import pandas as pd
 from tqdm import tqdm
 
 from django.core.management.base import OutputWrapper
 
+from lego.data.http_cache import HTTPCache, get_default_cache
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate: float, capacity: int = 1):
+        # rate in requests/sec, capacity is the allowed burst size
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class PagesNotFetched(requests.RequestException):
+
+    def __init__(self, message: str, urls: List[str]):
+        super().__init__(message)
+        # pages that still failed after every retry
+        self.urls = urls
+
 
 class RebrickableAPI(object):
 
-    def __init__(self, api_key: str, log: OutputWrapper = None):
+    def __init__(self, api_key: str, log: OutputWrapper = None, requests_per_second: float = 1.0, burst: int = 1,
+                 workers: int = 4, max_retries: int = 5, max_backoff: float = 30.0, cache: HTTPCache = None):
         self.API_KEY = api_key
         self.date_retrieved = datetime.now().strftime("%Y-%m-%d")
         self.log = log
+        self.limiter = TokenBucket(requests_per_second, burst)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': f'key {self.API_KEY}'})
+        self.cache = cache or get_default_cache()
+
+    def fetch_page(self, url: str, timeout: int = 10) -> dict:
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = self.cache.get(url, timeout=timeout, session=self.session,
+                                          before_request=self.limiter.acquire)
+                if response.ok:
+                    return response.json()
+            except FileNotFoundError:
+                # the cached entry was evicted by another thread after the lookup, the next attempt
+                # misses the cache and fetches the page again
+                continue
+            except (requests.RequestException, ValueError) as e:
+                if self.log:
+                    self.log.write(f'Got Exception {e} retrying...')
+            else:
+                # client errors other than rate limiting fail the same way on every attempt
+                if response.status_code < 500 and response.status_code != 429:
+                    response.raise_for_status()
+                if self.log:
+                    self.log.write(f'Error received: {response} retrying...')
+                retry_after = response.headers.get('Retry-After')
+
+            if attempt < self.max_retries:
+                backoff = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+                time.sleep(min(backoff, self.max_backoff))
+        raise requests.RequestException(f'Unable to fetch {url} after {self.max_retries + 1} attempts')
+
+    @staticmethod
+    def page_urls(url: str, num_entries: int, page_size: int) -> List[str]:
+        # every page after the first, derived from the total count
+        parts = urlparse(url)
+        query = parse_qs(parts.query)
+        query['page_size'] = [str(page_size)]
+        urls = []
+        for page in range(2, math.ceil(num_entries / page_size) + 1):
+            query['page'] = [str(page)]
+            urls.append(urlunparse(parts._replace(query=urlencode(query, doseq=True))))
+        return urls
 
     def fetch_data(self, url: str, timeout: int = 10) -> pd.DataFrame:
-        df = pd.DataFrame()
-        headers = {'Authorization': f'key {self.API_KEY}'}
-
-        # get metadata
-        try:
-            response = requests.get(url, headers=headers, timeout=timeout)
-            data = response.json()
-            num_entries = data['count']
-        except Exception as e:
-            if self.log:
-                self.log.write(f'Got Exception {e}')
-            return None
+        """
+        Fetches every page of a paginated endpoint into one DataFrame. Raises the error of the
+        first page, or PagesNotFetched listing the other pages that failed after every retry, so
+        a partial result is never returned.
+        """
+        # first page provides both the metadata and the first results
+        data = self.fetch_page(url, timeout)
+        num_entries = data['count']
 
-        # fetch data
-        with tqdm(total=num_entries) as pbar:
-            while True:
+        frames = [pd.json_normalize(data['results'])]
+        page_size = int(parse_qs(urlparse(url).query).get('page_size', [len(data['results']) or 1])[0])
+        urls = self.page_urls(url, num_entries, page_size) if data['next'] else []
+
+        # fetch remaining pages concurrently, the token bucket keeps the request rate
+        with tqdm(total=num_entries) as pbar, ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pbar.update(frames[0].shape[0])
+            futures = [pool.submit(self.fetch_page, page_url, timeout) for page_url in urls]
+            failed = []
+            for page_url, future in zip(urls, futures):
                 try:
-                    response = requests.get(url, headers=headers, timeout=timeout)
-                    if not response.ok:
-                        if self.log:
-                            self.log.write(f'Error received: {response} retrying...')
-                        time.sleep(2)
-                        continue
-
-                    data = response.json()
-                    df_response = pd.json_normalize(data['results'])
-                    df = df.append(df_response)
-
-                    pbar.update(df_response.shape[0])
-
-                    if data['next']:
-                        url = data['next']
-                    else:
-                        if data['count'] != df.shape[0] and self.log:
-                            self.log.write(f'Got {df.shape[0]} entries, expected {data["count"]} entries')
-                        break
-                    time.sleep(0.5) # rate limit to 1 request/sec
-                except TimeoutError:
+                    df_response = pd.json_normalize(future.result()['results'])
+                except Exception as e:
                     if self.log:
-                        self.log.write('Timed Out')
-        return df.reset_index(drop=True)
+                        self.log.write(f'Got Exception {e}')
+                    failed.append(page_url)
+                    continue
+                frames.append(df_response)
+                pbar.update(df_response.shape[0])
+
+        if failed:
+            raise PagesNotFetched(f'Unable to fetch {len(failed)} of {len(urls) + 1} pages of {url}', failed)
+
+        df = pd.concat(frames, ignore_index=True)
+        if num_entries != df.shape[0] and self.log:
+            self.log.write(f'Got {df.shape[0]} entries, expected {num_entries} entries')
+        return df
 
     def get_colors(self, write_csv: bool = True):
         url = f'https://rebrickable.com/api/v3/lego/colors/?page_size=500'
         df = self.fetch_data(url)
-        if df is not None and write_csv:
+        if write_csv:
             csv_path = f'colors_{self.date_retrieved}.csv'
             df.to_csv(csv_path, index=False)
             if self.log:
@@ -70,7 +151,7 @@ class RebrickableAPI(object):
     def get_parts(self, write_csv: bool = True):
         url = f'https://rebrickable.com/api/v3/lego/parts/?page_size=500'
         df = self.fetch_data(url)
-        if df is not None and write_csv:
+        if write_csv:
             csv_path = f'parts_{self.date_retrieved}.csv'
             df.to_csv(csv_path, index=False)
             if self.log:
@@ -80,7 +161,7 @@ class RebrickableAPI(object):
     def get_part_categories(self, write_csv: bool = True):
         url = f'https://rebrickable.com/api/v3/lego/part_categories/?page_size=500'
         df = self.fetch_data(url)
-        if df is not None and write_csv:
+        if write_csv:
             csv_path = f'part_categories_{self.date_retrieved}.csv'
             df.to_csv(csv_path, index=False)
             if self.log:
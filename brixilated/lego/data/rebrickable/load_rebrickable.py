@@ -1,28 +1,213 @@
-import requests
 import gzip
 import pandas as pd
-from io import StringIO
+from contextlib import contextmanager
+from typing import Dict, Iterator, TextIO
+
+from django.db import connection, transaction
+from django.core.management.base import OutputWrapper
+
+from lego.models import LegoPiece, LegoPieces, LegoSet, LegoColor
+from lego.data.load_data import BATCH_SIZE, upsert_objects
+from lego.data.http_cache import get_default_cache
+from lego.data.postgres import copy_dataframe, quoted_column, quoted_table, staging_table
+from lego.id_maps import ID_FIELDS, resolve_ids
+from lego.signals import catalog_updated
+
+REBRICKABLE_DOWNLOADS_URL = 'https://cdn.rebrickable.com/media/downloads'
+
+# rows parsed and written per step, bounds peak memory of an import
+CHUNK_SIZE = 50000
+
+
+@contextmanager
+def open_csv_gz(source: str, timeout: int = 60) -> Iterator[TextIO]:
+    # downloads are streamed into the http cache, then decompressed incrementally from disk
+    if source.startswith(('http://', 'https://')):
+        response = get_default_cache().get(source, timeout=timeout)
+        response.raise_for_status()
+        source = response.path
+
+    with gzip.open(source, 'rt', encoding='utf-8') as f:
+        yield f
+
+
+def iter_csv_chunks(source: str, chunksize: int = CHUNK_SIZE, **kwargs) -> Iterator[pd.DataFrame]:
+    with open_csv_gz(source) as f:
+        for chunk in pd.read_csv(f, chunksize=chunksize, **kwargs):
+            yield chunk
 
 
 def download_decompress_csv(url: str) -> pd.DataFrame:
-    r = requests.get(url)
-    bytes = gzip.decompress(r.content)
-    data = StringIO(str(bytes, 'utf-8'))
-    df = pd.read_csv(data)
-    return df
+    return pd.concat(iter_csv_chunks(url), ignore_index=True)
+
+
+def rebrickable_source(source: str, table: str) -> str:
+    return f'{source.rstrip("/")}/{table}.csv.gz'
+
+
+def _log_counts(log: OutputWrapper, name: str, counts: Dict[str, int]) -> None:
+    if log:
+        log.write(f'{name}: {counts["inserted"]} inserted, {counts["updated"]} updated, '
+                  f'{counts["unchanged"]} unchanged, {counts["merged"]} merged, {counts["conflicts"]} conflicts')
+
+
+def import_colors(source: str, chunksize: int = CHUNK_SIZE, log: OutputWrapper = None) -> Dict[str, int]:
+    totals = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'merged': 0, 'conflicts': 0}
+    for chunk in iter_csv_chunks(source, chunksize, dtype={'rgb': str}, keep_default_na=False):
+        # negative ids are placeholders such as [Unknown]
+        chunk = chunk[chunk['id'] >= 0]
+        is_trans = chunk['is_trans'].astype(str).str.lower().isin(['t', 'true'])
+        rows = pd.DataFrame({
+            'ldraw_color_id': chunk['id'],
+            'name': chunk['name'],
+            'hex_code': chunk['rgb'],
+            'material': is_trans.map({True: LegoColor.LegoColorCategory.TRANSPARENT,
+                                      False: LegoColor.LegoColorCategory.SOLID}),
+        }).to_dict('records')
+        counts = upsert_objects(LegoColor, rows, ['ldraw_color_id'])
+        totals = {key: totals[key] + counts[key] for key in totals}
+
+    _log_counts(log, 'Imported Rebrickable Colors', totals)
+    return totals
+
+
+def import_parts(source: str, chunksize: int = CHUNK_SIZE, log: OutputWrapper = None) -> Dict[str, int]:
+    name_length = LegoPiece._meta.get_field('part_name').max_length
+    totals = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'merged': 0, 'conflicts': 0}
+    for chunk in iter_csv_chunks(source, chunksize, dtype={'part_num': str}, keep_default_na=False):
+        rows = pd.DataFrame({
+            'ldraw_id': chunk['part_num'],
+            'part_name': chunk['name'].str.slice(0, name_length),
+        }).to_dict('records')
+        counts = upsert_objects(LegoPiece, rows, ['ldraw_id'])
+        totals = {key: totals[key] + counts[key] for key in totals}
+
+    _log_counts(log, 'Imported Rebrickable Parts', totals)
+    return totals
+
+
+def import_sets(sets_source: str, inventories_source: str, chunksize: int = CHUNK_SIZE,
+                log: OutputWrapper = None) -> Dict[int, int]:
+    description_length = LegoSet._meta.get_field('description').max_length
+    for chunk in iter_csv_chunks(sets_source, chunksize, dtype={'set_num': str}, keep_default_na=False):
+        rows = pd.DataFrame({
+            'name': chunk['set_num'],
+            'description': chunk['name'].str.slice(0, description_length),
+            'is_complete_set': True,
+        }).to_dict('records')
+        counts = upsert_objects(LegoSet, rows, ['name'])
+        _log_counts(log, 'Imported Rebrickable Sets', counts)
+
+    # only the latest inventory version of a set is imported, set_num -> (version, inventory id)
+    latest = {}
+    for chunk in iter_csv_chunks(inventories_source, chunksize, dtype={'set_num': str}):
+        for inventory_id, version, set_num in zip(chunk['id'].tolist(), chunk['version'].tolist(),
+                                                  chunk['set_num'].tolist()):
+            if set_num not in latest or version >= latest[set_num][0]:
+                latest[set_num] = (version, inventory_id)
+
+    # inventories may reference sets missing from sets.csv (e.g. minifigs)
+    set_nums = list(latest)
+    upsert_objects(LegoSet, [{'name': name, 'is_complete_set': True} for name in set_nums], ['name'])
+
+    set_ids = {}
+    for i in range(0, len(set_nums), BATCH_SIZE):
+        set_ids.update(LegoSet.objects.filter(name__in=set_nums[i:i + BATCH_SIZE]).values_list('name', 'pk'))
+    return {inventory_id: set_ids[set_num] for set_num, (_, inventory_id) in latest.items()}
+
+
+def _part_list_rows(chunk: pd.DataFrame, inventory_sets: Dict[int, int]) -> pd.DataFrame:
+    # inventory rows of the imported sets. Spare parts are extras packed with a set, not lines of
+    # its part list, and would duplicate the (set, piece, color) line of the same part.
+    is_spare = chunk['is_spare'].astype(str).str.lower().isin(['t', 'true'])
+    return chunk[chunk['inventory_id'].isin(list(inventory_sets)) & ~is_spare]
+
+
+def import_inventory_parts(source: str, inventory_sets: Dict[int, int], chunksize: int = CHUNK_SIZE,
+                           log: OutputWrapper = None) -> int:
+    if connection.vendor == 'postgresql':
+        return copy_inventory_parts(source, inventory_sets, chunksize, log)
+
+    inserted = 0
+    skipped = 0
+    with transaction.atomic():
+        # replace the part lists of every imported set
+        set_pks = list(set(inventory_sets.values()))
+        for i in range(0, len(set_pks), BATCH_SIZE):
+            LegoPieces.objects.filter(lego_set_id__in=set_pks[i:i + BATCH_SIZE]).delete()
+
+        for chunk in iter_csv_chunks(source, chunksize, dtype={'part_num': str}):
+            chunk = _part_list_rows(chunk, inventory_sets)
+            part_ids = resolve_ids('part', 'rebrickable', chunk['part_num'])
+            color_ids = resolve_ids('color', 'rebrickable', chunk['color_id'])
+
+            pieces = []
+            for inventory_id, part_num, color_id, quantity in zip(chunk['inventory_id'], chunk['part_num'],
+                                                                  chunk['color_id'], chunk['quantity']):
+                if part_num not in part_ids:
+                    skipped += 1
+                    continue
+                pieces.append(LegoPieces(lego_set_id=inventory_sets[inventory_id],
+                                         lego_piece_id=part_ids[part_num],
+                                         lego_color_id=color_ids.get(color_id),
+                                         quantity=quantity))
+            LegoPieces.objects.bulk_create(pieces, batch_size=BATCH_SIZE)
+            inserted += len(pieces)
+    catalog_updated.send(sender=LegoPieces, lego_sets=set_pks, lego_pieces=[])
 
+    if log:
+        log.write(f'Imported Rebrickable Inventory Parts: {inserted} inserted, {skipped} skipped (unknown part)')
+    return inserted
 
-def download_parts_db():
-    url = 'https://cdn.rebrickable.com/media/downloads/parts.csv.gz'
-    df = download_decompress_csv(url)
-    # print(gzip.decompress(r.content))
 
+def copy_inventory_parts(source: str, inventory_sets: Dict[int, int], chunksize: int = CHUNK_SIZE,
+                         log: OutputWrapper = None) -> int:
+    """
+    import_inventory_parts on PostgreSQL: the inventory rows are streamed with COPY into staging
+    tables, then the part lists are replaced with set-based SQL that resolves the pieces and colors
+    like the id maps do (by Rebrickable id, the lowest pk of duplicate ids), in one transaction.
+    """
+    part_lists = quoted_table(LegoPieces)
+    lego_set, lego_piece, lego_color, quantity = (quoted_column(LegoPieces, field) for field in
+                                                  ('lego_set', 'lego_piece', 'lego_color', 'quantity'))
+    piece_table, piece_pk = quoted_table(LegoPiece), quoted_column(LegoPiece, LegoPiece._meta.pk.name)
+    color_table, color_pk = quoted_table(LegoColor), quoted_column(LegoColor, LegoColor._meta.pk.name)
+    part_id = quoted_column(LegoPiece, ID_FIELDS['part']['rebrickable'])
+    color_id = quoted_column(LegoColor, ID_FIELDS['color']['rebrickable'])
+    set_pks = list(set(inventory_sets.values()))
 
-def download_colors_df() -> pd.DataFrame:
-    url = 'https://cdn.rebrickable.com/media/downloads/colors.csv.gz'
-    df = download_decompress_csv(url)
-    print(df)
+    with transaction.atomic(), connection.cursor() as cursor, \
+            staging_table(cursor, 'lego_staging_inventories', {'inventory_id': 'integer',
+                                                               'lego_set_id': 'integer'}) as inventories, \
+            staging_table(cursor, 'lego_staging_inventory_parts', {'inventory_id': 'integer', 'part_num': 'text',
+                                                                   'color_id': 'integer',
+                                                                   'quantity': 'integer'}) as parts:
+        copy_dataframe(cursor, inventories, pd.DataFrame({'inventory_id': list(inventory_sets),
+                                                          'lego_set_id': list(inventory_sets.values())}))
+        staged = 0
+        for chunk in iter_csv_chunks(source, chunksize, dtype={'part_num': str}):
+            chunk = _part_list_rows(chunk, inventory_sets)
+            staged += copy_dataframe(cursor, parts, chunk[['inventory_id', 'part_num', 'color_id', 'quantity']])
+        # planner statistics of the freshly loaded staging tables
+        cursor.execute(f'ANALYZE {inventories}')
+        cursor.execute(f'ANALYZE {parts}')
 
+        # replace the part lists of every imported set
+        cursor.execute(f'DELETE FROM {part_lists} WHERE {lego_set} IN (SELECT lego_set_id FROM {inventories})')
+        cursor.execute(f"""
+            INSERT INTO {part_lists} ({lego_set}, {lego_piece}, {lego_color}, {quantity})
+            SELECT i.lego_set_id, p.pk, c.pk, s.quantity
+            FROM {parts} s
+            JOIN {inventories} i ON i.inventory_id = s.inventory_id
+            JOIN (SELECT DISTINCT ON ({part_id}) {part_id} AS part_num, {piece_pk} AS pk FROM {piece_table}
+                  WHERE {part_id} IS NOT NULL ORDER BY {part_id}, {piece_pk}) p ON p.part_num = s.part_num
+            LEFT JOIN (SELECT DISTINCT ON ({color_id}) {color_id} AS color_id, {color_pk} AS pk FROM {color_table}
+                       WHERE {color_id} IS NOT NULL ORDER BY {color_id}, {color_pk}) c ON c.color_id = s.color_id
+        """)
+        inserted = cursor.rowcount
+    catalog_updated.send(sender=LegoPieces, lego_sets=set_pks, lego_pieces=[])
 
-download_parts_db()
-download_colors_df()
\ No newline at end of file
+    if log:
+        log.write(f'Imported Rebrickable Inventory Parts: {inserted} inserted, {staged - inserted} skipped '
+                  f'(unknown part)')
+    return inserted
@@ -0,0 +1,95 @@
+import pandas as pd
+from typing import Dict, Iterable, List, Tuple, Type
+
+from django.db import models, transaction
+from django.db.models import QuerySet
+
+from lego.models import LegoPiece
+from lego.signals import catalog_updated
+
+
+def _null(value) -> bool:
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def _normalize(model: Type[models.Model], df: pd.DataFrame, fields: List[str]) -> pd.DataFrame:
+    # convert values the way the ORM does, so csv and database values compare equal
+    normalized = pd.DataFrame(index=df.index)
+    for field in fields:
+        model_field = model._meta.get_field(field)
+        # object dtype keeps ints from being widened to float next to missing values
+        normalized[field] = pd.Series([None if _null(value) else model_field.get_prep_value(value)
+                                       for value in df[field]], index=df.index, dtype=object)
+    return normalized
+
+
+def _strings(df: pd.DataFrame) -> pd.DataFrame:
+    # str() of every value, missing ones included, per column as DataFrame.map needs pandas 2.1
+    return df.astype(object).apply(lambda column: column.map(str))
+
+
+def _key_strings(df: pd.DataFrame, key_fields: List[str]) -> pd.Series:
+    keys = _strings(df[key_fields])
+    return keys.agg('\x1f'.join, axis=1) if len(key_fields) > 1 else keys[key_fields[0]]
+
+
+def content_hashes(df: pd.DataFrame) -> pd.Series:
+    hashes = pd.util.hash_pandas_object(_strings(df), index=False)
+    return hashes.map('{:016x}'.format)
+
+
+def sync_objects(model: Type[models.Model], df: pd.DataFrame, key_fields: List[str], fields: List[str],
+                 queryset: QuerySet = None, delete_unhashed: bool = True, lego_sets: Iterable[int] = None,
+                 referenced_by: Iterable[Tuple[Type[models.Model], str]] = (),
+                 batch_size: int = 500) -> Dict[str, int]:
+    # apply only the inserts, updates and deletes between a snapshot and the rows in queryset,
+    # lego_sets are the sets whose part lists can change (see lego.signals.catalog_updated).
+    # Rows missing from the snapshot but still referenced through a (model, foreign key) of
+    # referenced_by are kept, deleting them would cascade, and counted as referenced.
+    queryset = model.objects.all() if queryset is None else queryset
+    snapshot = _normalize(model, df, key_fields + fields)
+    snapshot = snapshot[snapshot[key_fields].notna().any(axis=1)].drop_duplicates(key_fields, keep='last')
+    snapshot['content_hash'] = content_hashes(snapshot)
+    snapshot['_key'] = _key_strings(snapshot, key_fields)
+
+    existing = pd.DataFrame.from_records(list(queryset.values_list('pk', *key_fields, 'content_hash')),
+                                         columns=['pk', *key_fields, 'content_hash'])
+    existing['_key'] = _key_strings(_normalize(model, existing, key_fields), key_fields)
+
+    merged = snapshot.merge(existing[['_key', 'pk', 'content_hash']], on='_key', how='outer',
+                            suffixes=('', '_db'), indicator=True)
+    both = merged['_merge'] == 'both'
+    changed = both & (merged['content_hash'] != merged['content_hash_db'])
+    inserts = merged[merged['_merge'] == 'left_only']
+    updates = merged[changed]
+    deletes = merged[merged['_merge'] == 'right_only']
+    if not delete_unhashed:
+        # rows never written by a sync (e.g. created ad hoc by the set loader) are left alone
+        deletes = deletes[deletes['content_hash_db'].notna()]
+
+    def build(row: dict, **kwargs) -> models.Model:
+        # the outer merge turns missing values back into NaN
+        values = {f: None if _null(row[f]) else row[f] for f in key_fields + fields}
+        return model(content_hash=row['content_hash'], **values, **kwargs)
+
+    with transaction.atomic():
+        created = model.objects.bulk_create([build(row) for row in inserts.to_dict('records')], batch_size=batch_size)
+        model.objects.bulk_update([build(row, pk=int(row['pk'])) for row in updates.to_dict('records')],
+                                  key_fields + fields + ['content_hash'], batch_size=batch_size)
+        delete_pks = deletes['pk'].astype(int).tolist()
+        referenced = set()
+        for related_model, field in referenced_by:
+            for i in range(0, len(delete_pks), batch_size):
+                referenced.update(related_model.objects.filter(**{f'{field}__in': delete_pks[i:i + batch_size]})
+                                  .values_list(field, flat=True).distinct())
+        delete_pks = [pk for pk in delete_pks if pk not in referenced]
+        for i in range(0, len(delete_pks), batch_size):
+            model.objects.filter(pk__in=delete_pks[i:i + batch_size]).delete()
+    if len(inserts) or len(updates) or delete_pks:
+        # deleted pieces are reported by their post_delete signals, None when inserted pks are unknown
+        written = [] if model is not LegoPiece else None if any(obj.pk is None for obj in created) else \
+            [obj.pk for obj in created] + updates['pk'].astype(int).tolist()
+        catalog_updated.send(sender=model, lego_sets=lego_sets, lego_pieces=written)
+
+    return {'inserted': len(inserts), 'updated': len(updates), 'deleted': len(delete_pks),
+            'referenced': len(referenced), 'unchanged': int(both.sum()) - len(updates)}
@@ -0,0 +1,105 @@
+import os
+import csv
+import numpy as np
+from typing import Dict
+
+from lego.models import LegoColor, LegoPiece
+
+PART_TYPES = ['Brick', 'Plate', 'Tile', 'Slope', 'Wedge', 'Panel', 'Beam', 'Axle', 'Hinge', 'Bracket', 'Round Brick',
+              'Arch', 'Technic Brick', 'Window', 'Door']
+PART_MODIFIERS = ['', '', '', 'Modified', 'Inverted', 'Curved', 'with Studs on Side', 'with Clip', 'with Pin Hole']
+DIMENSIONS = ['1 x 1', '1 x 2', '1 x 3', '1 x 4', '1 x 6', '1 x 8', '2 x 2', '2 x 3', '2 x 4', '2 x 6', '2 x 8',
+              '4 x 4', '4 x 6', '6 x 6', '1 x 2 x 2/3', '1 x 1 x 3']
+
+# headers of the files read by read_lego_colors_csv and read_lego_set_csv
+COLOR_HEADER = ['Material', 'LEGO ID', 'LEGO Name (*=unconfirmed)', 'BL ID', 'BL Name', 'BO Name', 'LDraw ID',
+                'LDraw Name', 'Peeron Name', 'Other', 'Years Active Start', 'Years Active End', 'Notes', 'Hex',
+                'C', 'M', 'Y', 'K', 'Pantone']
+SET_HEADER = ['BLItemNo', 'ElementId', 'LdrawId', 'PartName', 'BLColorId', 'LDrawColorId', 'ColorName',
+              'ColorCategory', 'Qty', 'Weight']
+
+# materials of the generated colors, most are solid like the real palette
+MATERIALS = [LegoColor.LegoColorCategory.SOLID] * 6 + [LegoColor.LegoColorCategory.TRANSPARENT] * 2 + \
+            [LegoColor.LegoColorCategory.PEARL, LegoColor.LegoColorCategory.METALLIC]
+
+
+def _zipf_weights(n: int, exponent: float = 1.0) -> np.ndarray:
+    # a few pieces and colors are used everywhere, most of them rarely
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def generate_catalog(directory: str, pieces: int = 100000, colors: int = 200, sets: int = 20000,
+                     lines: int = 2000000, seed: int = 0) -> Dict[str, int]:
+    """
+    Writes a synthetic catalog in the formats of the bundled data: a colors csv, a headerless
+    pieces csv in default_lego_pieces/ and one part list csv per set in default_lego_sets/. Piece
+    and color popularity follows a Zipf distribution, every part list line has a unique element
+    id and (piece, color). The same arguments always generate the same catalog. Returns the
+    number of rows written.
+    """
+    rng = np.random.default_rng(seed)
+    pieces_dir = os.path.join(directory, 'default_lego_pieces')
+    sets_dir = os.path.join(directory, 'default_lego_sets')
+    os.makedirs(pieces_dir, exist_ok=True)
+    os.makedirs(sets_dir, exist_ok=True)
+
+    color_rows = []
+    for i in range(colors):
+        material = LegoColor.LegoColorCategory(MATERIALS[i % len(MATERIALS)])
+        name = f'Synthetic {material.label} {i}'
+        rgb = rng.integers(0, 256, 3)
+        color_rows.append([material.label, i, name, i, name, name, i, name, '', '', 1950 + i % 70, '', '',
+                           '{:02X}{:02X}{:02X}'.format(*rgb), '', '', '', '', ''])
+    with open(os.path.join(directory, 'lego_colors.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLOR_HEADER)
+        writer.writerows(color_rows)
+
+    categories = [category.value for category in LegoPiece.LegoPieceCategory]
+    names = []
+    weights = rng.integers(1, 200, pieces) / 100
+    with open(os.path.join(pieces_dir, 'synthetic_pieces.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        for i in range(pieces):
+            modifier = PART_MODIFIERS[i % len(PART_MODIFIERS)]
+            name = ' '.join(filter(None, [PART_TYPES[i % len(PART_TYPES)], modifier,
+                                          DIMENSIONS[(i // len(PART_TYPES)) % len(DIMENSIONS)]]))
+            names.append(name)
+            writer.writerow([str(i + 1), name, categories[i % len(categories)]])
+
+    sizes = np.maximum(rng.poisson(lines / max(sets, 1), sets), 1)
+    piece_ids = rng.choice(pieces, int(sizes.sum()), p=_zipf_weights(pieces, 0.9))
+    color_ids = rng.choice(colors, int(sizes.sum()), p=_zipf_weights(colors, 1.2))
+    quantities = rng.geometric(0.3, int(sizes.sum()))
+    element_id = 10000000
+    written = 0
+    start = 0
+    for i, size in enumerate(sizes.tolist()):
+        rows = []
+        seen = set()
+        total = 0
+        for piece, color, quantity in zip(piece_ids[start:start + size].tolist(),
+                                          color_ids[start:start + size].tolist(),
+                                          quantities[start:start + size].tolist()):
+            # like the BrickLink part lists, a set lists every (piece, color) once
+            if (piece, color) in seen:
+                continue
+            seen.add((piece, color))
+            material, name = color_rows[color][0], color_rows[color][4]
+            rows.append([piece + 1, element_id, piece + 1, names[piece], color, color, name, f'{material} Colors',
+                         quantity, weights[piece]])
+            element_id += 1
+            total += quantity
+        start += size
+        written += len(rows)
+        with open(os.path.join(sets_dir, f'SYN{i:05d}_Partlist.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(SET_HEADER)
+            writer.writerows(rows)
+            # the footer read_lego_set_csv skips
+            writer.writerow([''] * len(SET_HEADER))
+            writer.writerow(['Total qty', 'Total Weight'] + [''] * (len(SET_HEADER) - 2))
+            writer.writerow([total, 0] + [''] * (len(SET_HEADER) - 2))
+
+    return {'colors': colors, 'pieces': pieces, 'sets': sets, 'lines': written}
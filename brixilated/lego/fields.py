@@ -0,0 +1,115 @@
+import base64
+
+import graphene
+from graphene import relay
+from graphene_django.filter import DjangoFilterConnectionField
+from graphene_django.utils import maybe_queryset
+
+from lego.optimizer import optimize_for_info
+
+
+class OptimizedFilterConnectionField(DjangoFilterConnectionField):
+    """
+    Filter connection that joins/prefetches the relations selected below it and serves
+    reverse relations from the prefetch cache filled by its parent, avoiding N+1 queries.
+    """
+
+    @classmethod
+    def resolve_queryset(cls, connection, iterable, info, args, filtering_args, filterset_class):
+        queryset = maybe_queryset(iterable)
+        filtered = any(args.get(arg) is not None for arg in filtering_args)
+        if getattr(queryset, '_result_cache', None) is not None and not filtered:
+            return list(queryset)
+
+        queryset = super().resolve_queryset(connection, iterable, info, args, filtering_args, filterset_class)
+        return optimize_for_info(queryset, info)
+
+
+def keyset_cursor(pk: int) -> str:
+    return base64.b64encode(f'keyset:{pk}'.encode()).decode()
+
+
+def keyset_pk(cursor: str) -> int:
+    try:
+        prefix, pk = base64.b64decode(cursor.encode()).decode().split(':', 1)
+        assert prefix == 'keyset'
+        return int(pk)
+    except Exception:
+        raise ValueError(f'Invalid cursor: {cursor}')
+
+
+class CountableConnection(relay.Connection):
+    """
+    Connection exposing an optional totalCount, only counted when it is selected.
+    """
+
+    total_count = graphene.Int()
+
+    class Meta:
+        abstract = True
+
+    def resolve_total_count(self, info):
+        if getattr(self, 'length', None) is not None:
+            return self.length
+        return len(self.iterable) if isinstance(self.iterable, list) else self.iterable.count()
+
+
+class KeysetFilterConnectionField(OptimizedFilterConnectionField):
+    """
+    Filter connection paginated by primary key instead of OFFSET: cursors hold the last pk seen,
+    so every page is a single indexed range scan and no COUNT(*) is needed. An offset skips rows
+    after the `after` cursor; it is turned into the pk it skips to, so pages stay ordered by pk
+    and their cursors are keyset cursors too. Reverse relations served from the prefetch cache of
+    their parent are paged the same way in memory.
+    """
+
+    @classmethod
+    def resolve_connection(cls, connection, args, iterable, max_limit=None):
+        first = args.get('first')
+        last = args.get('last')
+        offset = args.get('offset')
+        after = keyset_pk(args['after']) if args.get('after') else None
+        before = keyset_pk(args['before']) if args.get('before') else None
+        if first is None and last is None:
+            first = max_limit
+
+        if isinstance(iterable, list):
+            # reverse relations served from a prefetch cache
+            rows = sorted((row for row in iterable if (after is None or row.pk > after) and
+                           (before is None or row.pk < before)), key=lambda row: row.pk)
+            if offset:
+                after = rows[offset - 1].pk if offset <= len(rows) else None
+                rows = rows[offset:]
+            page = rows[:first + 1] if first is not None else rows[max(len(rows) - last - 1, 0):][::-1]
+        else:
+            queryset = iterable
+            if after is not None:
+                queryset = queryset.filter(pk__gt=after)
+            if before is not None:
+                queryset = queryset.filter(pk__lt=before)
+            if offset:
+                skipped = list(queryset.order_by('pk').values_list('pk', flat=True)[offset - 1:offset])
+                after = skipped[0] if skipped else None
+                queryset = queryset.filter(pk__gt=after) if skipped else queryset.none()
+            if first is not None:
+                page = list(queryset.order_by('pk')[:first + 1])
+            else:
+                page = list(queryset.order_by('-pk')[:last + 1])
+
+        # one extra row tells whether another page exists in the direction of travel
+        size = first if first is not None else last
+        has_more = len(page) > size
+        page = page[:size]
+        if first is None:
+            page.reverse()
+
+        edges = [connection.Edge(node=node, cursor=keyset_cursor(node.pk)) for node in page]
+        page_info = relay.PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_previous_page=has_more if first is None else after is not None or bool(offset),
+            has_next_page=has_more if first is not None else before is not None,
+        )
+        resolved = connection(edges=edges, page_info=page_info)
+        resolved.iterable = iterable
+        return resolved
@@ -0,0 +1,166 @@
+import copy
+import threading
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple, Type
+
+from django.core.exceptions import ValidationError
+from django.db import models
+
+from lego.cache import get_catalog_changes, get_catalog_version
+from lego.models import LegoColor, LegoPiece
+
+# id columns of every scheme. Rebrickable ids are stored in the LDraw columns by the
+# Rebrickable importer, which shares them for almost every part and color.
+ID_FIELDS = {
+    'color': {'id': 'pk', 'lego': 'lego_id', 'bricklink': 'bl_color_id', 'ldraw': 'ldraw_color_id',
+              'rebrickable': 'ldraw_color_id'},
+    'part': {'id': 'pk', 'ldraw': 'ldraw_id', 'bricklink': 'bl_item_no', 'rebrickable': 'ldraw_id'},
+}
+
+ID_MODELS = {
+    'color': LegoColor,
+    'part': LegoPiece,
+}
+
+# values per IN (...) clause, kept below SQLite's variable limit
+BATCH_SIZE = 500
+
+
+def _id_fields(kind: str) -> List[str]:
+    return sorted({field for field in ID_FIELDS[kind].values() if field != 'pk'})
+
+
+class IdMap(object):
+    """
+    Bidirectional maps between the pks of one model and each of its id columns. Duplicate ids
+    resolve to the lowest pk. Instances are never modified once built, updates return a copy.
+    """
+
+    def __init__(self, model: Type[models.Model], fields: List[str], version: int = None):
+        self.model = model
+        self.fields = fields
+        self.version = version
+        self.forward = {field: {} for field in fields}     # field -> {id: pk}
+        self.reverse = {}                                   # pk -> (id of every field)
+
+    def normalize(self, field: str, value) -> Optional[Hashable]:
+        # ids as the database stores them ('4' and 4 are the same color id), None when invalid
+        if value is None or (isinstance(value, float) and value != value):
+            return None
+        if field == 'pk':
+            field = self.model._meta.pk.name
+        try:
+            return self.model._meta.get_field(field).to_python(value)
+        except (ValidationError, TypeError, ValueError):
+            return None
+
+    def updated(self, pks: Optional[Iterable[int]], version: int = None) -> 'IdMap':
+        """A copy with the ids of pks (every row when None) re-read from the database."""
+        index = copy.copy(self)
+        index.version = version
+        if pks is None:
+            index.forward = {field: {} for field in self.fields}
+            index.reverse = {}
+            batches = [self.model.objects.all()]
+        else:
+            pks = sorted(set(pks))
+            index.forward = {field: dict(ids) for field, ids in self.forward.items()}
+            index.reverse = dict(self.reverse)
+            for pk in pks:
+                for field, value in zip(self.fields, index.reverse.pop(pk, ())):
+                    if index.forward[field].get(value) == pk:
+                        del index.forward[field][value]
+            batches = [self.model.objects.filter(pk__in=pks[i:i + BATCH_SIZE]) for i in range(0, len(pks), BATCH_SIZE)]
+
+        for batch in batches:
+            for pk, *values in batch.order_by('pk').values_list('pk', *self.fields):
+                index.reverse[pk] = tuple(values)
+                for field, value in zip(self.fields, values):
+                    if value is not None and index.forward[field].get(value, pk) >= pk:
+                        index.forward[field][value] = pk
+        return index
+
+    def resolve(self, field: str, values: Iterable) -> Dict[Hashable, int]:
+        """
+        pks of the normalized ids found among values. Ids missing from the maps are looked up in
+        the database, so rows written by the current transaction (not yet in the maps) resolve.
+        """
+        ids = {value for value in (self.normalize(field, value) for value in values) if value is not None}
+        if field == 'pk':
+            found = {pk: pk for pk in ids if pk in self.reverse}
+        else:
+            forward = self.forward[field]
+            found = {value: forward[value] for value in ids if value in forward}
+
+        missing = sorted(ids - found.keys())
+        lookup = 'pk' if field == 'pk' else field
+        for i in range(0, len(missing), BATCH_SIZE):
+            rows = self.model.objects.filter(**{f'{lookup}__in': missing[i:i + BATCH_SIZE]}).order_by('-pk')
+            found.update(rows.values_list(lookup, 'pk'))
+        return found
+
+    def ids(self, pks: Iterable[int], field: str) -> Dict[int, Hashable]:
+        # the id in field of every pk, read from the database for pks missing from the maps
+        pks = set(pks)
+        if field == 'pk':
+            return {pk: pk for pk in pks}
+        position = self.fields.index(field)
+        found = {pk: self.reverse[pk][position] for pk in pks if pk in self.reverse}
+        missing = sorted(pks - found.keys())
+        for i in range(0, len(missing), BATCH_SIZE):
+            found.update(self.model.objects.filter(pk__in=missing[i:i + BATCH_SIZE]).values_list('pk', field))
+        return {pk: value for pk, value in found.items() if value is not None}
+
+
+class IdMaps(object):
+
+    def __init__(self, colors: IdMap, parts: IdMap, version: int = None):
+        self.colors = colors
+        self.parts = parts
+        self.version = version
+
+    def __getitem__(self, kind: str) -> IdMap:
+        return {'color': self.colors, 'part': self.parts}[kind]
+
+
+_id_maps = None
+_id_maps_lock = threading.Lock()
+
+
+def get_id_maps() -> IdMaps:
+    # colors are few and rebuilt on every catalog change, parts re-read only the written pieces when known
+    global _id_maps
+    version = get_catalog_version()
+    with _id_maps_lock:
+        maps = _id_maps
+        if maps is None or maps.version != version:
+            colors = IdMap(LegoColor, _id_fields('color')).updated(None, version)
+            changed = None if maps is None else get_catalog_changes(maps.version, version, 'lego_pieces')
+            parts = IdMap(LegoPiece, _id_fields('part')) if changed is None else maps.parts
+            maps = _id_maps = IdMaps(colors, parts.updated(changed, version), version)
+        return maps
+
+
+def resolve_ids(kind: str, scheme: str, values: Iterable) -> Dict[Hashable, int]:
+    """pks of the colors or parts (kind) of the ids in values of an id scheme (see ID_FIELDS)."""
+    return get_id_maps()[kind].resolve(ID_FIELDS[kind][scheme], values)
+
+
+def translate_ids(kind: str, values: List, source: str, target: str) -> Tuple[List[Optional[Hashable]], List]:
+    """
+    Translates ids of colors or parts (kind) between two schemes. Returns the target id of every
+    value (None when unresolved) and the values that did not resolve, in one pass over the maps.
+    """
+    id_map = get_id_maps()[kind]
+    source_field, target_field = ID_FIELDS[kind][source], ID_FIELDS[kind][target]
+    pks = id_map.resolve(source_field, values)
+    targets = id_map.ids(pks.values(), target_field)
+
+    translated = []
+    unresolved = []
+    for value in values:
+        pk = pks.get(id_map.normalize(source_field, value))
+        target_id = targets.get(pk) if pk is not None else None
+        translated.append(target_id)
+        if target_id is None:
+            unresolved.append(value)
+    return translated, unresolved
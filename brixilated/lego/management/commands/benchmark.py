@@ -0,0 +1,53 @@
+import json
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.test.runner import DiscoverRunner
+from lego.benchmark import compare, run_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Times the catalog loaders and representative GraphQL queries on a synthetic catalog, in a test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('catalog', help='Directory written by generate_catalog')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+        parser.add_argument('--threshold', type=float, default=10,
+                            help='Percent slowdown reported as a regression by --compare')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed requests per GraphQL query')
+        parser.add_argument('--sync_sample', type=int, default=100, help='Set part lists re-synced')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def report(self, section: str, results: dict) -> None:
+        self.stdout.write(f'\n{section}:')
+        for name, result in results.items():
+            timing = f'p50 {result["p50"] * 1000:.1f} ms, p99 {result["p99"] * 1000:.1f} ms' \
+                if result.get('calls', 1) > 1 else ''
+            self.stdout.write(f'  {name}: {result["wall_time"]:.3f} s, {result["queries"]} queries, '
+                              f'{result["peak_rss_mb"]} MB peak RSS' + (f', {timing}' if timing else ''))
+
+    def handle(self, *args, **options):
+        # the catalog is loaded into a throwaway test database, never into the configured one
+        setup_test_environment()
+        runner = DiscoverRunner(interactive=False, verbosity=0)
+        old_config = runner.setup_databases()
+        try:
+            results = run_benchmark(options['catalog'], options['repeat'], options['sync_sample'], options['seed'])
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+        self.report('Loaders', results['loaders'])
+        self.report('Queries', results['queries'])
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                changes = compare(json.load(f), results, options['threshold'])
+            self.stdout.write('\nChanges:')
+            for change in changes:
+                line = f'  {change["section"]}.{change["name"]} {change["metric"]}: {change["baseline"]:.4f} s -> ' \
+                       f'{change["current"]:.4f} s ({change["change"]:+.1f}%)'
+                self.stdout.write(self.style.ERROR(line) if change['regression'] else line)
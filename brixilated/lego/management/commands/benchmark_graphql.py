@@ -0,0 +1,77 @@
+import json
+import time
+import asyncio
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client, override_settings
+
+from lego.cache import LRUCache
+from lego.views import CachedGraphQLView
+
+DEFAULT_QUERY = '''{
+  legoSets(first: 20) { name LegoPieces(first: 20) { edges { node { quantity legoPiece { partName } } } } }
+  legoPiece(first: 50) { partName ldrawId }
+  legoColor(first: 50) { name hexCode }
+}'''
+
+
+class Command(BaseCommand):
+    help = 'Compares the WSGI (/lego/graphql) and ASGI (/lego/graphql/async) GraphQL views under concurrent clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--query', default=DEFAULT_QUERY)
+        parser.add_argument('--clients', type=int, default=16, help='Number of concurrent clients')
+        parser.add_argument('--requests', type=int, default=200, help='Requests sent per view')
+        parser.add_argument('--cache', action='store_true',
+                            help='Keep the response cache enabled (disabled by default so every request executes)')
+
+    def report(self, name: str, elapsed: float, latencies: List[float], clients: int) -> None:
+        latencies = sorted(latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        self.stdout.write(f'{name}: {len(latencies)} requests, {clients} clients, '
+                          f'{len(latencies) / elapsed:.1f} req/s, '
+                          f'p50 {statistics.median(latencies) * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms')
+
+    def run_wsgi(self, body: str, clients: int, requests: int) -> None:
+        def send(_) -> float:
+            start = time.perf_counter()
+            response = Client().post('/lego/graphql', body, content_type='application/json')
+            assert response.status_code == 200, response.content
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            latencies = list(executor.map(send, range(requests)))
+        self.report('WSGI /lego/graphql', time.perf_counter() - start, latencies, clients)
+
+    async def run_asgi(self, body: str, clients: int, requests: int) -> None:
+        latencies = []
+        remaining = iter(range(requests))
+
+        async def client() -> None:
+            async_client = AsyncClient()
+            for _ in remaining:
+                start = time.perf_counter()
+                response = await async_client.post('/lego/graphql/async', body, content_type='application/json')
+                assert response.status_code == 200, response.content
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(clients)))
+        self.report('ASGI /lego/graphql/async', time.perf_counter() - start, latencies, clients)
+
+    def handle(self, *args, **options):
+        body = json.dumps({'query': options['query']})
+        clients = options['clients']
+        requests = options['requests']
+
+        if not options['cache']:
+            CachedGraphQLView.response_cache = LRUCache(max_size=0)
+
+        # the test clients send requests as 'testserver'
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            self.run_wsgi(body, clients, requests)
+            asyncio.run(self.run_asgi(body, clients, requests))
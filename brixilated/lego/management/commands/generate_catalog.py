@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from lego.data.synthetic import generate_catalog
+
+
+class Command(BaseCommand):
+    help = 'Writes a synthetic catalog (colors, pieces and set part lists) in the formats of the bundled data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Directory to write the catalog to')
+        parser.add_argument('--pieces', type=int, default=100000, help='Number of Lego Pieces')
+        parser.add_argument('--colors', type=int, default=200, help='Number of Lego Colors')
+        parser.add_argument('--sets', type=int, default=20000, help='Number of Lego Sets')
+        parser.add_argument('--lines', type=int, default=2000000, help='Total part list lines across the sets')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        counts = generate_catalog(options['output'], options['pieces'], options['colors'], options['sets'],
+                                  options['lines'], options['seed'])
+        self.stdout.write(f'Generated {counts["colors"]} colors, {counts["pieces"]} pieces, {counts["sets"]} sets '
+                          f'and {counts["lines"]} part list lines in {options["output"]}')
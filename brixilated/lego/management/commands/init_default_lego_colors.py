@@ -2,7 +2,7 @@ import os
 import glob
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from lego.data.load_data import load_lego_colors_csv
+from lego.data.load_data import load_lego_colors_csv, sync_lego_colors_csv
 
 
 class Command(BaseCommand):
@@ -11,6 +11,10 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         default_path = glob.glob(os.path.join(settings.BASE_DIR, 'lego', 'data', '*.csv'))
         parser.add_argument('--lego_set_colors', nargs=1, default=default_path)
+        parser.add_argument('--upsert', action='store_true',
+                            help='Update existing entries in place instead of inserting duplicates')
+        parser.add_argument('--sync', action='store_true',
+                            help='Apply only the changes between the csv and the previous sync')
 
     def handle(self, *args, **options):
         file_path = None if len(options['lego_set_colors']) == 0 else options['lego_set_colors'][0]
@@ -20,7 +24,10 @@ class Command(BaseCommand):
             self.stdout.write(f"Processing File: {file_path}", ending='... ')
             if not file_path:
                 self.stdout.write()
-            load_lego_colors_csv(file_path, False, self.stdout)
+            if options['sync']:
+                sync_lego_colors_csv(file_path, False, self.stdout)
+            else:
+                load_lego_colors_csv(file_path, False, options['upsert'], self.stdout)
 
         except Exception as e:
             self.stdout.flush()
@@ -1,7 +1,10 @@
 import os
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from lego.data.load_data import load_lego_pieces_csv
+import pandas as pd
+from lego.data.load_data import (load_lego_pieces_csv, populate_pieces, read_lego_pieces_csv, sync_lego_pieces,
+                                 sync_lego_pieces_csv)
+from lego.data.parallel import ingest_files, worker_count
 
 
 class Command(BaseCommand):
@@ -9,11 +12,34 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         default_path = os.path.join(settings.BASE_DIR, 'lego', 'data', 'default_lego_pieces')
-        parser.add_argument('--lego_piece_dir', nargs=1, default=default_path)
+        parser.add_argument('--lego_piece_dir', default=default_path)
+        parser.add_argument('--upsert', action='store_true',
+                            help='Update existing entries in place instead of inserting duplicates')
+        parser.add_argument('--sync', action='store_true',
+                            help='Apply only the changes between the csv and the previous sync')
+        parser.add_argument('--workers', type=worker_count, default=1,
+                            help='Parse the csv files in this many processes (0 for one per core)')
+
+    def write_pieces(self, files, upsert, sync):
+        # parsed files, committed together by ingest_files
+        if sync:
+            for _, df in files:
+                sync_lego_pieces(df, self.stdout)
+        else:
+            populate_pieces(pd.concat([df for _, df in files], ignore_index=True), upsert, self.stdout)
 
     def handle(self, *args, **options):
         path = options['lego_piece_dir']
         files = os.listdir(path)
+        if options['workers'] != 1:
+            csv_files = [os.path.join(path, filename) for filename in sorted(files) if filename.endswith('.csv')]
+            failures = ingest_files(read_lego_pieces_csv,
+                                    lambda parsed: self.write_pieces(parsed, options['upsert'], options['sync']),
+                                    csv_files, options['workers'], log=self.stdout)
+            for file_path, e in failures.items():
+                self.stderr.write(f'Unable to process file {file_path}: {e}')
+            return
+
         for filename in files:
             try:
                 # only process csv files
@@ -25,7 +51,10 @@ class Command(BaseCommand):
 
                 # process file
                 self.stdout.write(f"Processing File: {file_path}", ending='... ')
-                load_lego_pieces_csv(file_path, self.stdout)
+                if options['sync']:
+                    sync_lego_pieces_csv(file_path, self.stdout)
+                else:
+                    load_lego_pieces_csv(file_path, options['upsert'], self.stdout)
             except Exception as e:
                 self.stdout.flush()
                 self.stderr.write(f'Unable to process file: {e}')
@@ -1,7 +1,9 @@
 import os
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from lego.data.load_data import load_lego_set_csv
+from lego.data.load_data import (lego_set_name_from_csv, load_lego_set_csv, populate_sets, read_lego_set_csv,
+                                 sync_lego_set, sync_lego_set_csv)
+from lego.data.parallel import ingest_files, worker_count
 
 
 class Command(BaseCommand):
@@ -9,11 +11,31 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         default_path = os.path.join(settings.BASE_DIR, 'lego', 'data', 'default_lego_sets')
-        parser.add_argument('--lego_set_dir', nargs=1, default=default_path)
+        parser.add_argument('--lego_set_dir', default=default_path)
+        parser.add_argument('--sync', action='store_true',
+                            help='Apply only the changes to existing sets instead of recreating them')
+        parser.add_argument('--workers', type=worker_count, default=1,
+                            help='Parse the csv files in this many processes (0 for one per core)')
+
+    def write_sets(self, files, sync):
+        # parsed files, committed together by ingest_files
+        if sync:
+            for file_path, df_set in files:
+                sync_lego_set(lego_set_name_from_csv(file_path), df_set, self.stdout)
+        else:
+            populate_sets([(lego_set_name_from_csv(file_path), df_set) for file_path, df_set in files], self.stdout)
 
     def handle(self, *args, **options):
         path = options['lego_set_dir']
         files = os.listdir(path)
+        if options['workers'] != 1:
+            csv_files = [os.path.join(path, filename) for filename in sorted(files) if filename.endswith('.csv')]
+            failures = ingest_files(read_lego_set_csv, lambda parsed: self.write_sets(parsed, options['sync']),
+                                    csv_files, options['workers'], log=self.stdout)
+            for file_path, e in failures.items():
+                self.stderr.write(f'Unable to process file {file_path}: {e}')
+            return
+
         for filename in files:
             try:
                 # only process csv files
@@ -25,7 +47,10 @@ class Command(BaseCommand):
 
                 # process file
                 self.stdout.write(f"Processing File: {file_path}", ending='... ')
-                load_lego_set_csv(file_path, self.stdout)
+                if options['sync']:
+                    sync_lego_set_csv(file_path, self.stdout)
+                else:
+                    load_lego_set_csv(file_path, self.stdout)
 
             except Exception as e:
                 self.stdout.flush()
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from lego.data.rebrickable.load_rebrickable import REBRICKABLE_DOWNLOADS_URL, CHUNK_SIZE, rebrickable_source, \
+    import_colors, import_parts, import_sets, import_inventory_parts
+
+
+class Command(BaseCommand):
+    help = 'Imports the Rebrickable catalog dumps (*.csv.gz) into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=REBRICKABLE_DOWNLOADS_URL,
+                            help='URL or local directory containing the Rebrickable *.csv.gz dumps')
+        parser.add_argument('--tables', nargs='+', default=['colors', 'parts', 'inventory_parts'],
+                            choices=['colors', 'parts', 'inventory_parts'])
+        parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        source = options['source']
+        chunk_size = options['chunk_size']
+        tables = options['tables']
+
+        try:
+            if 'colors' in tables:
+                self.stdout.write(f'Processing File: {rebrickable_source(source, "colors")}')
+                import_colors(rebrickable_source(source, 'colors'), chunk_size, self.stdout)
+
+            if 'parts' in tables:
+                self.stdout.write(f'Processing File: {rebrickable_source(source, "parts")}')
+                import_parts(rebrickable_source(source, 'parts'), chunk_size, self.stdout)
+
+            if 'inventory_parts' in tables:
+                self.stdout.write(f'Processing File: {rebrickable_source(source, "sets")}')
+                inventory_sets = import_sets(rebrickable_source(source, 'sets'),
+                                             rebrickable_source(source, 'inventories'), chunk_size, self.stdout)
+                self.stdout.write(f'Processing File: {rebrickable_source(source, "inventory_parts")}')
+                import_inventory_parts(rebrickable_source(source, 'inventory_parts'), inventory_sets, chunk_size,
+                                       self.stdout)
+        except Exception as e:
+            self.stdout.flush()
+            self.stderr.write(f'Unable to process file: {e}')
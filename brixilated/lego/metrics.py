@@ -0,0 +1,287 @@
+import re
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from inspect import isawaitable
+from ipaddress import ip_address, ip_network
+from typing import Iterable, List, Optional, Tuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from graphql import get_named_type, is_leaf_type
+
+logger = logging.getLogger(__name__)
+
+_settings = getattr(settings, 'LEGO_METRICS', {})
+
+# requests slower than this are logged with their slowest resolvers and most repeated SQL
+SLOW_REQUEST_SECONDS = _settings.get('SLOW_REQUEST_SECONDS', 1.0)
+# resolver paths and SQL patterns listed per slow request
+SLOW_REQUEST_REPORT_SIZE = _settings.get('SLOW_REQUEST_REPORT_SIZE', 5)
+# client networks allowed to read /metrics, whose slow request report holds raw SQL
+ALLOWED_NETWORKS = [ip_network(network) for network in _settings.get('ALLOWED_NETWORKS', ('127.0.0.0/8', '::1/128'))]
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# the IN lists and literals that differ between executions of the same statement
+_SQL_IN_LIST = re.compile(r'\((?:%s|NULL|\d+)(?:, (?:%s|NULL|\d+))*\)')
+_SQL_NUMBER = re.compile(r'\b\d+\b')
+
+
+class Histogram(object):
+    """
+    Prometheus histogram of one metric, by label values. Kept per server process like the
+    caches of lego.cache: every worker exposes its own series on /metrics.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets: Iterable[float] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> ([count per bucket, +Inf last], sum)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.series.get(label_values) or ([0] * (len(self.buckets) + 1), 0)
+            counts[index] += 1
+            self.series[label_values] = (counts, total + value)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self.series.items())
+        for label_values, counts, total in series:
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labels, label_values)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                bucket_labels = ','.join(labels + [f'le="{le}"'])
+                lines.append(f'{self.name}_bucket{{{bucket_labels}}} {cumulative}')
+            suffix = '{' + ','.join(labels) + '}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {total}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# requests answered from the response cache of lego.views.CachedGraphQLView run no resolvers and
+# little SQL, they are labeled cached="true" so they do not hide slow executions in the series
+REQUEST_SECONDS = Histogram('lego_request_duration_seconds', 'Duration of the HTTP requests', ['route', 'cached'],
+                            DURATION_BUCKETS)
+REQUEST_QUERIES = Histogram('lego_request_sql_queries', 'SQL statements executed per HTTP request',
+                            ['route', 'cached'], COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('lego_request_sql_duration_seconds', 'Time spent in SQL per HTTP request',
+                               ['route', 'cached'], DURATION_BUCKETS)
+# how often the most repeated statement of a request ran, N+1 queries show up in the top buckets
+REQUEST_REPEATED_QUERIES = Histogram('lego_request_sql_repeated_queries',
+                                     'Executions of the most repeated SQL statement per HTTP request',
+                                     ['route', 'cached'], COUNT_BUCKETS)
+SQL_SECONDS = Histogram('lego_sql_duration_seconds', 'Duration of the SQL statements', ['statement'],
+                        SQL_DURATION_BUCKETS)
+RESOLVER_SECONDS = Histogram('lego_graphql_resolver_duration_seconds',
+                             'Time spent in a GraphQL field resolver per request, children excluded', ['field'],
+                             DURATION_BUCKETS)
+RESOLVER_CALLS = Histogram('lego_graphql_resolver_calls', 'Calls of a GraphQL field resolver per request', ['field'],
+                           COUNT_BUCKETS)
+
+METRICS = [REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_DB_SECONDS, REQUEST_REPEATED_QUERIES, SQL_SECONDS,
+           RESOLVER_SECONDS, RESOLVER_CALLS]
+
+
+def render_metrics() -> str:
+    # Prometheus text exposition format 0.0.4
+    return '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+
+
+def sql_pattern(sql: str) -> str:
+    # statements differing only in parameters or IN list lengths share a pattern
+    return _SQL_NUMBER.sub('N', _SQL_IN_LIST.sub('(...)', sql))
+
+
+class RequestProfile(object):
+    # SQL and resolver timings of one request, shared by the threads resolving it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.db_seconds = 0.0
+        # pattern -> [executions, seconds]
+        self.sql = {}
+        # (parent type, field) -> [first resolver path, calls, seconds]
+        self.resolvers = {}
+        # answered from the response cache, see mark_cached
+        self.cached = False
+
+    def add_query(self, sql: str, seconds: float) -> None:
+        pattern = sql_pattern(sql)
+        with self.lock:
+            self.queries += 1
+            self.db_seconds += seconds
+            entry = self.sql.setdefault(pattern, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def add_resolver(self, info, seconds: float) -> None:
+        key = (info.parent_type.name, info.field_name)
+        with self.lock:
+            entry = self.resolvers.get(key)
+            if entry is None:
+                # the path of the first call stands for every path of the field, list indices dropped
+                path = '.'.join(str(name) for name in info.path.as_list() if not isinstance(name, int))
+                entry = self.resolvers[key] = [path, 0, 0.0]
+            entry[1] += 1
+            entry[2] += seconds
+
+    def repeated_queries(self) -> List[Tuple[str, int, float]]:
+        # (pattern, executions, seconds) of the statements run more than once, most executed first
+        return sorted(((pattern, count, seconds) for pattern, (count, seconds) in self.sql.items() if count > 1),
+                      key=lambda entry: (-entry[1], -entry[2]))
+
+    def slowest_resolvers(self) -> List[Tuple[str, str, int, float]]:
+        # (parent type.field, path, calls, seconds), slowest first
+        return sorted(((f'{parent}.{field}', path, calls, seconds)
+                       for (parent, field), (path, calls, seconds) in self.resolvers.items()),
+                      key=lambda entry: -entry[3])
+
+
+_profile: ContextVar[Optional[RequestProfile]] = ContextVar('lego_request_profile', default=None)
+
+
+def mark_cached() -> None:
+    # the current request was answered from a response cache, without running its resolvers
+    profile = _profile.get()
+    if profile is not None:
+        profile.cached = True
+
+
+def metrics_allowed(request) -> bool:
+    # the client address is that of the socket, a forwarded header could be set by anyone
+    try:
+        address = ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in network for network in ALLOWED_NETWORKS)
+
+
+def record_sql(execute, sql, params, many, context):
+    # execute wrapper of every database connection, see instrument_connection
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - start
+        SQL_SECONDS.observe(seconds, sql.lstrip().split(' ', 1)[0].upper() if sql else '')
+        profile = _profile.get()
+        if profile is not None:
+            profile.add_query(sql, seconds)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if record_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_sql)
+
+
+class ResolverTimingMiddleware(object):
+    """
+    Graphene middleware timing the object and list field resolvers of the requests profiled by
+    MetricsMiddleware. Scalar fields are read off their parent and left untimed, which keeps the
+    overhead and the number of series low. Querysets returned unevaluated are counted as SQL of
+    the request, not as resolver time. Responses served from the response cache run no resolvers,
+    so the resolver series only cover executed queries.
+    """
+
+    def resolve(self, next, root, info, **args):
+        profile = _profile.get()
+        if profile is None or is_leaf_type(get_named_type(info.return_type)):
+            return next(root, info, **args)
+
+        start = time.perf_counter()
+        result = next(root, info, **args)
+        if isawaitable(result):
+            return self.resolve_async(result, profile, info, start)
+        profile.add_resolver(info, time.perf_counter() - start)
+        return result
+
+    @staticmethod
+    async def resolve_async(result, profile: RequestProfile, info, start: float):
+        try:
+            return await result
+        finally:
+            profile.add_resolver(info, time.perf_counter() - start)
+
+
+class MetricsMiddleware(object):
+    """
+    Profiles the SQL (through record_sql) and GraphQL resolvers (through ResolverTimingMiddleware)
+    of every request into the histograms served on /metrics, and logs the slowest resolvers and
+    most repeated SQL of requests slower than LEGO_METRICS['SLOW_REQUEST_SECONDS'].
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        profile = RequestProfile()
+        token = _profile.set(profile)
+        start = time.perf_counter()
+        try:
+            return self.get_response(request)
+        finally:
+            _profile.reset(token)
+            self.record(request, profile, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        profile = RequestProfile()
+        token = _profile.set(profile)
+        start = time.perf_counter()
+        try:
+            return await self.get_response(request)
+        finally:
+            _profile.reset(token)
+            self.record(request, profile, time.perf_counter() - start)
+
+    @staticmethod
+    def record(request, profile: RequestProfile, seconds: float) -> None:
+        # unmatched urls share one series, so scanners cannot grow the label space
+        route = request.resolver_match.route if request.resolver_match else ''
+        cached = 'true' if profile.cached else 'false'
+        REQUEST_SECONDS.observe(seconds, route, cached)
+        REQUEST_QUERIES.observe(profile.queries, route, cached)
+        REQUEST_DB_SECONDS.observe(profile.db_seconds, route, cached)
+        REQUEST_REPEATED_QUERIES.observe(max((count for count, _ in profile.sql.values()), default=0), route,
+                                         cached)
+
+        resolvers = profile.slowest_resolvers()
+        for field, _, calls, resolver_seconds in resolvers:
+            RESOLVER_CALLS.observe(calls, field)
+            RESOLVER_SECONDS.observe(resolver_seconds, field)
+
+        if seconds >= SLOW_REQUEST_SECONDS:
+            lines = [f'Slow request {request.method} {request.path}: {seconds:.3f} s, {profile.queries} SQL '
+                     f'statements in {profile.db_seconds:.3f} s' + (', cached response' if profile.cached else '')]
+            lines += [f'  resolver {field} ({path}): {calls} calls, {resolver_seconds:.3f} s'
+                      for field, path, calls, resolver_seconds in resolvers[:SLOW_REQUEST_REPORT_SIZE]]
+            lines += [f'  repeated SQL x{count} ({sql_seconds:.3f} s): {pattern}'
+                      for pattern, count, sql_seconds in profile.repeated_queries()[:SLOW_REQUEST_REPORT_SIZE]]
+            logger.warning('\n'.join(lines))
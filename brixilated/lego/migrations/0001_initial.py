@@ -0,0 +1,92 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LegoColor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('material', models.CharField(choices=[('SO', 'Solid'), ('TR', 'Transparent'), ('PE', 'Pearl'), ('CH', 'Chrome'), ('ME', 'Metallic'), ('MI', 'Milky'), ('GL', 'Glitter'), ('SA', 'Satin'), ('SP', 'Speckle'), ('IN', 'Ink'), ('PR', 'Process'), ('MO', 'Modulex'), ('OT', 'Other')], default='OT', help_text='Lego color material', max_length=2)),
+                ('lego_id', models.PositiveSmallIntegerField(help_text='Lego color ID', null=True)),
+                ('name', models.CharField(blank=True, help_text='Lego color name', max_length=64, null=True)),
+                ('bl_color_id', models.PositiveSmallIntegerField(help_text='Lego color BL ID', null=True)),
+                ('bl_color_name', models.CharField(blank=True, help_text='Lego color BL name', max_length=64, null=True)),
+                ('bo_color_name', models.CharField(blank=True, help_text='Lego color BO name', max_length=64, null=True)),
+                ('ldraw_color_id', models.PositiveSmallIntegerField(help_text='Lego color LDraw ID', null=True)),
+                ('ldraw_color_name', models.CharField(blank=True, help_text='Lego color LDraw name', max_length=64, null=True)),
+                ('peeron_name', models.CharField(blank=True, help_text='Lego color Peeron name', max_length=64, null=True)),
+                ('other', models.TextField(blank=True, help_text='Lego color other', max_length=128, null=True)),
+                ('year_start', models.PositiveSmallIntegerField(blank=True, help_text='Lego color Year Start', null=True)),
+                ('year_end', models.PositiveSmallIntegerField(blank=True, help_text='Lego color Year End', null=True)),
+                ('notes', models.TextField(blank=True, help_text='Lego color notes', max_length=128, null=True)),
+                ('hex_code', models.CharField(blank=True, help_text='Lego color hex code', max_length=6, null=True)),
+                ('cyan', models.PositiveSmallIntegerField(help_text='Lego color cyan', null=True)),
+                ('magenta', models.PositiveSmallIntegerField(help_text='Lego color magenta', null=True)),
+                ('yellow', models.PositiveSmallIntegerField(help_text='Lego color yellow', null=True)),
+                ('black', models.PositiveSmallIntegerField(help_text='Lego color black', null=True)),
+                ('pantone', models.CharField(blank=True, help_text='Lego color pantone', max_length=64, null=True)),
+                ('content_hash', models.CharField(blank=True, editable=False, help_text='Content hash of the row from the last catalog sync', max_length=16, null=True)),
+            ],
+            options={
+                'verbose_name': 'Color',
+                'verbose_name_plural': 'Colors',
+            },
+        ),
+        migrations.CreateModel(
+            name='LegoPiece',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ldraw_id', models.CharField(help_text='Lego piece LDraw ID', max_length=64, null=True, unique=True)),
+                ('bl_item_no', models.CharField(help_text='Lego piece BL Item Number', max_length=64, null=True, unique=True)),
+                ('part_name', models.CharField(blank=True, help_text='Lego piece name', max_length=64)),
+                ('category', models.CharField(choices=[('BA', 'Basic'), ('WA', 'Wall'), ('SN', 'Snot'), ('CL', 'Clip'), ('HI', 'Hinge'), ('SO', 'Socket'), ('AN', 'Angle'), ('CU', 'Curved'), ('VE', 'Vehicle'), ('MI', 'Minifig'), ('NA', 'Nature'), ('TE', 'Technic'), ('EL', 'Electronics'), ('OT', 'Other'), ('RE', 'Retired')], default='OT', help_text='Lego piece category', max_length=2)),
+                ('description', models.TextField(blank=True, help_text='Lego piece Description', max_length=256)),
+                ('weight', models.PositiveSmallIntegerField(help_text='Lego piece weight', null=True)),
+                ('custom_piece', models.BooleanField(default=False, help_text='Lego piece is a custom piece')),
+                ('content_hash', models.CharField(blank=True, editable=False, help_text='Content hash of the row from the last catalog sync', max_length=16, null=True)),
+            ],
+            options={
+                'verbose_name': 'Piece',
+                'verbose_name_plural': 'Pieces',
+            },
+        ),
+        migrations.CreateModel(
+            name='LegoSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Name of Lego Set', max_length=32, unique=True)),
+                ('description', models.TextField(blank=True, help_text='Lego Set description', max_length=256)),
+                ('is_complete_set', models.BooleanField(default=False, help_text='Data-structure is a Complete Lego Set')),
+            ],
+            options={
+                'verbose_name': 'Lego Set',
+                'verbose_name_plural': 'Lego Sets',
+            },
+        ),
+        migrations.CreateModel(
+            name='LegoPieces',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('element_id', models.PositiveIntegerField(help_text='Lego Piece Element ID', null=True, unique=True)),
+                ('quantity', models.PositiveSmallIntegerField(help_text='Number of Lego pieces')),
+                ('content_hash', models.CharField(blank=True, editable=False, help_text='Content hash of the row from the last catalog sync', max_length=16, null=True)),
+                ('lego_color', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='LegoColor', to='lego.legocolor')),
+                ('lego_piece', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='LegoPiece', to='lego.legopiece')),
+                ('lego_set', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='LegoPieces', to='lego.legoset')),
+            ],
+            options={
+                'verbose_name': 'Set Piece',
+                'verbose_name_plural': 'Set Pieces',
+            },
+        ),
+    ]
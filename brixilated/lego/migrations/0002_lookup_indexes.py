@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_part_name_trigram_index(apps, schema_editor):
+    # substring/similarity searches on part names, only supported by PostgreSQL (pg_trgm)
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE INDEX IF NOT EXISTS lego_piece_part_name_trgm '
+                          'ON lego_legopiece USING gin (part_name gin_trgm_ops)')
+
+
+def drop_part_name_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS lego_piece_part_name_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lego', '0001_initial'),
+    ]
+
+    operations = [
+        # the composite index is built before the single column lego_set index it replaces is dropped
+        migrations.AddIndex(
+            model_name='legopieces',
+            index=models.Index(fields=['lego_set', 'lego_piece', 'lego_color'], name='lego_pieces_set_piece_color'),
+        ),
+        migrations.AlterField(
+            model_name='legopieces',
+            name='lego_set',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='LegoPieces', to='lego.legoset'),
+        ),
+        migrations.AddIndex(
+            model_name='legocolor',
+            index=models.Index(fields=['ldraw_color_id'], name='lego_color_ldraw_color_id'),
+        ),
+        migrations.AddIndex(
+            model_name='legocolor',
+            index=models.Index(fields=['bl_color_id'], name='lego_color_bl_color_id'),
+        ),
+        migrations.AddIndex(
+            model_name='legocolor',
+            index=models.Index(fields=['lego_id'], name='lego_color_lego_id'),
+        ),
+        migrations.AddIndex(
+            model_name='legopiece',
+            index=models.Index(fields=['part_name'], name='lego_piece_part_name'),
+        ),
+        migrations.RunPython(create_part_name_trigram_index, drop_part_name_trigram_index),
+    ]
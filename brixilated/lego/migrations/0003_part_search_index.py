@@ -0,0 +1,39 @@
+from django.db import migrations
+
+# the name and SQL of the GIN index of lego.search.search_vector() as of this migration, kept
+# here so later changes to lego.search cannot change what this migration does
+SEARCH_INDEX_NAME = 'lego_piece_search'
+
+_NORMALIZED = r"""COALESCE(regexp_replace(lower(coalesce("{}", '')), '(\d)\s*x\s*(?=\d)', '\1x', 'g'), '')"""
+
+CREATE_SEARCH_INDEX = (
+    f'CREATE INDEX "{SEARCH_INDEX_NAME}" ON "lego_legopiece" USING gin ('
+    f"""((setweight(to_tsvector('simple'::regconfig, """
+    f"""{_NORMALIZED.format('ldraw_id')} || ' ' || {_NORMALIZED.format('bl_item_no')} || ' ' || """
+    f"""{_NORMALIZED.format('part_name')}), 'A') || """
+    f"""setweight(to_tsvector('simple'::regconfig, {_NORMALIZED.format('description')}), 'C'))));"""
+)
+
+
+def create_part_search_index(apps, schema_editor):
+    # full text search over the part fields (see lego.search), only supported by PostgreSQL
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(CREATE_SEARCH_INDEX)
+
+
+def drop_part_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX IF EXISTS {SEARCH_INDEX_NAME}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lego', '0002_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_part_search_index, drop_part_search_index),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from lego.aggregates import update_set_aggregates
+
+
+def compute_set_aggregates(apps, schema_editor):
+    update_set_aggregates(None, apps.get_model('lego', 'LegoSet'), apps.get_model('lego', 'LegoPieces'),
+                          apps.get_model('lego', 'LegoSetColor'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lego', '0003_part_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LegoSetColor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(help_text='Number of Lego pieces of the color')),
+            ],
+            options={
+                'verbose_name': 'Set Color',
+                'verbose_name_plural': 'Set Colors',
+            },
+        ),
+        migrations.AddField(
+            model_name='legoset',
+            name='total_pieces',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of Lego pieces'),
+        ),
+        migrations.AddField(
+            model_name='legoset',
+            name='total_weight',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Weight of the pieces of known weight'),
+        ),
+        migrations.AddField(
+            model_name='legoset',
+            name='unique_parts',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of distinct pieces'),
+        ),
+        migrations.AddField(
+            model_name='legoset',
+            name='unique_pieces',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of part list lines'),
+        ),
+        migrations.AddIndex(
+            model_name='legoset',
+            index=models.Index(fields=['total_pieces'], name='lego_set_total_pieces'),
+        ),
+        migrations.AddField(
+            model_name='legosetcolor',
+            name='lego_color',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='LegoSetColors', to='lego.legocolor'),
+        ),
+        migrations.AddField(
+            model_name='legosetcolor',
+            name='lego_set',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='LegoSetColors', to='lego.legoset'),
+        ),
+        migrations.RunPython(compute_set_aggregates, migrations.RunPython.noop),
+    ]
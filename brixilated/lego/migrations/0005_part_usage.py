@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from lego.aggregates import update_part_usage
+
+
+def compute_part_usage(apps, schema_editor):
+    update_part_usage(None, apps.get_model('lego', 'LegoPieces'), apps.get_model('lego', 'LegoPartUsage'),
+                      apps.get_model('lego', 'LegoPartUsageSet'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lego', '0004_set_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LegoPartUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('set_count', models.PositiveIntegerField(help_text='Number of Lego sets using the piece in the color')),
+                ('total_quantity', models.PositiveIntegerField(help_text='Number of Lego pieces across those sets')),
+                ('lego_color', models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='lego.legocolor')),
+                ('lego_piece', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='lego.legopiece')),
+            ],
+            options={
+                'verbose_name': 'Part Usage',
+                'verbose_name_plural': 'Part Usage',
+                'indexes': [models.Index(fields=['lego_piece', 'lego_color'], name='lego_part_usage_piece_color'), models.Index(fields=['lego_color', '-set_count'], name='lego_part_usage_color_sets'), models.Index(fields=['-set_count'], name='lego_part_usage_sets'), models.Index(fields=['-total_quantity'], name='lego_part_usage_quantity')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LegoPartUsageSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(help_text='Number of Lego pieces in the set')),
+                ('lego_color', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='lego.legocolor')),
+                ('lego_piece', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='lego.legopiece')),
+                ('lego_set', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='lego.legoset')),
+            ],
+            options={
+                'verbose_name': 'Part Usage Set',
+                'verbose_name_plural': 'Part Usage Sets',
+                'indexes': [models.Index(fields=['lego_piece', 'lego_color', '-quantity'], name='lego_part_usage_set_top')],
+            },
+        ),
+        migrations.RunPython(compute_part_usage, migrations.RunPython.noop),
+    ]
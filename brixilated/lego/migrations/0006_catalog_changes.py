@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lego', '0005_part_usage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lego_sets', models.JSONField(help_text='Sets whose part lists changed, null when unknown', null=True)),
+                ('lego_pieces', models.JSONField(help_text='Pieces inserted or updated, null when unknown', null=True)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Catalog Change',
+                'verbose_name_plural': 'Catalog Changes',
+            },
+        ),
+    ]
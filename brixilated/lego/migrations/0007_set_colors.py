@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lego', '0006_catalog_changes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='legoset',
+            name='total_weight',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Weight of the pieces of known weight, in the whole units of the piece weights'),
+        ),
+        migrations.AlterField(
+            model_name='legosetcolor',
+            name='lego_color',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='lego.legocolor'),
+        ),
+        migrations.AlterField(
+            model_name='legosetcolor',
+            name='lego_set',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='colors', to='lego.legoset'),
+        ),
+    ]
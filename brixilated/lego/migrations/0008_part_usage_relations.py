@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lego', '0007_set_colors'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='legopartusage',
+            name='lego_color',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='usage', to='lego.legocolor'),
+        ),
+        migrations.AlterField(
+            model_name='legopartusage',
+            name='lego_piece',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='usage', to='lego.legopiece'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import RowNumber
 from django.utils.translation import gettext_lazy as _
 
 
@@ -6,6 +7,14 @@ class LegoSet(models.Model):
     name = models.CharField(unique=True, max_length=32, help_text='Name of Lego Set')
     description = models.TextField(max_length=256, blank=True, help_text='Lego Set description')
     is_complete_set = models.BooleanField(default=False, help_text='Data-structure is a Complete Lego Set')
+    # aggregates of the part list, kept current by lego.aggregates
+    total_pieces = models.PositiveIntegerField(default=0, editable=False, help_text='Number of Lego pieces')
+    unique_pieces = models.PositiveIntegerField(default=0, editable=False, help_text='Number of part list lines')
+    unique_parts = models.PositiveIntegerField(default=0, editable=False, help_text='Number of distinct pieces')
+    # sum of quantity x LegoPiece.weight, piece weights are whole numbers so integers hold it exactly
+    total_weight = models.PositiveIntegerField(default=0, editable=False,
+                                               help_text='Weight of the pieces of known weight, in the whole units '
+                                                         'of the piece weights')
 
     def __str__(self) -> str:
         return f'Name: {self.name}, Completed Set: {self.is_complete_set}, Description: {self.description}'
@@ -13,15 +22,166 @@ class LegoSet(models.Model):
     class Meta:
         verbose_name = 'Lego Set'
         verbose_name_plural = 'Lego Sets'
+        indexes = [
+            models.Index(fields=['total_pieces'], name='lego_set_total_pieces'),
+        ]
+
+
+class LegoSetColor(models.Model):
+    # color breakdown of a set's part list, kept current by lego.aggregates
+    lego_set = models.ForeignKey('LegoSet', on_delete=models.CASCADE, related_name='colors')
+    # null for the custom pieces of the set
+    lego_color = models.ForeignKey('LegoColor', null=True, on_delete=models.CASCADE, related_name='+')
+    quantity = models.PositiveIntegerField(help_text='Number of Lego pieces of the color')
+
+    def __str__(self) -> str:
+        return f'Lego Set: {self.lego_set.name}, Color: {self.lego_color}, Quantity: {self.quantity}'
+
+    class Meta:
+        verbose_name = 'Set Color'
+        verbose_name_plural = 'Set Colors'
+
+
+class CatalogChange(models.Model):
+    # one row per catalog write, its pk is the catalog version shared by every process (see lego.cache)
+    lego_sets = models.JSONField(null=True, help_text='Sets whose part lists changed, null when unknown')
+    lego_pieces = models.JSONField(null=True, help_text='Pieces inserted or updated, null when unknown')
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self) -> str:
+        return f'Catalog Version: {self.pk}, Created: {self.created}'
+
+    class Meta:
+        verbose_name = 'Catalog Change'
+        verbose_name_plural = 'Catalog Changes'
+
+
+class LegoPartUsageQuerySet(models.QuerySet):
+    """
+    Usage rows that load the top sets of every row they fetch in one query (LegoPartUsageSet
+    has no relation to prefetch through), e.g. for every piece of a page at once when they are
+    the queryset of a prefetch.
+    """
+
+    # pieces of the fetched rows per top sets query, kept below SQLite's variable limit
+    BATCH_SIZE = 500
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._top_sets = []     # (LegoPartUsageSet queryset, sets per row, attribute of the rows)
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._top_sets = list(self._top_sets)
+        return clone
+
+    def with_top_sets(self, queryset: models.QuerySet, first: int, to_attr: str) -> 'LegoPartUsageQuerySet':
+        """Sets every fetched row's to_attr to the first rows of queryset of its (piece, color), most pieces first."""
+        clone = self._chain()
+        clone._top_sets.append((queryset, first, to_attr))
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super()._fetch_all()
+        if fetched or not self._top_sets or self._iterable_class is not models.query.ModelIterable:
+            return
+        pairs = {(row.lego_piece_id, row.lego_color_id) for row in self._result_cache}
+        pieces = sorted({piece for piece, _ in pairs})
+        # every color of the rows, the sets of pairs no row has are dropped
+        colors = {color for _, color in pairs}
+        in_colors = models.Q(lego_color__in=colors - {None})
+        if None in colors:
+            in_colors |= models.Q(lego_color__isnull=True)
+        rank = models.Window(RowNumber(), partition_by=[models.F('lego_piece'), models.F('lego_color')],
+                             order_by=[models.F('quantity').desc(), models.F('pk').asc()])
+
+        for queryset, first, to_attr in self._top_sets:
+            top_sets = {pair: [] for pair in pairs}
+            for i in range(0, len(pieces), self.BATCH_SIZE):
+                rows = queryset.filter(in_colors, lego_piece__in=pieces[i:i + self.BATCH_SIZE]) \
+                    .annotate(rank=rank).filter(rank__lte=first).order_by('rank')
+                for row in rows:
+                    pair_sets = top_sets.get((row.lego_piece_id, row.lego_color_id))
+                    if pair_sets is not None:
+                        pair_sets.append(row)
+            for row in self._result_cache:
+                setattr(row, to_attr, top_sets[(row.lego_piece_id, row.lego_color_id)])
+
+
+class LegoPartUsage(models.Model):
+    # where a piece is used in a color, kept current by lego.aggregates
+    # indexed as the leading column of lego_part_usage_piece_color
+    lego_piece = models.ForeignKey('LegoPiece', on_delete=models.CASCADE, related_name='usage', db_index=False)
+    # null for custom pieces, indexed as the leading column of lego_part_usage_color_sets
+    lego_color = models.ForeignKey('LegoColor', null=True, on_delete=models.CASCADE, related_name='usage',
+                                   db_index=False)
+    set_count = models.PositiveIntegerField(help_text='Number of Lego sets using the piece in the color')
+    total_quantity = models.PositiveIntegerField(help_text='Number of Lego pieces across those sets')
+
+    objects = LegoPartUsageQuerySet.as_manager()
+
+    def __str__(self) -> str:
+        return f'Lego Piece: {self.lego_piece_id}, Color: {self.lego_color_id}, Sets: {self.set_count}, ' \
+               f'Quantity: {self.total_quantity}'
+
+    class Meta:
+        verbose_name = 'Part Usage'
+        verbose_name_plural = 'Part Usage'
+        indexes = [
+            models.Index(fields=['lego_piece', 'lego_color'], name='lego_part_usage_piece_color'),
+            models.Index(fields=['lego_color', '-set_count'], name='lego_part_usage_color_sets'),
+            models.Index(fields=['-set_count'], name='lego_part_usage_sets'),
+            models.Index(fields=['-total_quantity'], name='lego_part_usage_quantity'),
+        ]
+
+
+class LegoPartUsageSet(models.Model):
+    # the sets behind LegoPartUsage, one row per (set, piece, color) of the part lists. Rows of
+    # deleted sets are kept (no constraint, no cascade) until lego.aggregates refreshes their usage.
+    lego_set = models.ForeignKey('LegoSet', on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    # indexed as the leading column of lego_part_usage_set_top
+    lego_piece = models.ForeignKey('LegoPiece', on_delete=models.CASCADE, related_name='+', db_index=False)
+    lego_color = models.ForeignKey('LegoColor', null=True, on_delete=models.CASCADE, related_name='+')
+    quantity = models.PositiveIntegerField(help_text='Number of Lego pieces in the set')
+
+    def __str__(self) -> str:
+        return f'Lego Set: {self.lego_set_id}, Lego Piece: {self.lego_piece_id}, Color: {self.lego_color_id}, ' \
+               f'Quantity: {self.quantity}'
+
+    class Meta:
+        verbose_name = 'Part Usage Set'
+        verbose_name_plural = 'Part Usage Sets'
+        indexes = [
+            models.Index(fields=['lego_piece', 'lego_color', '-quantity'], name='lego_part_usage_set_top'),
+        ]
 
 
 class LegoPieces(models.Model):
-    lego_set = models.ForeignKey('LegoSet', on_delete=models.CASCADE, related_name='LegoPieces')
+    # indexed as the leading column of lego_pieces_set_piece_color
+    lego_set = models.ForeignKey('LegoSet', on_delete=models.CASCADE, related_name='LegoPieces', db_index=False)
     lego_piece = models.ForeignKey('LegoPiece', on_delete=models.CASCADE, related_name='LegoPiece')
     # nullable from custom pieces
     lego_color = models.ForeignKey('LegoColor', null=True, on_delete=models.CASCADE, related_name='LegoColor')
     element_id = models.PositiveIntegerField(null=True, unique=True, help_text='Lego Piece Element ID')
     quantity = models.PositiveSmallIntegerField(help_text='Number of Lego pieces')
+    content_hash = models.CharField(max_length=16, null=True, blank=True, editable=False,
+                                    help_text='Content hash of the row from the last catalog sync')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # the set of the line as loaded, a save moving it to another set refreshes both (see lego.signals)
+        instance.loaded_lego_set_id = instance.__dict__.get('lego_set_id')
+        return instance
+
+    def delete(self, *args, **kwargs):
+        lego_set_id = self.lego_set_id
+        result = super().delete(*args, **kwargs)
+        # instance deletes only, a post_delete receiver would disable the fast deletes of whole part lists
+        from lego.signals import catalog_updated
+        catalog_updated.send(sender=LegoPieces, lego_sets=[lego_set_id], lego_pieces=[])
+        return result
 
     def __str__(self) -> str:
         return f'Lego Set: {self.lego_set.name}, Lego Piece: {self.lego_piece.ldraw_id}, ' \
@@ -30,6 +190,9 @@ class LegoPieces(models.Model):
     class Meta:
         verbose_name = 'Set Piece'
         verbose_name_plural = 'Set Pieces'
+        indexes = [
+            models.Index(fields=['lego_set', 'lego_piece', 'lego_color'], name='lego_pieces_set_piece_color'),
+        ]
 
 
 class LegoPiece(models.Model):
@@ -59,6 +222,8 @@ class LegoPiece(models.Model):
     description = models.TextField(max_length=256, blank=True, help_text='Lego piece Description')
     weight = models.PositiveSmallIntegerField(null=True, help_text='Lego piece weight')
     custom_piece = models.BooleanField(default=False, help_text='Lego piece is a custom piece')
+    content_hash = models.CharField(max_length=16, null=True, blank=True, editable=False,
+                                    help_text='Content hash of the row from the last catalog sync')
 
     def __str__(self) -> str:
         return f'Piece: {self.part_name}, LDraw Number: {self.ldraw_id}'
@@ -66,6 +231,10 @@ class LegoPiece(models.Model):
     class Meta:
         verbose_name = 'Piece'
         verbose_name_plural = 'Pieces'
+        # a trigram index on part_name is added on PostgreSQL by migration 0002
+        indexes = [
+            models.Index(fields=['part_name'], name='lego_piece_part_name'),
+        ]
 
 
 class LegoColor(models.Model):
@@ -105,6 +274,8 @@ class LegoColor(models.Model):
     yellow = models.PositiveSmallIntegerField(null=True, help_text='Lego color yellow')
     black = models.PositiveSmallIntegerField(null=True, help_text='Lego color black')
     pantone = models.CharField(blank=True, null=True, max_length=64, help_text='Lego color pantone')
+    content_hash = models.CharField(max_length=16, null=True, blank=True, editable=False,
+                                    help_text='Content hash of the row from the last catalog sync')
 
     def __str__(self) -> str:
         return f'Color ID: {self.ldraw_color_id}, Name: {self.name}'
@@ -112,3 +283,8 @@ class LegoColor(models.Model):
     class Meta:
         verbose_name = 'Color'
         verbose_name_plural = 'Colors'
+        indexes = [
+            models.Index(fields=['ldraw_color_id'], name='lego_color_ldraw_color_id'),
+            models.Index(fields=['bl_color_id'], name='lego_color_bl_color_id'),
+            models.Index(fields=['lego_id'], name='lego_color_lego_id'),
+        ]
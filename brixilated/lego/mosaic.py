@@ -0,0 +1,153 @@
+import numpy as np
+from typing import Iterable, Tuple
+
+from django.db import transaction
+
+from lego.color_index import ColorIndex, get_color_index, rgb_to_lab
+from lego.models import LegoColor, LegoPiece, LegoPieces, LegoSet
+from lego.signals import catalog_updated
+
+# LDraw ids of the 1x1 parts a mosaic can be built from, created on first use when missing
+MOSAIC_PIECES = {
+    'plate': ('3024', 'Plate 1 x 1'),
+    'tile': ('3070b', 'Tile 1 x 1 with Groove'),
+    'round_plate': ('4073', 'Plate, Round 1 x 1'),
+    'round_tile': ('98138', 'Tile, Round 1 x 1'),
+}
+
+# largest quantity of a LegoPieces row (PositiveSmallIntegerField)
+MAX_QUANTITY = 32767
+
+# Floyd-Steinberg weights of the right, lower left, lower and lower right neighbours
+_DIFFUSION = (7 / 16, 3 / 16, 5 / 16, 1 / 16)
+
+
+def to_rgb(image: np.ndarray) -> np.ndarray:
+    """(H, W) grayscale, (H, W, 3) RGB or (H, W, 4) RGBA image (0-255) as a float (H, W, 3) RGB array."""
+    image = np.asarray(image, dtype=float)
+    if image.ndim == 2:
+        image = np.repeat(image[..., None], 3, axis=-1)
+    if image.shape[-1] == 4:
+        # composite transparent pixels on white
+        alpha = image[..., 3:] / 255.0
+        image = image[..., :3] * alpha + 255.0 * (1 - alpha)
+    return image[..., :3]
+
+
+def downsample(image: np.ndarray, width: int, height: int) -> np.ndarray:
+    """Averages the pixels of an (H, W, 3) image covered by every stud of a (height, width) grid."""
+    for axis, size in ((0, height), (1, width)):
+        starts = np.linspace(0, image.shape[axis], size + 1)[:-1].astype(int)
+        if image.shape[axis] >= size:
+            counts = np.diff(np.append(starts, image.shape[axis]))
+            shape = [1, 1, 1]
+            shape[axis] = size
+            image = np.add.reduceat(image, starts, axis=axis) / counts.reshape(shape)
+        else:
+            # images smaller than the grid are upscaled by repeating pixels
+            image = np.take(image, starts, axis=axis)
+    return image
+
+
+def grid_size(image: np.ndarray, width: int, height: int = None) -> Tuple[int, int]:
+    # keep the aspect ratio when only the width is given
+    if height is None:
+        height = max(1, round(width * image.shape[0] / image.shape[1]))
+    return width, height
+
+
+def dither(lab: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """
+    Floyd-Steinberg error diffusion of an (H, W, 3) CIELAB grid onto an (n, 3) CIELAB palette,
+    returning the (H, W) palette indices. Pixel (y, x) only depends on pixels of earlier
+    wavefronts x + 2y, so every wavefront is quantized as one vectorized step.
+    """
+    height, width = lab.shape[:2]
+    # one column of padding on both sides and a row below absorb the error pushed off the grid
+    work = np.zeros((height + 1, width + 2, 3))
+    work[:height, 1:width + 1] = lab
+    palette_norms = (palette ** 2).sum(axis=1)
+
+    ys, xs = np.divmod(np.arange(height * width), width)
+    wavefront = xs + 2 * ys
+    order = np.argsort(wavefront, kind='stable')
+    bounds = np.cumsum(np.bincount(wavefront))[:-1]
+
+    indices = np.empty((height, width), dtype=int)
+    right, lower_left, lower, lower_right = _DIFFUSION
+    for pixels in np.split(order, bounds):
+        y, x = ys[pixels], xs[pixels] + 1
+        values = work[y, x]
+        nearest = np.argmin(palette_norms[None, :] - 2 * values @ palette.T, axis=1)
+        indices[y, x - 1] = nearest
+        error = values - palette[nearest]
+        # neighbours of one wavefront are distinct within each of these updates
+        work[y, x + 1] += error * right
+        work[y + 1, x - 1] += error * lower_left
+        work[y + 1, x] += error * lower
+        work[y + 1, x + 1] += error * lower_right
+    return indices
+
+
+def quantize(image: np.ndarray, width: int, height: int = None, use_dither: bool = True,
+             materials: Iterable[str] = (LegoColor.LegoColorCategory.SOLID,), year_from: int = None,
+             year_to: int = None, metric: str = 'cie76',
+             color_index: ColorIndex = None) -> Tuple[np.ndarray, ColorIndex]:
+    """
+    Downsamples an image to a stud grid and maps every stud to a Lego color, returning the
+    (height, width) array of indices into color_index.colors. Without dithering every stud
+    takes its nearest color by metric (CIE76 by default, like the dithering, as CIEDE2000 is
+    several times slower on large grids), dithering diffuses the error in CIELAB.
+    """
+    color_index = color_index or get_color_index()
+    image = to_rgb(image)
+    width, height = grid_size(image, width, height)
+    lab = rgb_to_lab(downsample(image, width, height))
+
+    candidates = color_index.candidates(materials, year_from, year_to)
+    if not len(candidates):
+        raise ValueError('No Lego colors match the mosaic palette filters')
+
+    if use_dither:
+        return candidates[dither(lab, color_index.lab[candidates])], color_index
+
+    indices, _ = color_index.nearest(lab.reshape(-1, 3), 1, metric, materials, year_from, year_to)
+    return indices.reshape(height, width), color_index
+
+
+def mosaic_piece(piece: str = 'plate') -> LegoPiece:
+    ldraw_id, part_name = MOSAIC_PIECES[piece]
+    lego_piece, _ = LegoPiece.objects.get_or_create(ldraw_id=ldraw_id, defaults={
+        'part_name': part_name,
+        'category': LegoPiece.LegoPieceCategory.BASIC,
+    })
+    return lego_piece
+
+
+def create_mosaic_set(name: str, image: np.ndarray, width: int, height: int = None, piece: str = 'plate',
+                      description: str = '', **kwargs) -> Tuple[LegoSet, np.ndarray]:
+    """
+    Creates (or replaces the part list of) a LegoSet holding the 1x1 pieces of an image mosaic.
+    Returns the set and the (height, width) grid of LegoColor ids. Extra arguments are passed
+    to quantize().
+    """
+    indices, color_index = quantize(image, width, height, **kwargs)
+    color_ids = np.array([color.pk for color in color_index.colors])[indices]
+    counts = np.bincount(indices.ravel(), minlength=len(color_index.colors))
+
+    lego_piece = mosaic_piece(piece)
+    with transaction.atomic():
+        lego_set, _ = LegoSet.objects.update_or_create(name=name, defaults={
+            'description': description,
+            'is_complete_set': True,
+        })
+        LegoPieces.objects.filter(lego_set=lego_set).delete()
+        LegoPieces.objects.bulk_create([
+            LegoPieces(lego_set=lego_set, lego_piece=lego_piece, lego_color=color_index.colors[i],
+                       quantity=min(MAX_QUANTITY, count - offset))
+            for i, count in zip(np.flatnonzero(counts).tolist(), counts[counts > 0].tolist())
+            # larger counts are split over several rows
+            for offset in range(0, count, MAX_QUANTITY)
+        ])
+    catalog_updated.send(sender=LegoPieces, lego_sets=[lego_set.pk], lego_pieces=[])
+    return lego_set, color_ids
@@ -0,0 +1,120 @@
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from django.db.models import Model, Prefetch, QuerySet
+from graphene.utils.str_converters import to_camel_case
+from graphql import FieldNode, FragmentSpreadNode, InlineFragmentNode, SelectionSetNode, value_from_ast_untyped
+
+# fields served by custom resolvers whose rows are still fetched for every parent row at once:
+# (model, field name) -> function of (lookup path, field node, its selected fields, fragments,
+# variables) returning the Prefetch of those rows, see register_prefetch
+CUSTOM_PREFETCHES: Dict[Tuple[type, str], Callable[..., Prefetch]] = {}
+
+
+def _fields(selection_set: SelectionSetNode, fragments: dict) -> Iterator[FieldNode]:
+    # flatten fragments into the plain fields they select
+    if selection_set is None:
+        return
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            yield selection
+        elif isinstance(selection, FragmentSpreadNode):
+            yield from _fields(fragments[selection.name.value].selection_set, fragments)
+        elif isinstance(selection, InlineFragmentNode):
+            yield from _fields(selection.selection_set, fragments)
+
+
+def node_fields(field_nodes: List[FieldNode], fragments: dict) -> List[FieldNode]:
+    # unwrap relay connections (edges { node { ... } }) down to the node's fields
+    fields = [field for node in field_nodes for field in _fields(node.selection_set, fragments)]
+    edges = [field for field in fields if field.name.value == 'edges']
+    if edges:
+        nodes = [field for edge in edges for field in _fields(edge.selection_set, fragments)
+                 if field.name.value == 'node']
+        return [field for node in nodes for field in _fields(node.selection_set, fragments)]
+    return fields
+
+
+def response_key(field: FieldNode) -> str:
+    # name of the field in the response, unique among the selections of its parent
+    return field.alias.value if field.alias else field.name.value
+
+
+def field_arguments(field: FieldNode, variables: dict = None) -> dict:
+    # arguments of a field by their GraphQL names, enum literals as their names
+    return {argument.name.value: value_from_ast_untyped(argument.value, variables) for argument in field.arguments}
+
+
+def register_prefetch(model: Model, name: str, prefetch: Callable[..., Prefetch]) -> None:
+    CUSTOM_PREFETCHES[(model, name)] = prefetch
+
+
+def _model_fields(model: Model) -> dict:
+    return {to_camel_case(field.name): field for field in model._meta.get_fields()}
+
+
+def _related_lookups(model: Model, fields: List[FieldNode], fragments: dict, prefix: str = '',
+                     variables: dict = None) -> Tuple[List[str], List[Prefetch], List[str]]:
+    select = []
+    prefetch = []
+    only = []
+    columns = {model._meta.pk.name}
+    project = True
+    model_fields = _model_fields(model)
+    for field in fields:
+        name = field.name.value
+        model_field = model_fields.get(name)
+        if model_field is None:
+            custom_prefetch = CUSTOM_PREFETCHES.get((model, name))
+            if custom_prefetch is not None:
+                # the resolver reads rows prefetched through the pk
+                prefetch.append(custom_prefetch(prefix, field, node_fields([field], fragments), fragments, variables))
+            elif name not in ('id', '__typename'):
+                # a custom resolver may read any column, so keep the whole row
+                project = False
+            continue
+
+        if not model_field.is_relation:
+            columns.add(model_field.name)
+            continue
+
+        path = f'{prefix}{model_field.name}'
+        sub_fields = node_fields([field], fragments)
+        if model_field.concrete and (model_field.many_to_one or model_field.one_to_one):
+            # forward foreign keys are joined into the same query
+            columns.add(model_field.name)
+            select.append(path)
+            sub_select, sub_prefetch, sub_only = _related_lookups(model_field.related_model, sub_fields,
+                                                                  fragments, f'{path}__', variables)
+            select += sub_select
+            prefetch += sub_prefetch
+            only += sub_only
+        elif model_field.one_to_many:
+            # reverse relations are fetched with one extra query for every parent row at once,
+            # keeping the foreign key back to the parent so rows can be matched up
+            queryset = optimize_queryset(model_field.related_model.objects.all(), sub_fields, fragments,
+                                         required=[model_field.field.name], variables=variables)
+            prefetch.append(Prefetch(path, queryset=queryset))
+
+    if not project:
+        columns = {model_field.name for model_field in model._meta.concrete_fields}
+    only = [f'{prefix}{column}' for column in sorted(columns)] + only
+    return select, prefetch, only
+
+
+def optimize_queryset(queryset: QuerySet, fields: List[FieldNode], fragments: dict = None,
+                      required: List[str] = None, variables: dict = None) -> QuerySet:
+    # join/prefetch the selected relations and only load the selected columns
+    select, prefetch, only = _related_lookups(queryset.model, fields, fragments or {}, variables=variables)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    # related managers set the parent on every row through its foreign key column
+    required = (required or []) + [field.name for field in queryset._known_related_objects]
+    return queryset.only(*only, *required)
+
+
+def optimize_for_info(queryset: QuerySet, info) -> QuerySet:
+    # select_related/prefetch_related/only everything the current field's selection set will resolve
+    return optimize_queryset(queryset, node_fields(info.field_nodes, info.fragments), info.fragments,
+                             variables=info.variable_values)
@@ -1,75 +1,484 @@
 import graphene
+import numpy as np
+from functools import partial
+from django.conf import settings
+from django.db.models import Prefetch
+from django_filters.utils import get_all_model_fields
 from graphene import relay
 from graphene_django import DjangoObjectType
-from graphene_django.filter import DjangoFilterConnectionField
-from lego.models import LegoSet, LegoPiece, LegoPieces, LegoColor
+from graphene_django.settings import graphene_settings
+from graphql import GraphQLError
+from lego.models import LegoSet, LegoSetColor, LegoPiece, LegoPieces, LegoColor, LegoPartUsage, LegoPartUsageSet
+from lego.buildability import get_buildability_index
+from lego.color_index import get_color_index, to_lab
+from lego.id_maps import ID_FIELDS, translate_ids
+from lego.search import search_parts
+from lego.set_diff import diff_sets
+from lego.fields import CountableConnection, KeysetFilterConnectionField
+from lego.optimizer import (field_arguments, node_fields, optimize_for_info, optimize_queryset, register_prefetch,
+                            response_key)
+
+
+# bookkeeping of lego.data.sync, neither queried nor filtered through the API
+SYNC_FIELDS = ('content_hash',)
+
+
+def model_filter_fields(model) -> list:
+    # the filters of filter_fields = '__all__' without the sync bookkeeping
+    return [field for field in get_all_model_fields(model) if field not in SYNC_FIELDS]
+
+
+def page_limit(first: int = None) -> int:
+    # plain lists are served in bounded pages, capped like the relay connections
+    max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+    return max_limit if first is None else min(first, max_limit)
+
+
+def paginate(queryset, first: int = None, offset: int = None, order_by: str = 'pk'):
+    first = page_limit(first)
+    offset = offset or 0
+    return queryset.order_by(*dict.fromkeys([order_by, 'pk']))[offset:offset + first]
 
 
 class LegoSetType(DjangoObjectType):
+    LegoPieces = KeysetFilterConnectionField(lambda: LegoPiecesType, required=True)
+    # a set uses a few dozen colors at most, the breakdown is served whole
+    colors = graphene.List(graphene.NonNull(lambda: LegoSetColorType), required=True,
+                           description='Pieces of every color of the part list, most used color first')
+
+    def resolve_colors(self, info):
+        # sorted in Python so the rows prefetched for every set are used
+        return sorted(self.colors.all(), key=lambda row: (-row.quantity, row.pk))
+
     class Meta:
         model = LegoSet
         fields = '__all__'
         filter_fields = '__all__'
         interfaces = (relay.Node,)
+        connection_class = CountableConnection
+
+
+class LegoSetColorType(DjangoObjectType):
+    class Meta:
+        model = LegoSetColor
+        fields = ('lego_color', 'quantity')
+
+
+class LegoSetOrder(graphene.Enum):
+    # the aggregates are stored on LegoSet, sorting never reads the part lists
+    ID = 'pk'
+    NAME = 'name'
+    TOTAL_PIECES = 'total_pieces'
+    TOTAL_PIECES_DESC = '-total_pieces'
+    UNIQUE_PARTS = 'unique_parts'
+    UNIQUE_PARTS_DESC = '-unique_parts'
+    TOTAL_WEIGHT = 'total_weight'
+    TOTAL_WEIGHT_DESC = '-total_weight'
+
+
+class LegoPartUsageOrder(graphene.Enum):
+    SET_COUNT = 'set_count'
+    SET_COUNT_DESC = '-set_count'
+    TOTAL_QUANTITY = 'total_quantity'
+    TOTAL_QUANTITY_DESC = '-total_quantity'
+
+
+def part_usage_field(description: str) -> graphene.List:
+    return graphene.List(graphene.NonNull(lambda: LegoPartUsageType), required=True, first=graphene.Int(),
+                         offset=graphene.Int(),
+                         order_by=LegoPartUsageOrder(default_value=LegoPartUsageOrder.SET_COUNT_DESC.value),
+                         description=description)
+
+
+def usage_order(order_by=None) -> str:
+    # enum members from the resolver arguments, enum names from the literals the optimizer reads
+    order_by = getattr(order_by, 'value', order_by) or LegoPartUsageOrder.SET_COUNT_DESC.value
+    members = LegoPartUsageOrder._meta.enum.__members__
+    return members[order_by].value if order_by in members else order_by
+
+
+def usage_queryset(queryset, fields, fragments, variables, required=None):
+    # usage rows of a selection, with the top sets of every fetched row loaded in one query per topSets field
+    queryset = optimize_queryset(queryset, fields, fragments, required, variables)
+    for field in fields:
+        if field.name.value == 'topSets':
+            top_sets = optimize_queryset(LegoPartUsageSet.objects.all(), node_fields([field], fragments), fragments,
+                                         ['lego_piece', 'lego_color'], variables)
+            queryset = queryset.with_top_sets(top_sets, page_limit(field_arguments(field, variables).get('first')),
+                                              f'top_sets_{response_key(field)}')
+    return queryset
+
+
+def prefetch_part_usage(relation, path, field, fields, fragments, variables):
+    # partUsage of every piece or color (relation) of a page at once, the page of each parent
+    # is cut with a window function by the sliced prefetch
+    arguments = field_arguments(field, variables)
+    queryset = usage_queryset(LegoPartUsage.objects.all(), fields, fragments, variables, [relation])
+    return Prefetch(f'{path}usage', to_attr=f'part_usage_{response_key(field)}',
+                    queryset=paginate(queryset, arguments.get('first'), arguments.get('offset'),
+                                      usage_order(arguments.get('orderBy'))))
+
+
+def part_usage_page(root, info, relation, first=None, offset=None, order_by=None):
+    prefetched = getattr(root, f'part_usage_{info.path.key}', None)
+    if prefetched is not None:
+        return prefetched
+    # the parent was not loaded by an optimized queryset
+    queryset = usage_queryset(LegoPartUsage.objects.filter(**{relation: root}),
+                              node_fields(info.field_nodes, info.fragments), info.fragments, info.variable_values)
+    return paginate(queryset, first, offset, usage_order(order_by))
 
 
 class LegoPiecesType(DjangoObjectType):
     class Meta:
         model = LegoPieces
-        fields = '__all__'
-        filter_fields = '__all__'
+        exclude = SYNC_FIELDS
+        filter_fields = model_filter_fields(LegoPieces)
         interfaces = (relay.Node,)
+        connection_class = CountableConnection
 
 
 class LegoPieceType(DjangoObjectType):
     category = graphene.String()
+    LegoPiece = KeysetFilterConnectionField(lambda: LegoPiecesType, required=True)
+    part_usage = part_usage_field('Colors the piece is used in, most used first')
 
     def resolve_category(self, info):
         return LegoPiece.LegoPieceCategory(self.category).name
 
+    def resolve_part_usage(self, info, first=None, offset=None, order_by=LegoPartUsageOrder.SET_COUNT_DESC.value):
+        return part_usage_page(self, info, 'lego_piece', first, offset, order_by)
+
     class Meta:
         model = LegoPiece
-        fields = '__all__'
-        filter_fields = '__all__'
+        # usage is served paginated by partUsage
+        exclude = SYNC_FIELDS + ('usage',)
+        filter_fields = model_filter_fields(LegoPiece)
         interfaces = (relay.Node,)
+        connection_class = CountableConnection
 
 
 class LegoColorType(DjangoObjectType):
     material = graphene.String()
+    LegoColor = KeysetFilterConnectionField(lambda: LegoPiecesType, required=True)
+    part_usage = part_usage_field('Pieces used in the color, most used first')
 
     def resolve_material(self, info):
         return LegoColor.LegoColorCategory(self.material).name
 
+    def resolve_part_usage(self, info, first=None, offset=None, order_by=LegoPartUsageOrder.SET_COUNT_DESC.value):
+        return part_usage_page(self, info, 'lego_color', first, offset, order_by)
+
     class Meta:
         model = LegoColor
-        fields = '__all__'
-        filter_fields = '__all__'
+        exclude = SYNC_FIELDS + ('usage',)
+        filter_fields = model_filter_fields(LegoColor)
         interfaces = (relay.Node,)
+        connection_class = CountableConnection
+
+
+class LegoPartUsageSetType(DjangoObjectType):
+    class Meta:
+        model = LegoPartUsageSet
+        fields = ('lego_set', 'quantity')
+
+
+class LegoPartUsageType(DjangoObjectType):
+    # read from the usage index, never from the part lists
+    top_sets = graphene.List(graphene.NonNull(LegoPartUsageSetType), required=True, first=graphene.Int(),
+                             description='Sets using the most pieces of the piece in the color')
+
+    def resolve_top_sets(self, info, first=None):
+        # loaded for every row of the page by usage_queryset
+        prefetched = getattr(self, f'top_sets_{info.path.key}', None)
+        if prefetched is not None:
+            return prefetched
+        return paginate(LegoPartUsageSet.objects.filter(lego_piece_id=self.lego_piece_id,
+                                                        lego_color_id=self.lego_color_id).select_related('lego_set'),
+                        first, 0, '-quantity')
+
+    class Meta:
+        model = LegoPartUsage
+        fields = ('lego_piece', 'lego_color', 'set_count', 'total_quantity')
+
+
+register_prefetch(LegoPiece, 'partUsage', partial(prefetch_part_usage, 'lego_piece'))
+register_prefetch(LegoColor, 'partUsage', partial(prefetch_part_usage, 'lego_color'))
+
+
+class ColorInput(graphene.InputObjectType):
+    hex = graphene.String(description='RRGGBB or #RRGGBB')
+    rgb = graphene.List(graphene.NonNull(graphene.Float), description='[r, g, b] in 0-255')
+    lab = graphene.List(graphene.NonNull(graphene.Float), description='[L, a, b] in CIELAB (D65)')
+
+
+class ColorMetric(graphene.Enum):
+    CIEDE2000 = 'ciede2000'
+    CIE76 = 'cie76'
+
+
+class ColorMatchesType(graphene.ObjectType):
+    # flat scalar lists keep large batches cheap to serialize
+    k = graphene.Int(required=True, description='Matches per input color')
+    color_ids = graphene.List(graphene.NonNull(graphene.Int), required=True,
+                              description='Ids of the k closest Lego colors of every input color, closest first')
+    distances = graphene.List(graphene.NonNull(graphene.Float), required=True,
+                              description='Distance of every entry of colorIds')
+    colors = graphene.List(graphene.NonNull(LegoColorType), required=True,
+                           description='Every matched Lego color, once')
+
+
+class InventoryItemInput(graphene.InputObjectType):
+    lego_piece = graphene.Int(required=True, description='LegoPiece id')
+    lego_color = graphene.Int(description='LegoColor id, null for pieces without a color')
+    quantity = graphene.Int(required=True)
+
+
+class ShortfallType(graphene.ObjectType):
+    lego_piece = graphene.Field(LegoPieceType, required=True)
+    lego_color = graphene.Field(LegoColorType)
+    quantity = graphene.Int(required=True, description='Pieces the set needs')
+    missing = graphene.Int(required=True, description='Pieces the inventory lacks in this exact color')
+
+
+class SetBuildabilityType(graphene.ObjectType):
+    lego_set = graphene.Field(LegoSetType, required=True)
+    total_pieces = graphene.Int(required=True)
+    covered_pieces = graphene.Int(required=True, description='Pieces covered, including color substitutes')
+    percent_complete = graphene.Float(required=True)
+    buildable = graphene.Boolean(required=True)
+    shortfalls = graphene.List(graphene.NonNull(ShortfallType), required=True, first=graphene.Int(),
+                               description='Lines the inventory lacks, all of them unless first is given')
+
+    @staticmethod
+    def resolve_shortfalls(root, info, first=None):
+        return root['shortfalls'] if first is None else root['shortfalls'][:max(first, 0)]
+
+
+class BuildableSetsType(graphene.ObjectType):
+    buildable_count = graphene.Int(required=True, description='Sets the inventory fully covers')
+    sets = graphene.List(graphene.NonNull(SetBuildabilityType), required=True,
+                         description='Sets by percent complete, then size')
+
+
+class SetDiffSummaryType(graphene.ObjectType):
+    lego_set = graphene.Field(LegoSetType, required=True)
+    added = graphene.Int(required=True, description='Lines missing from the base set')
+    removed = graphene.Int(required=True, description='Lines of the base set missing from this set')
+    changed = graphene.Int(required=True, description='Lines of both sets with different quantities')
+    piece_delta = graphene.Int(required=True)
+    weight_delta = graphene.Float(required=True, description='Weight delta of the pieces of known weight')
+
+    @staticmethod
+    def resolve_lego_set(root, info):
+        return root['lego_sets'][root['lego_set_id']]
+
+
+class SetDiffType(graphene.ObjectType):
+    # lines in flat columns keep diffs of large sets cheap to serialize
+    lego_sets = graphene.List(graphene.NonNull(LegoSetType), required=True, description='Base set first')
+    lego_piece_ids = graphene.List(graphene.NonNull(graphene.Int), required=True)
+    lego_color_ids = graphene.List(graphene.Int, required=True)
+    unit_weights = graphene.List(graphene.Int, required=True, description='Weight of one piece of every line')
+    quantities = graphene.List(graphene.NonNull(graphene.List(graphene.NonNull(graphene.Int))), required=True,
+                               description='Quantity of every line in every set, in the order of legoSets')
+    summaries = graphene.List(graphene.NonNull(SetDiffSummaryType), required=True,
+                              description='Every set compared against the base set')
+    pieces = graphene.List(graphene.NonNull(LegoPieceType), required=True, description='Every piece, once')
+    colors = graphene.List(graphene.NonNull(LegoColorType), required=True, description='Every color, once')
+
+    @staticmethod
+    def resolve_lego_sets(root, info):
+        return [root['lego_sets'][pk] for pk in root['lego_set_ids']]
+
+    @staticmethod
+    def resolve_summaries(root, info):
+        return [dict(summary, lego_sets=root['lego_sets']) for summary in root['summaries']]
+
+    @staticmethod
+    def resolve_pieces(root, info):
+        return list(LegoPiece.objects.filter(pk__in=set(root['lego_piece_ids'])).order_by('pk'))
+
+    @staticmethod
+    def resolve_colors(root, info):
+        return list(LegoColor.objects.filter(pk__in=set(root['lego_color_ids']) - {None}).order_by('pk'))
+
+
+class IdKind(graphene.Enum):
+    COLOR = 'color'
+    PART = 'part'
+
+
+class IdScheme(graphene.Enum):
+    ID = 'id'
+    LEGO = 'lego'
+    BRICKLINK = 'bricklink'
+    LDRAW = 'ldraw'
+    REBRICKABLE = 'rebrickable'
+
+
+class IdTranslationType(graphene.ObjectType):
+    ids = graphene.List(graphene.String, required=True,
+                        description='Translated id of every input id, null when it did not resolve')
+    unresolved = graphene.List(graphene.NonNull(graphene.String), required=True,
+                               description='Input ids without a translation')
 
 
 class Query(graphene.ObjectType):
     # custom lego query
-    lego_sets = graphene.List(LegoSetType)
-    lego_piece = graphene.List(LegoPieceType)
-    lego_color = graphene.List(LegoColorType)
+    lego_sets = graphene.List(LegoSetType, first=graphene.Int(), offset=graphene.Int(),
+                              order_by=LegoSetOrder(default_value=LegoSetOrder.ID.value))
+    lego_piece = graphene.List(LegoPieceType, first=graphene.Int(), offset=graphene.Int())
+    lego_color = graphene.List(LegoColorType, first=graphene.Int(), offset=graphene.Int())
+
+    # (piece, color) pairs of every part list by popularity
+    part_usage = part_usage_field('Pieces and colors, most used first')
+
+    # color or part ids translated between LEGO, BrickLink, LDraw and Rebrickable ids
+    translate_ids = graphene.Field(IdTranslationType, kind=IdKind(required=True), source=IdScheme(required=True),
+                                   target=IdScheme(required=True),
+                                   ids=graphene.List(graphene.NonNull(graphene.String), required=True))
+
+    # pieces matching a text query (part name, description, LDraw id, BL item number), best first
+    search_parts = graphene.List(LegoPieceType, query=graphene.String(required=True), first=graphene.Int(),
+                                 offset=graphene.Int())
+
+    # k closest Lego colors of every input color
+    nearest_colors = graphene.Field(ColorMatchesType,
+                                    colors=graphene.List(graphene.NonNull(ColorInput), required=True),
+                                    k=graphene.Int(default_value=1),
+                                    metric=ColorMetric(default_value=ColorMetric.CIEDE2000.value),
+                                    materials=graphene.List(graphene.NonNull(graphene.String)),
+                                    year_from=graphene.Int(), year_to=graphene.Int())
+
+    # sets an inventory of pieces can build, or is closest to building
+    buildable_sets = graphene.Field(BuildableSetsType,
+                                    inventory=graphene.List(graphene.NonNull(InventoryItemInput), required=True),
+                                    color_tolerance=graphene.Float(default_value=0,
+                                                                   description='CIEDE2000 distance within which '
+                                                                               'a color substitutes another'),
+                                    min_percent=graphene.Float(default_value=0),
+                                    buildable_only=graphene.Boolean(default_value=False),
+                                    first=graphene.Int(), offset=graphene.Int())
+
+    # added, removed and changed lines of sets against the first one
+    set_diff = graphene.Field(SetDiffType, lego_sets=graphene.List(graphene.NonNull(graphene.Int), required=True),
+                              include_unchanged=graphene.Boolean(default_value=False))
 
     # filterable fields
-    all_lego_piece = DjangoFilterConnectionField(LegoPieceType)
-    all_lego_pieces = DjangoFilterConnectionField(LegoPiecesType)
-    all_lego_sets = DjangoFilterConnectionField(LegoSetType)
-    all_lego_color = DjangoFilterConnectionField(LegoColorType)
+    all_lego_piece = KeysetFilterConnectionField(LegoPieceType)
+    all_lego_pieces = KeysetFilterConnectionField(LegoPiecesType)
+    all_lego_sets = KeysetFilterConnectionField(LegoSetType)
+    all_lego_color = KeysetFilterConnectionField(LegoColorType)
 
     @staticmethod
-    def resolve_lego_sets(self, info):
-        return LegoSet.objects.all()
+    def resolve_lego_sets(self, info, first=None, offset=None, order_by=LegoSetOrder.ID.value):
+        return paginate(optimize_for_info(LegoSet.objects.all(), info), first, offset,
+                        getattr(order_by, 'value', order_by))
 
     @staticmethod
-    def resolve_lego_piece(self, info):
-        return LegoPiece.objects.all()
+    def resolve_lego_piece(self, info, first=None, offset=None):
+        return paginate(optimize_for_info(LegoPiece.objects.all(), info), first, offset)
+
+    @staticmethod
+    def resolve_lego_color(self, info, first=None, offset=None):
+        return paginate(optimize_for_info(LegoColor.objects.all(), info), first, offset)
+
+    @staticmethod
+    def resolve_part_usage(self, info, first=None, offset=None, order_by=LegoPartUsageOrder.SET_COUNT_DESC.value):
+        queryset = usage_queryset(LegoPartUsage.objects.all(), node_fields(info.field_nodes, info.fragments),
+                                  info.fragments, info.variable_values)
+        return paginate(queryset, first, offset, usage_order(order_by))
+
+    @staticmethod
+    def resolve_translate_ids(self, info, kind, source, target, ids):
+        max_ids = getattr(settings, 'LEGO_GRAPHQL', {}).get('MAX_TRANSLATE_BATCH', 10000)
+        if len(ids) > max_ids:
+            raise GraphQLError(f'translateIds accepts at most {max_ids} ids per request.')
+        kind, source, target = (getattr(value, 'value', value) for value in (kind, source, target))
+        for scheme in (source, target):
+            if scheme not in ID_FIELDS[kind]:
+                raise GraphQLError(f'{kind} ids have no {scheme} scheme.')
+        translated, unresolved = translate_ids(kind, ids, source, target)
+        return {
+            'ids': [None if value is None else str(value) for value in translated],
+            'unresolved': unresolved,
+        }
+
+    @staticmethod
+    def resolve_search_parts(self, info, query, first=None, offset=None):
+        max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+        first = max_limit if first is None else max(0, min(first, max_limit))
+        pks = [pk for pk, _ in search_parts(query, first, max(offset or 0, 0))]
+        pieces = optimize_for_info(LegoPiece.objects.filter(pk__in=pks), info).in_bulk()
+        return [pieces[pk] for pk in pks if pk in pieces]
+
+    @staticmethod
+    def resolve_nearest_colors(self, info, colors, k=1, metric=ColorMetric.CIEDE2000.value, materials=None,
+                               year_from=None, year_to=None):
+        max_colors = getattr(settings, 'LEGO_GRAPHQL', {}).get('MAX_COLOR_BATCH', 10000)
+        if len(colors) > max_colors:
+            raise GraphQLError(f'nearestColors accepts at most {max_colors} colors per request.')
+        try:
+            lab = to_lab(colors)
+            materials = [LegoColor.LegoColorCategory[material].value for material in materials or []]
+        except (KeyError, ValueError) as e:
+            raise GraphQLError(f'Invalid nearestColors input: {e}')
+
+        color_index = get_color_index()
+        indices, distances = color_index.nearest(lab, max(k, 1), getattr(metric, 'value', metric), materials,
+                                                 year_from, year_to)
+        return {
+            'k': indices.shape[1],
+            'color_ids': [color_index.colors[i].pk for i in indices.ravel().tolist()],
+            'distances': distances.ravel().tolist(),
+            'colors': [color_index.colors[i] for i in np.unique(indices).tolist()],
+        }
+
+    @staticmethod
+    def resolve_buildable_sets(self, info, inventory, color_tolerance=0, min_percent=0, buildable_only=False,
+                               first=None, offset=None):
+        max_items = getattr(settings, 'LEGO_GRAPHQL', {}).get('MAX_INVENTORY_SIZE', 100000)
+        if len(inventory) > max_items:
+            raise GraphQLError(f'buildableSets accepts at most {max_items} inventory items per request.')
+        max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+        first = max_limit if first is None else max(0, min(first, max_limit))
+
+        items = {}
+        for item in inventory:
+            if item.quantity > 0:
+                key = (item.lego_piece, item.lego_color)
+                items[key] = items.get(key, 0) + item.quantity
+
+        buildable_count, ranked = get_buildability_index().rank(items, color_tolerance or 0, min_percent or 0,
+                                                                buildable_only, first, max(offset or 0, 0))
+        shortfalls = [shortfall for result in ranked for shortfall in result['shortfalls']]
+        lego_sets = LegoSet.objects.in_bulk([result['lego_set_id'] for result in ranked])
+        pieces = LegoPiece.objects.in_bulk({shortfall['lego_piece_id'] for shortfall in shortfalls})
+        colors = LegoColor.objects.in_bulk({shortfall['lego_color_id'] for shortfall in shortfalls} - {None})
+        return {
+            'buildable_count': buildable_count,
+            'sets': [dict(result, lego_set=lego_sets[result['lego_set_id']], shortfalls=[
+                dict(shortfall, lego_piece=pieces[shortfall['lego_piece_id']],
+                     lego_color=colors.get(shortfall['lego_color_id']))
+                for shortfall in result['shortfalls'] if shortfall['lego_piece_id'] in pieces
+            ]) for result in ranked if result['lego_set_id'] in lego_sets],
+        }
 
     @staticmethod
-    def resolve_lego_color(self, info):
-        return LegoColor.objects.all()
+    def resolve_set_diff(self, info, lego_sets, include_unchanged=False):
+        max_sets = getattr(settings, 'LEGO_GRAPHQL', {}).get('MAX_DIFF_SETS', 20)
+        if len(lego_sets) > max_sets:
+            raise GraphQLError(f'setDiff accepts at most {max_sets} sets per request.')
+        found = LegoSet.objects.in_bulk(lego_sets)
+        missing = [str(pk) for pk in lego_sets if pk not in found]
+        if missing:
+            raise GraphQLError(f'Unknown LegoSet ids: {", ".join(missing)}')
+        try:
+            diff = diff_sets(lego_sets, include_unchanged)
+        except ValueError as e:
+            raise GraphQLError(f'Invalid setDiff input: {e}')
+        return dict(diff, lego_sets=found)
 
     # category_by_name = graphene.Field(CategoryType, name=graphene.String(required=True))
     #
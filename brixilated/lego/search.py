@@ -0,0 +1,253 @@
+import re
+import math
+import bisect
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
+
+from django.db import connection
+from django.db.models import F, Func, Q, TextField, Value
+
+from lego.cache import get_catalog_changes, get_catalog_version
+from lego.models import LegoPiece
+
+# searched fields and the weight of a match in each of them
+FIELD_WEIGHTS = {
+    'ldraw_id': 3.0,
+    'bl_item_no': 3.0,
+    'part_name': 2.0,
+    'description': 1.0,
+}
+
+# score factors of query tokens matching an indexed token as a prefix or with one typo
+PREFIX_FACTOR = 0.8
+TYPO_FACTOR = 0.6
+
+# shortest alphabetic token matched with a typo, numbers and dimensions only match exactly
+MIN_TYPO_LENGTH = 4
+
+# pieces re-read per query when the index is refreshed
+REFRESH_BATCH_SIZE = 500
+
+# GIN index of search_vector() on PostgreSQL
+SEARCH_INDEX_NAME = 'lego_piece_search'
+
+TOKEN = re.compile(r'[0-9a-z]+')
+# '1 x 2', '1X2' and '1x2' are all indexed as the token '1x2'
+DIMENSION = re.compile(r'(\d)\s*x\s*(?=\d)')
+
+
+def normalize(text: str) -> str:
+    return DIMENSION.sub(r'\1x', (text or '').lower())
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall(normalize(text))
+
+
+def _deletes(token: str) -> Set[str]:
+    # the token without one of its characters, two tokens within one edit share at least one of these
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+def _edit_distance(a: str, b: str) -> int:
+    # Damerau-Levenshtein (optimal string alignment) distance
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def _typo_candidate(token: str) -> bool:
+    return len(token) >= MIN_TYPO_LENGTH and token.isalpha()
+
+
+class PartSearchIndex(object):
+    """
+    In-process inverted index over the searchable fields of every LegoPiece, used when the
+    database has no full text search. Query tokens match indexed tokens exactly, the last one
+    also as a prefix (search as you type), and words also with one typo (found through the
+    one-deletion variants of the vocabulary). Pieces rank by the number of query tokens they
+    match, then match exactly, then by the idf and field weights of the matches, and the
+    pieces with the fewest tokens (the most specific ones) come first on ties.
+    """
+
+    def __init__(self, version: int = None):
+        self.version = version
+        self.postings = {}      # token -> {piece pk: field weight}
+        self.documents = {}     # piece pk -> tokens
+        self.vocabulary = []    # sorted tokens, for prefix matches
+        self.variants = {}      # one-deletion variant -> tokens
+        # refreshed in place, queries and refreshes never overlap
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def document_tokens(row: Dict[str, str]) -> Dict[str, float]:
+        # token -> weight of the best field it appears in
+        tokens = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(row.get(field)):
+                tokens[token] = max(tokens.get(token, 0), weight)
+        return tokens
+
+    def add_token(self, token: str) -> None:
+        bisect.insort(self.vocabulary, token)
+        if _typo_candidate(token):
+            for variant in _deletes(token) | {token}:
+                self.variants.setdefault(variant, set()).add(token)
+
+    def remove_token(self, token: str) -> None:
+        del self.postings[token]
+        del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+        if _typo_candidate(token):
+            for variant in _deletes(token) | {token}:
+                tokens = self.variants[variant]
+                tokens.discard(token)
+                if not tokens:
+                    del self.variants[variant]
+
+    def remove(self, pk: int) -> None:
+        for token in self.documents.pop(pk, ()):
+            posting = self.postings[token]
+            del posting[pk]
+            if not posting:
+                self.remove_token(token)
+
+    def add(self, pk: int, row: Dict[str, str]) -> None:
+        tokens = self.document_tokens(row)
+        self.documents[pk] = list(tokens)
+        for token, weight in tokens.items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = {}
+                self.add_token(token)
+            posting[pk] = weight
+
+    def refresh(self, pks: Iterable[int] = None, version: int = None) -> None:
+        """Re-reads the pieces of pks (every piece when None), pieces no longer found are dropped."""
+        fields = list(FIELD_WEIGHTS)
+        with self.lock:
+            if pks is None:
+                self.postings, self.documents, self.vocabulary, self.variants = {}, {}, [], {}
+                batches = [LegoPiece.objects.all()]
+            else:
+                pks = sorted(set(pks))
+                for pk in pks:
+                    self.remove(pk)
+                batches = [LegoPiece.objects.filter(pk__in=pks[i:i + REFRESH_BATCH_SIZE])
+                           for i in range(0, len(pks), REFRESH_BATCH_SIZE)]
+            for batch in batches:
+                for pk, *values in batch.order_by().values_list('pk', *fields):
+                    self.add(pk, dict(zip(fields, values)))
+            self.version = version
+
+    def expand(self, token: str, prefix: bool) -> Dict[str, float]:
+        # indexed tokens a query token matches, with their score factor
+        matches = {}
+        if prefix:
+            start = bisect.bisect_left(self.vocabulary, token)
+            end = bisect.bisect_left(self.vocabulary, token + '{', start)
+            matches.update((candidate, PREFIX_FACTOR) for candidate in self.vocabulary[start:end])
+        if _typo_candidate(token):
+            candidates = set()
+            for variant in _deletes(token) | {token}:
+                candidates.update(self.variants.get(variant, ()))
+            for candidate in candidates:
+                if _edit_distance(token, candidate) == 1:
+                    matches.setdefault(candidate, TYPO_FACTOR)
+        if token in self.postings:
+            matches[token] = 1.0
+        return matches
+
+    def search(self, query: str, first: int = 20, offset: int = 0) -> List[Tuple[int, float]]:
+        """(piece pk, score) of a page of the pieces matching a text query, best first."""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        scores = {}
+        matched = {}
+        exact = {}
+        with self.lock:
+            for i, token in enumerate(tokens):
+                best = {}
+                for candidate, factor in self.expand(token, prefix=i == len(tokens) - 1).items():
+                    for pk, weight in self.postings[candidate].items():
+                        if factor * weight > best.get(pk, 0):
+                            best[pk] = factor * weight
+                # idf of the query token over every piece it matches
+                idf = math.log(1 + len(self.documents) / max(len(best), 1))
+                for pk in self.postings.get(token, ()):
+                    exact[pk] = exact.get(pk, 0) + 1
+                for pk, score in best.items():
+                    scores[pk] = scores.get(pk, 0) + score * idf
+                    matched[pk] = matched.get(pk, 0) + 1
+
+            ranked = sorted(scores, key=lambda pk: (-matched[pk], -exact.get(pk, 0), -scores[pk],
+                                                    len(self.documents[pk]), pk))
+        return [(pk, scores[pk]) for pk in ranked[offset:offset + first]]
+
+
+_part_search_index = None
+_part_search_index_lock = threading.Lock()
+
+
+def get_part_search_index() -> PartSearchIndex:
+    # catches up with catalog changes, re-reading only the written pieces when they are known
+    global _part_search_index
+    version = get_catalog_version()
+    with _part_search_index_lock:
+        index = _part_search_index
+        if index is None:
+            index = PartSearchIndex()
+            index.refresh(None, version)
+        elif index.version != version:
+            index.refresh(get_catalog_changes(index.version, version, 'lego_pieces'), version)
+        _part_search_index = index
+        return index
+
+
+class NormalizedText(Func):
+    # normalize() in SQL, lower case with dimensions written as 1x2
+    function = 'regexp_replace'
+    template = r"%(function)s(lower(coalesce(%(expressions)s, '')), '(\d)\s*x\s*(?=\d)', '\1x', 'g')"
+    output_field = TextField()
+
+
+def search_vector():
+    """
+    Weighted tsvector of the searchable fields on PostgreSQL, indexed as SEARCH_INDEX_NAME by
+    migration 0003 (which keeps a copy of its SQL). Queries must build it the same way to use the index.
+    """
+    from django.contrib.postgres.search import SearchVector
+
+    return (SearchVector(NormalizedText('ldraw_id'), NormalizedText('bl_item_no'), NormalizedText('part_name'),
+                         config='simple', weight='A')
+            + SearchVector(NormalizedText('description'), config='simple', weight='C'))
+
+
+def search_postgres(query: str, first: int = 20, offset: int = 0) -> List[Tuple[int, float]]:
+    # full text matches of every token (the last one as a prefix), or part names trigram-similar to the query
+    from django.contrib.postgres.lookups import TrigramWordSimilar
+    from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+
+    tokens = list(dict.fromkeys(tokenize(query)))
+    if not tokens:
+        return []
+    text = ' '.join(tokens)
+    terms = ' & '.join(tokens[:-1] + [f'{tokens[-1]}:*'])
+    search_query = SearchQuery(terms, config='simple', search_type='raw')
+    rows = LegoPiece.objects.annotate(
+        document=search_vector(),
+        rank=SearchRank(F('document'), search_query) + TrigramWordSimilarity(Value(text), 'part_name'),
+    ).filter(Q(document=search_query) | Q(TrigramWordSimilar(F('part_name'), Value(text)))) \
+        .order_by('-rank', 'pk').values_list('pk', 'rank')
+    return list(rows[offset:offset + first])
+
+
+def search_parts(query: str, first: int = 20, offset: int = 0) -> List[Tuple[int, float]]:
+    """(LegoPiece pk, score) of a page of the pieces matching a text query, best first."""
+    if connection.vendor == 'postgresql':
+        return search_postgres(query, first, offset)
+    return get_part_search_index().search(query, first, offset)
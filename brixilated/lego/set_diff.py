@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+from typing import Sequence
+
+from django.db.models import Sum
+
+from lego.models import LegoPieces
+
+# color key of the lines of custom pieces, which have no color (pivoting drops null keys)
+NO_COLOR = -1
+
+
+def read_part_lists(lego_sets: Sequence[int]) -> pd.DataFrame:
+    # one aggregated row per (set, piece, color) with the unit weight of the piece, in a single query
+    rows = LegoPieces.objects.filter(lego_set_id__in=lego_sets).order_by() \
+        .values_list('lego_set_id', 'lego_piece_id', 'lego_color_id', 'lego_piece__weight') \
+        .annotate(quantity=Sum('quantity'))
+    df = pd.DataFrame.from_records(list(rows), columns=['lego_set_id', 'lego_piece_id', 'lego_color_id',
+                                                        'weight', 'quantity'])
+    df['lego_color_id'] = df['lego_color_id'].fillna(NO_COLOR).astype(np.int64)
+    df['weight'] = df['weight'].astype(float)
+    return df
+
+
+def diff_sets(lego_sets: Sequence[int], include_unchanged: bool = False) -> dict:
+    """
+    Diffs the part lists of LegoSets by (piece, color), comparing every set against the first
+    one (the base). Lines are returned in columns, with the quantity of every line in every
+    set, and per compared set the number of added, removed and quantity-changed lines and the
+    piece and weight deltas. Weight deltas only count pieces of known weight.
+    """
+    lego_sets = list(dict.fromkeys(lego_sets))
+    if len(lego_sets) < 2:
+        raise ValueError('At least two distinct LegoSets are needed for a diff')
+
+    df = read_part_lists(lego_sets)
+    wide = df.pivot_table(index=['lego_piece_id', 'lego_color_id'], columns='lego_set_id', values='quantity',
+                          aggfunc='sum', fill_value=0).reindex(columns=lego_sets, fill_value=0)
+    quantities = wide.to_numpy(dtype=np.int64).reshape(len(wide), len(lego_sets))
+    pieces = wide.index.get_level_values('lego_piece_id').to_numpy(dtype=np.int64)
+    colors = wide.index.get_level_values('lego_color_id').to_numpy(dtype=np.int64)
+    weights = df.groupby('lego_piece_id')['weight'].first().reindex(pieces).to_numpy(dtype=float)
+
+    base, compared = quantities[:, :1], quantities[:, 1:]
+    deltas = compared - base
+    added = (base == 0) & (compared > 0)
+    removed = (base > 0) & (compared == 0)
+    changed = (base > 0) & (compared > 0) & (deltas != 0)
+    weight_deltas = (deltas * np.nan_to_num(weights)[:, None]).sum(axis=0)
+
+    lines = np.arange(len(wide)) if include_unchanged else np.flatnonzero((deltas != 0).any(axis=1))
+    return {
+        'lego_set_ids': lego_sets,
+        'lego_piece_ids': pieces[lines].tolist(),
+        'lego_color_ids': [None if color == NO_COLOR else color for color in colors[lines].tolist()],
+        'unit_weights': [None if np.isnan(weight) else int(weight) for weight in weights[lines].tolist()],
+        'quantities': quantities[lines].tolist(),
+        'summaries': [{
+            'lego_set_id': lego_set,
+            'added': int(added[:, i].sum()),
+            'removed': int(removed[:, i].sum()),
+            'changed': int(changed[:, i].sum()),
+            'piece_delta': int(deltas[:, i].sum()),
+            'weight_delta': float(weight_deltas[i]),
+        } for i, lego_set in enumerate(lego_sets[1:])],
+    }
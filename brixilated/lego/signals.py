@@ -0,0 +1,98 @@
+import threading
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from lego.aggregates import sets_with_pieces, update_part_usage, update_set_aggregates
+from lego.cache import bump_catalog_version
+from lego.models import LegoColor, LegoPiece, LegoPieces, LegoSet
+
+# sent by the bulk loaders, which bypass post_save/post_delete. lego_sets lists the pks of the
+# sets whose part lists changed and lego_pieces the pks of the pieces inserted or updated,
+# None (the default) when that is unknown.
+catalog_updated = Signal()
+
+# sets whose aggregates and part usage wait for the current transaction to commit, per thread
+# (None for every set). Piece writes change the aggregates of the sets using them, not their usage.
+_pending_aggregates = threading.local()
+
+
+def invalidate_catalog_caches(lego_sets=None, lego_pieces=None):
+    # after commit, so no request can cache pre-commit data under the new version
+    transaction.on_commit(partial(bump_catalog_version,
+                                  None if lego_sets is None else list(lego_sets),
+                                  None if lego_pieces is None else list(lego_pieces)))
+
+
+def flush_set_aggregates():
+    lego_sets = getattr(_pending_aggregates, 'lego_sets', set())
+    part_lists = getattr(_pending_aggregates, 'part_lists', set())
+    _pending_aggregates.lego_sets = set()
+    _pending_aggregates.part_lists = set()
+    if lego_sets is None or lego_sets:
+        update_set_aggregates(lego_sets)
+    if part_lists is None or part_lists:
+        update_part_usage(part_lists)
+
+
+def _pend(name, lego_sets):
+    pending = getattr(_pending_aggregates, name, set())
+    setattr(_pending_aggregates, name, None if pending is None or lego_sets is None else pending | set(lego_sets))
+
+
+def update_set_aggregates_on_commit(lego_sets=None, part_lists=None):
+    # the changes of one transaction (e.g. the signals of a cascading delete) are aggregated once,
+    # sets pending from a rolled back transaction are simply aggregated again by the next flush
+    _pend('lego_sets', lego_sets)
+    _pend('part_lists', part_lists)
+    transaction.on_commit(flush_set_aggregates)
+
+
+def catalog_changed(lego_sets=None, lego_pieces=None):
+    if lego_sets is None or lego_pieces is None:
+        update_set_aggregates_on_commit(None, lego_sets)
+    else:
+        # piece writes can change the weight of every set using them
+        update_set_aggregates_on_commit(set(lego_sets) | set(sets_with_pieces(lego_pieces) if lego_pieces else ()),
+                                        lego_sets)
+    invalidate_catalog_caches(lego_sets, lego_pieces)
+
+
+@receiver(catalog_updated)
+def catalog_updated_receiver(sender, lego_sets=None, lego_pieces=None, **kwargs):
+    catalog_changed(lego_sets, lego_pieces)
+
+
+@receiver(post_save, sender=LegoSet)
+@receiver(post_delete, sender=LegoSet)
+def lego_set_changed(sender, instance, **kwargs):
+    catalog_changed([instance.pk], [])
+
+
+# LegoPieces has no post_delete receiver on purpose: a listener disables fast deletes of whole
+# part lists. Instance deletes send catalog_updated from LegoPieces.delete, the loaders delete in
+# bulk and send it themselves, the others cascade from the receivers below.
+@receiver(post_save, sender=LegoPieces)
+def lego_pieces_changed(sender, instance, created, **kwargs):
+    # an updated line may have moved from another set, unknown unless the line was loaded from the database
+    loaded_lego_set_id = getattr(instance, 'loaded_lego_set_id', None)
+    if created or loaded_lego_set_id is not None:
+        catalog_changed({instance.lego_set_id, loaded_lego_set_id} - {None}, [])
+    else:
+        catalog_changed(None, [])
+    instance.loaded_lego_set_id = instance.lego_set_id
+
+
+@receiver(post_save, sender=LegoPiece)
+@receiver(post_save, sender=LegoColor)
+def catalog_entry_saved(sender, instance, **kwargs):
+    catalog_changed([], [instance.pk] if sender is LegoPiece else [])
+
+
+@receiver(post_delete, sender=LegoPiece)
+@receiver(post_delete, sender=LegoColor)
+def catalog_entry_deleted(sender, instance, **kwargs):
+    # deletes cascade into the part lists of any set
+    catalog_changed(None, [instance.pk] if sender is LegoPiece else [])
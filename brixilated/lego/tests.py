@@ -1,3 +1,1394 @@
-from django.test import TestCase
+import base64
+import csv
+import gzip
+import hashlib
+import importlib
+import ipaddress
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import requests
+
+from django.contrib import admin
+from django.core.management import call_command
+from django.core.management.base import CommandError, OutputWrapper
+from django.conf import settings
+from django.db import IntegrityError, connection
+from asgiref.sync import async_to_sync
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from lego import aggregates, buildability, cache as lego_cache, color_index, id_maps, metrics, search, signals
+from lego.admin import LegoPiecesAdmin
+from lego.aggregates import update_part_usage, update_set_aggregates
+from lego.buildability import BuildabilityIndex
+from lego.color_index import ColorIndex, delta_e2000, get_color_index, rgb_to_lab
+from lego.data.http_cache import HTTPCache
+from lego.data.load_data import (lego_set_name_from_csv, load_lego_colors_csv, load_lego_pieces_csv,
+                                 load_lego_sets_csv, populate_pieces, populate_sets, read_lego_pieces_csv,
+                                 read_lego_set_csv, sync_lego_pieces, sync_lego_set_csv, upsert_objects)
+from lego.data.parallel import ingest_files, worker_count
+from lego.data.rebrickable.api_rebrickable import PagesNotFetched, RebrickableAPI
+from lego.data.rebrickable.load_rebrickable import import_colors, import_inventory_parts, import_parts, import_sets
+from lego.data.synthetic import generate_catalog
+from lego.models import (CatalogChange, LegoColor, LegoPartUsage, LegoPartUsageSet, LegoPiece, LegoPieces, LegoSet,
+                         LegoSetColor)
+from lego.mosaic import dither, quantize
+from lego.schema import schema
+from lego.set_diff import diff_sets
+from lego.views import CachedGraphQLView, ThreadedExecutionContext
+
+# full table scans in EXPLAIN output (SQLite / PostgreSQL)
+SEQUENTIAL_SCAN = re.compile(r'\bSCAN \w+$|Seq Scan', re.MULTILINE)
+
+
+def forget_catalog(test):
+    # catalog versions of earlier tests were rolled back and may be reused, drop what the process kept of them
+    for module, name, value in ((lego_cache, '_catalog_version', (0, float('-inf'))),
+                                (color_index, '_color_index', None), (buildability, '_buildability_index', None),
+                                (id_maps, '_id_maps', None), (search, '_part_search_index', None)):
+        patcher = mock.patch.object(module, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+class IndexPlanTests(TestCase):
+    """The main lookups of the loaders and GraphQL filters stay off sequential scans."""
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            # tiny test tables would be scanned regardless, make the planner prefer any usable index
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+    def assertIndexScan(self, queryset):
+        plan = queryset.explain()
+        self.assertIsNone(SEQUENTIAL_SCAN.search(plan), plan)
+
+    def test_color_ids(self):
+        self.assertIndexScan(LegoColor.objects.filter(ldraw_color_id=1))
+        self.assertIndexScan(LegoColor.objects.filter(bl_color_id=1))
+        self.assertIndexScan(LegoColor.objects.filter(lego_id=1))
+
+    def test_part_name(self):
+        self.assertIndexScan(LegoPiece.objects.filter(part_name='Brick 2 x 4'))
+        self.assertIndexScan(LegoPiece.objects.filter(ldraw_id='3001'))
+
+    def test_set_pieces(self):
+        self.assertIndexScan(LegoPieces.objects.filter(lego_set=1))
+        self.assertIndexScan(LegoPieces.objects.filter(lego_set=1, lego_piece=2, lego_color=3))
+        self.assertIndexScan(LegoPieces.objects.filter(lego_piece=2))
+        self.assertIndexScan(LegoPieces.objects.filter(lego_color=3))
+
+    def test_detects_sequential_scan(self):
+        self.assertIsNotNone(SEQUENTIAL_SCAN.search(LegoColor.objects.filter(name='Red').explain()))
+
+
+class UpsertTests(TestCase):
+    """Every upserted row is counted once, rows matching two different entries are conflicts."""
+
+    def test_counts(self):
+        LegoColor.objects.create(ldraw_color_id=4, bl_color_id=5, name='Red')
+        blue = LegoColor.objects.create(ldraw_color_id=1, bl_color_id=7, name='Blue')
+        rows = [
+            {'ldraw_color_id': 4, 'bl_color_id': 5, 'name': 'Red'},
+            {'ldraw_color_id': 1, 'bl_color_id': 7, 'name': 'Blue 2'},
+            {'ldraw_color_id': 1, 'bl_color_id': 7, 'name': 'Blue 3'},
+            {'ldraw_color_id': 99, 'bl_color_id': 99, 'name': 'New'},
+            {'ldraw_color_id': 99, 'bl_color_id': 99, 'name': 'New 2'},
+            # LDraw id of Red, BrickLink id of Blue
+            {'ldraw_color_id': 4, 'bl_color_id': 7, 'name': 'Mixed'},
+            # LDraw id of Red, another BrickLink id
+            {'ldraw_color_id': 4, 'bl_color_id': 8, 'name': 'Other'},
+        ]
+        counts = upsert_objects(LegoColor, rows, ['ldraw_color_id', 'bl_color_id'])
+
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'unchanged': 1, 'merged': 2, 'conflicts': 2})
+        self.assertEqual(sum(counts.values()), len(rows))
+        blue.refresh_from_db()
+        self.assertEqual(blue.name, 'Blue 3')
+        self.assertEqual(sorted(LegoColor.objects.values_list('name', flat=True)), ['Blue 3', 'New 2', 'Red'])
+
+        # re-running the batch changes nothing
+        counts = upsert_objects(LegoColor, rows[2:3] + rows[4:5], ['ldraw_color_id', 'bl_color_id'])
+        self.assertEqual(counts['unchanged'], 2)
+
+
+class RebrickableImportTests(TestCase):
+    """The Rebrickable dumps import in chunks from local .csv.gz files."""
+
+    def write_dump(self, directory, table, header, rows):
+        path = os.path.join(directory, f'{table}.csv.gz')
+        with gzip.open(path, 'wt') as csv:
+            csv.write(f'{header}\n')
+            csv.writelines(f'{",".join(map(str, row))}\n' for row in rows)
+        return path
+
+    def test_import(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        colors = self.write_dump(directory, 'colors', 'id,name,rgb,is_trans',
+                                 [(-1, '[Unknown]', '0033B2', 'f'), (4, 'Red', 'C91A09', 'f'),
+                                  # a chunk of codes that are all digits
+                                  (0, 'Black', '000000', 'f'), (1001, 'Test Gray', '111111', 'f'),
+                                  (36, 'Trans-Red', 'C91A09', 't')])
+        parts = self.write_dump(directory, 'parts', 'part_num,name,part_cat_id,part_material',
+                                [('3001', 'Brick 2 x 4', 11, 'Plastic'), ('3020', 'Plate 2 x 4', 14, 'Plastic'),
+                                 ('3024', 'Plate 1 x 1', 14, 'Plastic')])
+        sets = self.write_dump(directory, 'sets', 'set_num,name,year,theme_id,num_parts,img_url',
+                               [('6020-1', 'Magic Shop', 1993, 1, 3, ''), ('6021-1', 'Village', 1994, 1, 2, '')])
+        inventories = self.write_dump(directory, 'inventories', 'id,version,set_num',
+                                      [(1, 1, '6020-1'), (3, 2, '6020-1'), (2, 1, '6021-1'), (4, 1, 'fig-000001')])
+        inventory_parts = self.write_dump(directory, 'inventory_parts',
+                                          'inventory_id,part_num,color_id,quantity,is_spare',
+                                          [(1, '3001', 4, 9, 'f'), (3, '3001', 4, 2, 'f'), (3, '3024', 36, 1, 'f'),
+                                           (3, '3024', 36, 1, 't'), (3, 'unknown', 4, 5, 'f'),
+                                           (2, '3020', 4, 7, 'f'), (4, '3020', 36, 1, 'f')])
+
+        self.assertEqual(import_colors(colors, chunksize=2)['inserted'], 4)
+        self.assertEqual(sorted(LegoColor.objects.values_list('ldraw_color_id', 'hex_code')),
+                         [(0, '000000'), (4, 'C91A09'), (36, 'C91A09'), (1001, '111111')])
+        self.assertEqual(import_parts(parts, chunksize=2)['inserted'], 3)
+        inventory_sets = import_sets(sets, inventories, chunksize=2)
+
+        magic_shop = LegoSet.objects.get(name='6020-1')
+        # the latest inventory version of every set, minifigs only listed in inventories included
+        self.assertEqual(inventory_sets, {3: magic_shop.pk, 2: LegoSet.objects.get(name='6021-1').pk,
+                                          4: LegoSet.objects.get(name='fig-000001').pk})
+        self.assertEqual(magic_shop.description, 'Magic Shop')
+
+        self.assertEqual(import_inventory_parts(inventory_parts, inventory_sets, chunksize=2), 4)
+        # spare parts are not part list lines, unknown parts are skipped
+        self.assertEqual(sorted(LegoPieces.objects.filter(lego_set=magic_shop).values_list(
+            'lego_piece__ldraw_id', 'lego_color__name', 'quantity')), [('3001', 'Red', 2), ('3024', 'Trans-Red', 1)])
+
+
+def start_server(test, handler):
+    # serves handler on a free local port for the duration of the test, recording the request paths
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server
+
+
+class StubRebrickableHandler(BaseHTTPRequestHandler):
+    # pages of 2 colors out of 5, the responses of a page are popped from server.script first
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        script = self.server.script.get(urlparse(self.path).path, [])
+        status = script.pop(0) if script else 200
+        page = int(parse_qs(urlparse(self.path).query).get('page', ['1'])[0])
+        body = json.dumps({'count': 5, 'next': 'more' if page < 3 else None,
+                           'results': [{'id': i, 'name': f'Color {i}'} for i in range((page - 1) * 2,
+                                                                                     min(page * 2, 5))]})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RebrickableAPITests(TestCase):
+    """Paginated fetches are rate limited, retried on 429 and 5xx, and never return partial results."""
+
+    def setUp(self):
+        self.server = start_server(self, StubRebrickableHandler)
+        self.server.script = {}
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.api = RebrickableAPI('key', requests_per_second=20, workers=2, max_retries=2, max_backoff=0,
+                                  cache=HTTPCache(cache_dir))
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server.server_address[1]}{path}?page_size=2'
+
+    def test_rate_limited_retries(self):
+        self.server.script['/colors/'] = [429, 503]
+        start = time.monotonic()
+        df = self.api.fetch_data(self.url('/colors/'))
+        self.assertEqual(df['id'].tolist(), [0, 1, 2, 3, 4])
+        # 3 pages, 2 of the requests retried
+        self.assertEqual(len(self.server.requests), 5)
+        # the token bucket spaces the 5 requests by 1/20 s
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_client_errors(self):
+        self.server.script['/parts/'] = [404]
+        with self.assertRaises(requests.HTTPError):
+            self.api.fetch_data(self.url('/parts/'))
+        # not retried
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_failed_pages(self):
+        # the first page succeeds, then every attempt at the next pages fails
+        self.server.script['/colors/'] = [200] + [500] * 6
+        with self.assertRaises(PagesNotFetched) as raised:
+            self.api.fetch_data(self.url('/colors/'))
+        self.assertEqual(sorted(parse_qs(urlparse(url).query)['page'] for url in raised.exception.urls),
+                         [['2'], ['3']])
+        self.assertEqual(len(self.server.requests), 7)
+
+    def test_evicted_body(self):
+        url = self.url('/colors/')
+        self.assertEqual(len(self.api.fetch_page(url)['results']), 2)
+        get = self.api.cache.get
+
+        def get_then_evict(*args, **kwargs):
+            # another thread evicts the entry between the lookup and the read of its body
+            response = get(*args, **kwargs)
+            if response.from_cache:
+                os.remove(response.path)
+            return response
+
+        with mock.patch.object(self.api.cache, 'get', side_effect=get_then_evict) as cache_get:
+            self.assertEqual(len(self.api.fetch_page(url)['results']), 2)
+        # a cache miss, fetched again without a backoff
+        self.assertEqual(cache_get.call_count, 2)
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class StubDownloadHandler(BaseHTTPRequestHandler):
+    # /<size> returns size bytes of latin-1 text with an etag, revalidated with 304
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        etag = f'"{self.path}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = ('é' * int(self.path[1:])).encode('latin-1')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=latin-1')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPCacheTests(TestCase):
+    """Stored bodies are served until they expire, then revalidated; eviction spares the entry just stored."""
+
+    def setUp(self):
+        self.server = start_server(self, StubDownloadHandler)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def url(self, size):
+        return f'http://127.0.0.1:{self.server.server_address[1]}/{size}'
+
+    def test_hit_and_miss(self):
+        cache = HTTPCache(self.cache_dir)
+        miss = cache.get(self.url(3))
+        self.assertFalse(miss.from_cache)
+        self.assertEqual(miss.text, 'ééé')
+        hit = cache.get(self.url(3))
+        self.assertTrue(hit.from_cache)
+        # decoded with the charset of the original response
+        self.assertEqual(hit.encoding, 'latin-1')
+        self.assertEqual(hit.text, 'ééé')
+        self.assertEqual(self.server.requests, ['/3'])
+
+    def test_expiry(self):
+        cache = HTTPCache(self.cache_dir, ttl=0)
+        cache.get(self.url(3))
+        revalidated = cache.get(self.url(3))
+        # the expired entry is revalidated with its etag and served from disk on 304
+        self.assertTrue(revalidated.from_cache)
+        self.assertEqual(revalidated.content, 'ééé'.encode('latin-1'))
+        self.assertEqual(self.server.requests, ['/3', '/3'])
+
+    def test_eviction(self):
+        cache = HTTPCache(self.cache_dir, max_size=10)
+        cache.get(self.url(4))
+        cache.get(self.url(5))
+        # larger than max_size, still readable after the store
+        large = cache.get(self.url(20))
+        self.assertEqual(len(large.content), 20)
+        self.assertTrue(cache.get(self.url(20)).from_cache)
+        # the older entries were evicted
+        self.assertFalse(cache.get(self.url(4)).from_cache)
+        self.assertEqual(self.server.requests, ['/4', '/5', '/20', '/4'])
+
+
+class InventoryImportTests(TestCase):
+    """
+    Rebrickable inventory imports, through COPY and staging tables on PostgreSQL (run the tests with
+    POSTGRES_HOST set, e.g. against the docker-compose db service) and the ORM everywhere else.
+    """
+
+    def setUp(self):
+        self.red = LegoColor.objects.create(ldraw_color_id=4, name='Red')
+        LegoColor.objects.create(ldraw_color_id=4, name='Red (duplicate)')
+        self.brick = LegoPiece.objects.create(ldraw_id='3001', part_name='Brick 2 x 4')
+        self.plate = LegoPiece.objects.create(ldraw_id='3020', part_name='Plate 2 x 4')
+        self.lego_set = LegoSet.objects.create(name='6020-1')
+        self.other_set = LegoSet.objects.create(name='6021-1')
+        LegoPieces.objects.create(lego_set=self.lego_set, lego_piece=self.plate, quantity=9)
+        LegoPieces.objects.create(lego_set=self.other_set, lego_piece=self.plate, quantity=1)
+
+    def write_inventory_parts(self, rows):
+        f = tempfile.NamedTemporaryFile(suffix='.csv.gz', delete=False)
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        with gzip.open(f.name, 'wt') as csv:
+            csv.write('inventory_id,part_num,color_id,quantity,is_spare\n')
+            csv.writelines(f'{",".join(map(str, row))},f\n' for row in rows)
+        return f.name
+
+    def part_list(self, lego_set):
+        return sorted(LegoPieces.objects.filter(lego_set=lego_set).values_list('lego_piece', 'lego_color', 'quantity'))
+
+    def test_replaces_part_lists(self):
+        source = self.write_inventory_parts([
+            (1, '3001', 4, 2),
+            (1, '3020', -1, 3),
+            (1, 'unknown', 4, 5),
+            (2, '3001', 4, 7),
+        ])
+        inserted = import_inventory_parts(source, {1: self.lego_set.pk}, chunksize=2)
+
+        self.assertEqual(inserted, 2)
+        # colors resolve to the lowest pk of duplicate ids, unknown colors to none
+        self.assertEqual(self.part_list(self.lego_set), [(self.brick.pk, self.red.pk, 2), (self.plate.pk, None, 3)])
+        self.assertEqual(self.part_list(self.other_set), [(self.plate.pk, None, 1)])
+
+        # imports are repeatable
+        self.assertEqual(import_inventory_parts(source, {1: self.lego_set.pk}), 2)
+        self.assertEqual(len(self.part_list(self.lego_set)), 2)
+
+
+class SyncTests(TestCase):
+    """A sync applies only the changes of the snapshot and never deletes pieces still in part lists."""
+
+    def sync(self, rows):
+        output = StringIO()
+        sync_lego_pieces(pd.DataFrame(rows, columns=['ldraw_id', 'part_name', 'category', 'description']),
+                         OutputWrapper(output))
+        return output.getvalue().strip()
+
+    def pieces(self):
+        return sorted(LegoPiece.objects.values_list('ldraw_id', 'part_name'))
+
+    def test_sync(self):
+        rows = [('3001', 'Brick 2 x 4', 'BA', ''), ('3020', 'Plate 2 x 4', 'BA', ''),
+                ('3024', 'Plate 1 x 1', 'BA', ''), ('3069b', 'Tile 1 x 2', 'BA', '')]
+        self.assertEqual(self.sync(rows), 'Synced Lego Pieces: 4 inserted, 0 updated, 0 deleted, 0 unchanged')
+        hashes = dict(LegoPiece.objects.values_list('ldraw_id', 'content_hash'))
+        self.assertNotIn(None, hashes.values())
+
+        self.assertEqual(self.sync(rows), 'Synced Lego Pieces: 0 inserted, 0 updated, 0 deleted, 4 unchanged')
+        self.assertEqual(dict(LegoPiece.objects.values_list('ldraw_id', 'content_hash')), hashes)
+
+        # 3024 is in a part list, 3069b is not
+        lego_set = LegoSet.objects.create(name='6020-1')
+        LegoPieces.objects.create(lego_set=lego_set, lego_piece=LegoPiece.objects.get(ldraw_id='3024'), quantity=2)
+        rows = [('3001', 'Brick 2 x 4', 'BA', ''), ('3020', 'Plate 2 x 4 Modified', 'BA', ''),
+                ('3010', 'Brick 1 x 4', 'BA', '')]
+        self.assertEqual(self.sync(rows), 'Synced Lego Pieces: 1 inserted, 1 updated, 1 deleted, 1 unchanged, '
+                                          '1 not deleted (still in part lists)')
+        self.assertEqual(self.pieces(), [('3001', 'Brick 2 x 4'), ('3010', 'Brick 1 x 4'),
+                                         ('3020', 'Plate 2 x 4 Modified'), ('3024', 'Plate 1 x 1')])
+        self.assertEqual(LegoPieces.objects.filter(lego_set=lego_set).count(), 1)
+
+    def test_schema_hides_content_hash(self):
+        self.assertNotIn('contentHash', str(schema))
+
+
+class GraphQLQueryTests(TestCase):
+    """Nested selections are served by joins and prefetches, not one query per row."""
+
+    @classmethod
+    def setUpTestData(cls):
+        colors = LegoColor.objects.bulk_create([LegoColor(ldraw_color_id=i, name=f'Color {i}') for i in range(3)])
+        pieces = LegoPiece.objects.bulk_create([LegoPiece(ldraw_id=str(3001 + i), part_name=f'Piece {i}')
+                                                for i in range(4)])
+        sets = LegoSet.objects.bulk_create([LegoSet(name=f'{6020 + i}-1') for i in range(3)])
+        LegoPieces.objects.bulk_create([LegoPieces(lego_set=lego_set, lego_piece=piece, lego_color=color,
+                                                   quantity=i + 1)
+                                        for lego_set in sets for i, (piece, color) in enumerate(zip(pieces, colors))])
+
+    def execute(self, query, **variables):
+        result = schema.execute(query, variable_values=variables)
+        self.assertIsNone(result.errors)
+        return result.data
+
+    def test_set_part_lists(self):
+        # the sets, then the part lines of every set with their pieces and colors joined
+        with self.assertNumQueries(2):
+            data = self.execute('''{
+              legoSets(first: 10) {
+                name
+                LegoPieces(first: 10) { edges { node { quantity legoPiece { partName } legoColor { name } } } }
+              }
+            }''')
+        self.assertEqual(len(data['legoSets']), 3)
+        self.assertEqual(data['legoSets'][0]['LegoPieces']['edges'][2]['node'],
+                         {'quantity': 3, 'legoPiece': {'partName': 'Piece 2'}, 'legoColor': {'name': 'Color 2'}})
+
+    def test_all_lego_pieces(self):
+        with self.assertNumQueries(1):
+            data = self.execute('''{
+              allLegoPieces(first: 5) {
+                edges { node { quantity legoSet { name } legoPiece { ldrawId } legoColor { name } } }
+              }
+            }''')
+        self.assertEqual([edge['node']['legoSet']['name'] for edge in data['allLegoPieces']['edges']],
+                         ['6020-1'] * 3 + ['6021-1'] * 2)
+        self.assertEqual(data['allLegoPieces']['edges'][0]['node']['legoPiece'], {'ldrawId': '3001'})
+
+    def test_projection(self):
+        # one query with the color joined, reading only the selected columns
+        with CaptureQueriesContext(connection) as queries:
+            data = self.execute('{ allLegoPieces(first: 5) { edges { node { quantity legoColor { name } } } } }')
+        self.assertEqual(data['allLegoPieces']['edges'][1]['node'], {'quantity': 2, 'legoColor': {'name': 'Color 1'}})
+        self.assertEqual(len(queries), 1)
+        columns = re.sub(r'\bFROM\b.*', '', queries[0]['sql'])
+        for selected in ('"lego_legopieces"."quantity"', '"lego_legopieces"."lego_color_id"',
+                         '"lego_legocolor"."name"'):
+            self.assertIn(selected, columns)
+        for unselected in ('element_id', 'content_hash', 'lego_piece_id', 'ldraw_color_id', 'hex_code'):
+            self.assertNotIn(unselected, columns)
+
+    def page(self, **variables):
+        return self.execute('''query ($first: Int, $last: Int, $after: String, $before: String, $offset: Int) {
+          allLegoPieces(first: $first, last: $last, after: $after, before: $before, offset: $offset) {
+            totalCount
+            pageInfo { hasNextPage hasPreviousPage endCursor }
+            edges { cursor node { id } }
+          }
+        }''', **variables)['allLegoPieces']
+
+    def test_keyset_walk(self):
+        everything = [edge['node']['id'] for edge in self.page(first=100)['edges']]
+        self.assertEqual(len(everything), 9)
+        walked = []
+        after = None
+        while True:
+            page = self.page(first=4, after=after)
+            walked += [edge['node']['id'] for edge in page['edges']]
+            if not page['pageInfo']['hasNextPage']:
+                break
+            after = page['pageInfo']['endCursor']
+        self.assertEqual(walked, everything)
+        self.assertEqual([edge['node']['id'] for edge in self.page(last=3)['edges']], everything[-3:])
+
+    def test_keyset_offset(self):
+        everything = self.page(first=100)['edges']
+        # the offset skips rows after the cursor, the cursors stay keyset cursors
+        page = self.page(first=2, after=everything[1]['cursor'], offset=3)
+        self.assertEqual(page['edges'], everything[5:7])
+        self.assertTrue(page['pageInfo']['hasPreviousPage'])
+        self.assertEqual(self.page(first=2, after=page['pageInfo']['endCursor'])['edges'], everything[7:9])
+        self.assertEqual(self.page(first=2, offset=20)['edges'], [])
+
+    def test_total_count(self):
+        self.assertEqual(self.page(first=2)['totalCount'], 9)
+        data = self.execute('''{
+          legoSets(first: 1) { LegoPieces(first: 1, offset: 1) { totalCount edges { cursor node { quantity } } } }
+        }''')
+        connection = data['legoSets'][0]['LegoPieces']
+        self.assertEqual(connection['totalCount'], 3)
+        # nested connections are paged by pk like the root ones
+        self.assertEqual(connection['edges'][0]['node'], {'quantity': 2})
+        self.assertTrue(base64.b64decode(connection['edges'][0]['cursor']).startswith(b'keyset:'))
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class QueryLimitTests(TestCase):
+    """Operations nested too deep or over the estimated cost budget are rejected before they run."""
+
+    # every part list line of every set, with 3 more lines of each of their pieces
+    nested = 'legoSets(first: 100) { LegoPieces(first: %s) { edges { node { legoPiece { ' \
+             'LegoPiece(first: 3) { edges { node { quantity } } } } } } } }'
+
+    def setUp(self):
+        CachedGraphQLView.response_cache.clear()
+        self.addCleanup(CachedGraphQLView.response_cache.clear)
+
+    def post(self, query, variables=None):
+        response = self.client.post('/lego/graphql', json.dumps({'query': query, 'variables': variables}),
+                                    content_type='application/json')
+        return response.status_code, [error['message'] for error in response.json().get('errors', [])]
+
+    def test_depth(self):
+        query = '{ legoSets(first: 1) { LegoPieces(first: 1) { edges { node { legoPiece { LegoPiece(first: 1) { ' \
+                'edges { node { legoSet { LegoPieces(first: 1) { edges { node { quantity } } } } } } } } } } } } }'
+        self.assertEqual(self.post(query), (400, ["'anonymous' exceeds maximum operation depth of 10."]))
+
+    def test_cost(self):
+        error = "'anonymous' exceeds maximum query cost of 50000 (estimated cost 130200)."
+        self.assertEqual(self.post('{ %s }' % (self.nested % 100)), (400, [error]))
+        # page sizes given as variables count as the largest page
+        self.assertEqual(self.post('query ($first: Int) { %s }' % (self.nested % '$first'), {'first': 1}),
+                         (400, [error]))
+
+    def test_within_limits(self):
+        self.assertEqual(self.post('{ %s }' % (self.nested % 1)), (200, []))
+        # an empty page costs nothing below it
+        self.assertEqual(self.post('{ %s }' % (self.nested % 0)), (200, []))
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class CatalogVersionTests(TestCase):
+    """The catalog version lives in the database, so writes of any process invalidate the cached responses."""
+
+    query = '{ legoSets(first: 10) { name } }'
+
+    def setUp(self):
+        CachedGraphQLView.response_cache.clear()
+        self.addCleanup(CachedGraphQLView.response_cache.clear)
+        forget_catalog(self)
+        LegoSet.objects.create(name='6020-1')
+
+    def post(self, body):
+        response = self.client.post('/lego/graphql', json.dumps(body), content_type='application/json')
+        return response.json()
+
+    def set_names(self):
+        return [lego_set['name'] for lego_set in self.post({'query': self.query})['data']['legoSets']]
+
+    def test_write_invalidates_responses(self):
+        self.assertEqual(self.set_names(), ['6020-1'])
+        # writes bypassing the signals keep the version, the cached response is served
+        LegoSet.objects.filter(name='6020-1').update(name='6021-1')
+        self.assertEqual(self.set_names(), ['6020-1'])
+        with self.captureOnCommitCallbacks(execute=True):
+            LegoSet.objects.create(name='6022-1')
+        self.assertEqual(self.set_names(), ['6021-1', '6022-1'])
+
+    def test_write_of_another_process(self):
+        # the version is read again on every request
+        with mock.patch.object(lego_cache, 'CATALOG_VERSION_TTL', 0):
+            self.assertEqual(self.set_names(), ['6020-1'])
+            # e.g. a loader process, its version reaches this process through the database
+            LegoSet.objects.filter(name='6020-1').update(name='6021-1')
+            change = CatalogChange.objects.create(lego_sets=[LegoSet.objects.get().pk], lego_pieces=[])
+            self.assertEqual(lego_cache.get_catalog_version(), change.pk)
+            self.assertEqual(self.set_names(), ['6021-1'])
+
+    def test_catalog_changes(self):
+        first = lego_cache.bump_catalog_version([1, 2], [5])
+        second = lego_cache.bump_catalog_version([3, 2], None)
+        self.assertEqual(lego_cache.get_catalog_version(), second)
+        self.assertEqual(lego_cache.get_catalog_changes(first - 1, second), {1, 2, 3})
+        self.assertEqual(lego_cache.get_catalog_changes(first, second), {2, 3})
+        # unknown pieces, then expired versions need a full rebuild
+        self.assertIsNone(lego_cache.get_catalog_changes(first - 1, second, 'lego_pieces'))
+        CatalogChange.objects.filter(pk=first).delete()
+        self.assertIsNone(lego_cache.get_catalog_changes(first - 1, second))
+
+    def test_persisted_queries(self):
+        query_hash = hashlib.sha256(self.query.encode('utf-8')).hexdigest()
+        extensions = {'persistedQuery': {'version': 1, 'sha256Hash': query_hash}}
+        missed = self.post({'extensions': extensions})
+        self.assertEqual(missed['errors'][0]['message'], 'PersistedQueryNotFound')
+        self.assertEqual(self.post({'query': self.query, 'extensions': extensions})['data'],
+                         {'legoSets': [{'name': '6020-1'}]})
+        # registered, the hash now stands for the query
+        self.assertEqual(self.post({'extensions': extensions})['data'], {'legoSets': [{'name': '6020-1'}]})
+        mismatched = {'persistedQuery': {'version': 1, 'sha256Hash': '0' * 64}}
+        self.assertEqual(self.post({'query': self.query, 'extensions': mismatched})['errors'][0]['message'],
+                         'Provided sha256Hash does not match query.')
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class AsyncGraphQLViewTests(TransactionTestCase):
+    """The root fields of a query sent to /lego/graphql/async resolve concurrently, each in a worker thread."""
+
+    def setUp(self):
+        CachedGraphQLView.response_cache.clear()
+        self.addCleanup(CachedGraphQLView.response_cache.clear)
+        # committed, the worker threads read through their own connections
+        LegoSet.objects.create(name='6020-1')
+        LegoPiece.objects.create(ldraw_id='3001', part_name='Brick 2 x 4')
+        LegoColor.objects.create(ldraw_color_id=4, name='Red')
+
+    def test_root_fields(self):
+        query = '{ legoSets(first: 5) { name } legoPiece(first: 5) { ldrawId } legoColor(first: 5) { name } }'
+        threads = []
+        execute_root_field = ThreadedExecutionContext.execute_root_field
+
+        def record_thread(context, *args):
+            threads.append(threading.get_ident())
+            return execute_root_field(context, *args)
+
+        with mock.patch.object(ThreadedExecutionContext, 'execute_root_field', record_thread):
+            response = async_to_sync(self.async_client.post)('/lego/graphql/async', {'query': query},
+                                                             content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'data': {'legoSets': [{'name': '6020-1'}],
+                                                    'legoPiece': [{'ldrawId': '3001'}],
+                                                    'legoColor': [{'name': 'Red'}]}})
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_expired_catalog_version(self):
+        # the version is read again from the database, off the event loop
+        forget_catalog(self)
+        response = async_to_sync(self.async_client.post)('/lego/graphql/async', {'query': '{ legoSets { name } }'},
+                                                         content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'data': {'legoSets': [{'name': '6020-1'}]}})
+
+
+# the CIEDE2000 test pairs of Sharma, Wu and Dalal (2005): L1, a1, b1, L2, a2, b2, delta E
+CIEDE2000_PAIRS = [
+    (50.0000, 2.6772, -79.7751, 50.0000, 0.0000, -82.7485, 2.0425),
+    (50.0000, 3.1571, -77.2803, 50.0000, 0.0000, -82.7485, 2.8615),
+    (50.0000, 2.8361, -74.0200, 50.0000, 0.0000, -82.7485, 3.4412),
+    (50.0000, -1.3802, -84.2814, 50.0000, 0.0000, -82.7485, 1.0000),
+    (50.0000, -1.1848, -84.8006, 50.0000, 0.0000, -82.7485, 1.0000),
+    (50.0000, -0.9009, -85.5211, 50.0000, 0.0000, -82.7485, 1.0000),
+    (50.0000, 0.0000, 0.0000, 50.0000, -1.0000, 2.0000, 2.3669),
+    (50.0000, -1.0000, 2.0000, 50.0000, 0.0000, 0.0000, 2.3669),
+    (50.0000, 2.4900, -0.0010, 50.0000, -2.4900, 0.0009, 7.1792),
+    (50.0000, 2.4900, -0.0010, 50.0000, -2.4900, 0.0010, 7.1792),
+    (50.0000, 2.4900, -0.0010, 50.0000, -2.4900, 0.0011, 7.2195),
+    (50.0000, 2.4900, -0.0010, 50.0000, -2.4900, 0.0012, 7.2195),
+    (50.0000, -0.0010, 2.4900, 50.0000, 0.0009, -2.4900, 4.8045),
+    (50.0000, -0.0010, 2.4900, 50.0000, 0.0010, -2.4900, 4.8045),
+    (50.0000, -0.0010, 2.4900, 50.0000, 0.0011, -2.4900, 4.7461),
+    (50.0000, 2.5000, 0.0000, 50.0000, 0.0000, -2.5000, 4.3065),
+    (50.0000, 2.5000, 0.0000, 73.0000, 25.0000, -18.0000, 27.1492),
+    (50.0000, 2.5000, 0.0000, 61.0000, -5.0000, 29.0000, 22.8977),
+    (50.0000, 2.5000, 0.0000, 56.0000, -27.0000, -3.0000, 31.9030),
+    (50.0000, 2.5000, 0.0000, 58.0000, 24.0000, 15.0000, 19.4535),
+    (50.0000, 2.5000, 0.0000, 50.0000, 3.1736, 0.5854, 1.0000),
+    (50.0000, 2.5000, 0.0000, 50.0000, 3.2972, 0.0000, 1.0000),
+    (50.0000, 2.5000, 0.0000, 50.0000, 1.8634, 0.5757, 1.0000),
+    (50.0000, 2.5000, 0.0000, 50.0000, 3.2592, 0.3350, 1.0000),
+    (60.2574, -34.0099, 36.2677, 60.4626, -34.1751, 39.4387, 1.2644),
+    (63.0109, -31.0961, -5.8663, 62.8187, -29.7946, -4.0864, 1.2630),
+    (61.2901, 3.7196, -5.3901, 61.4292, 2.2480, -4.9620, 1.8731),
+    (35.0831, -44.1164, 3.7933, 35.0232, -40.0716, 1.5901, 1.8645),
+    (22.7233, 20.0904, -46.6940, 23.0331, 14.9730, -42.5619, 2.0373),
+    (36.4612, 47.8580, 18.3852, 36.2715, 50.5065, 21.2231, 1.4146),
+    (90.8027, -2.0831, 1.4410, 91.1528, -1.6435, 0.0447, 1.4441),
+    (90.9257, -0.5406, -0.9208, 88.6381, -0.8985, -0.7239, 1.5381),
+    (6.7747, -0.2908, -2.4247, 5.8714, -0.0985, -2.2286, 0.6377),
+    (2.0776, 0.0795, -1.1350, 0.9033, -0.0636, -0.5514, 0.9082),
+]
+
+
+class ColorIndexTests(TestCase):
+    """CIEDE2000 matches the published reference pairs, the palette follows the catalog version."""
+
+    def test_ciede2000_reference_pairs(self):
+        pairs = np.array(CIEDE2000_PAIRS)
+        np.testing.assert_allclose(delta_e2000(pairs[:, 0:3], pairs[:, 3:6]), pairs[:, 6], atol=1e-4)
+        # symmetric
+        np.testing.assert_allclose(delta_e2000(pairs[:, 3:6], pairs[:, 0:3]), pairs[:, 6], atol=1e-4)
+
+    def test_rgb_to_lab(self):
+        np.testing.assert_allclose(rgb_to_lab([[255, 255, 255], [0, 0, 0], [255, 0, 0]]),
+                                   [[100, 0, 0], [0, 0, 0], [53.2408, 80.0925, 67.2032]], atol=1e-2)
+
+    def test_rebuilt_on_catalog_change(self):
+        forget_catalog(self)
+        with self.captureOnCommitCallbacks(execute=True):
+            LegoColor.objects.create(ldraw_color_id=4, name='Red', hex_code='C91A09')
+        self.assertEqual([color.name for color in get_color_index().colors], ['Red'])
+        with self.captureOnCommitCallbacks(execute=True):
+            LegoColor.objects.create(ldraw_color_id=1, name='Blue', hex_code='0055BF')
+        index = get_color_index()
+        self.assertEqual(sorted(color.name for color in index.colors), ['Blue', 'Red'])
+        indices, _ = index.nearest(rgb_to_lab([[0, 80, 200]]))
+        self.assertEqual(index.colors[indices[0, 0]].name, 'Blue')
+
+
+class BuildabilityTests(TestCase):
+    """Sets are scored by exact matches, then by bricks of similar colors the set has not used yet."""
+
+    def setUp(self):
+        forget_catalog(self)
+        self.red = LegoColor.objects.create(ldraw_color_id=4, name='Red', hex_code='C91A09')
+        # within a CIEDE2000 distance of 2 from red
+        self.dark_red = LegoColor.objects.create(ldraw_color_id=320, name='Dark Red', hex_code='C01A0B')
+        self.blue = LegoColor.objects.create(ldraw_color_id=1, name='Blue', hex_code='0055BF')
+        self.brick = LegoPiece.objects.create(ldraw_id='3001', part_name='Brick 2 x 4')
+        self.plate = LegoPiece.objects.create(ldraw_id='3020', part_name='Plate 2 x 4')
+        self.lego_set = LegoSet.objects.create(name='6020-1')
+        for piece, color, quantity in ((self.brick, self.red, 4), (self.brick, self.dark_red, 2),
+                                       (self.plate, self.blue, 3)):
+            LegoPieces.objects.create(lego_set=self.lego_set, lego_piece=piece, lego_color=color, quantity=quantity)
+        self.index = BuildabilityIndex.build()
+
+    def rank(self, inventory, tolerance=0):
+        inventory = {(piece.pk, color.pk): quantity for piece, color, quantity in inventory}
+        return self.index.rank(inventory, tolerance)[1][0]
+
+    def test_exact_matches(self):
+        result = self.rank([(self.brick, self.red, 4), (self.brick, self.dark_red, 2), (self.plate, self.blue, 5)])
+        self.assertEqual((result['covered_pieces'], result['buildable'], result['shortfalls']), (9, True, []))
+
+    def test_shortfalls(self):
+        result = self.rank([(self.brick, self.red, 3), (self.plate, self.blue, 3)])
+        self.assertEqual(result['covered_pieces'], 6)
+        self.assertEqual(sorted((shortfall['lego_color_id'], shortfall['missing'])
+                                for shortfall in result['shortfalls']), [(self.red.pk, 1), (self.dark_red.pk, 2)])
+
+    def test_substitutions(self):
+        # the 2 red bricks left after the red line stand in for the dark red ones
+        result = self.rank([(self.brick, self.red, 6), (self.plate, self.blue, 3)], tolerance=2)
+        self.assertEqual((result['covered_pieces'], result['buildable']), (9, True))
+        self.assertEqual(self.rank([(self.brick, self.red, 5), (self.plate, self.blue, 3)], 2)['covered_pieces'], 8)
+        # bricks of a color too far away never substitute, nor count as spares of the red ones
+        result = self.rank([(self.brick, self.red, 4), (self.brick, self.blue, 10), (self.plate, self.blue, 3)], 2)
+        self.assertEqual(result['covered_pieces'], 7)
+        # a dark red line fills from the red bricks only once
+        LegoPieces.objects.filter(lego_color=self.red).update(quantity=1)
+        self.index = BuildabilityIndex.build()
+        self.assertEqual(self.rank([(self.brick, self.red, 2), (self.plate, self.blue, 3)], 2)['covered_pieces'], 5)
+
+
+class SetDiffTests(TestCase):
+    """Part lists are diffed by (piece, color) against the first set."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.red = LegoColor.objects.create(ldraw_color_id=4, name='Red')
+        cls.blue = LegoColor.objects.create(ldraw_color_id=1, name='Blue')
+        cls.brick = LegoPiece.objects.create(ldraw_id='3001', part_name='Brick 2 x 4', weight=2)
+        cls.plate = LegoPiece.objects.create(ldraw_id='3020', part_name='Plate 2 x 4', weight=1)
+        cls.tile = LegoPiece.objects.create(ldraw_id='3069b', part_name='Tile 1 x 2')
+        cls.custom = LegoPiece.objects.create(part_name='Sticker', custom_piece=True)
+        cls.base, cls.other, cls.empty, cls.also_empty = [LegoSet.objects.create(name=name) for name in
+                                                          ('6020-1', '6020-2', '6021-1', '6022-1')]
+        lines = ((cls.base, cls.brick, cls.red, 4), (cls.base, cls.plate, cls.blue, 2), (cls.base, cls.custom, None, 1),
+                 (cls.other, cls.brick, cls.red, 6), (cls.other, cls.plate, cls.blue, 2),
+                 (cls.other, cls.tile, cls.red, 3))
+        for lego_set, piece, color, quantity in lines:
+            LegoPieces.objects.create(lego_set=lego_set, lego_piece=piece, lego_color=color, quantity=quantity)
+
+    def lines(self, diff):
+        return sorted(zip(diff['lego_piece_ids'], diff['lego_color_ids'], diff['unit_weights'], diff['quantities']),
+                      key=lambda line: line[0])
+
+    def test_changes(self):
+        diff = diff_sets([self.base.pk, self.other.pk])
+        # the unchanged plate line is left out, removed custom pieces have no color
+        self.assertEqual(self.lines(diff), [(self.brick.pk, self.red.pk, 2, [4, 6]),
+                                            (self.tile.pk, self.red.pk, None, [0, 3]),
+                                            (self.custom.pk, None, None, [1, 0])])
+        self.assertEqual(diff_sets([self.base.pk, self.other.pk, self.empty.pk])['summaries'], [
+            {'lego_set_id': self.other.pk, 'added': 1, 'removed': 1, 'changed': 1, 'piece_delta': 4,
+             'weight_delta': 4.0},
+            {'lego_set_id': self.empty.pk, 'added': 0, 'removed': 3, 'changed': 0, 'piece_delta': -7,
+             'weight_delta': -10.0},
+        ])
+        self.assertEqual(len(diff_sets([self.base.pk, self.other.pk], include_unchanged=True)['quantities']), 4)
+
+    def test_empty_sets(self):
+        diff = diff_sets([self.empty.pk, self.base.pk])
+        self.assertEqual(diff['summaries'][0]['added'], 3)
+        diff = diff_sets([self.empty.pk, self.also_empty.pk])
+        self.assertEqual((diff['quantities'], diff['summaries'][0]['piece_delta']), ([], 0))
+        with self.assertRaises(ValueError):
+            diff_sets([self.base.pk, self.base.pk])
+
+    def test_query(self):
+        result = schema.execute('''query ($legoSets: [Int!]!) {
+          setDiff(legoSets: $legoSets) {
+            legoSets { name } quantities pieces { ldrawId }
+            summaries { legoSet { name } added removed changed pieceDelta }
+          }
+        }''', variable_values={'legoSets': [self.base.pk, self.other.pk]})
+        self.assertIsNone(result.errors)
+        diff = result.data['setDiff']
+        self.assertEqual(diff['legoSets'], [{'name': '6020-1'}, {'name': '6020-2'}])
+        self.assertEqual(len(diff['quantities']), 3)
+        self.assertEqual(diff['summaries'], [{'legoSet': {'name': '6020-2'}, 'added': 1, 'removed': 1, 'changed': 1,
+                                              'pieceDelta': 4}])
+
+
+def sequential_dither(lab, palette):
+    # textbook Floyd-Steinberg, one pixel at a time in row-major order
+    height, width = lab.shape[:2]
+    work = lab.astype(float).copy()
+    palette_norms = (palette ** 2).sum(axis=1)
+    indices = np.empty((height, width), dtype=int)
+    for y in range(height):
+        for x in range(width):
+            nearest = int(np.argmin(palette_norms - 2 * work[y, x] @ palette.T))
+            indices[y, x] = nearest
+            error = work[y, x] - palette[nearest]
+            for dy, dx, weight in ((0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)):
+                if 0 <= y + dy < height and 0 <= x + dx < width:
+                    work[y + dy, x + dx] += error * weight
+    return indices
+
+
+class MosaicTests(TestCase):
+    """Wavefront dithering matches sequential Floyd-Steinberg, undithered studs take their nearest color."""
+
+    def test_dither_matches_sequential(self):
+        rng = np.random.default_rng(0)
+        palette = rgb_to_lab(rng.integers(0, 256, (12, 3)))
+        for height, width in ((1, 9), (9, 1), (7, 11), (16, 5)):
+            lab = rgb_to_lab(rng.integers(0, 256, (height, width, 3)))
+            np.testing.assert_array_equal(dither(lab, palette), sequential_dither(lab, palette))
+
+    def test_palette_mapping(self):
+        colors = [LegoColor(pk=i + 1, name=name, hex_code=hex_code, material=LegoColor.LegoColorCategory.SOLID)
+                  for i, (name, hex_code) in enumerate([('White', 'FFFFFF'), ('Black', '1B2A34'),
+                                                        ('Red', 'C91A09'), ('Blue', '0055BF')])]
+        index = ColorIndex(colors)
+        # 2 x 3 blocks of 4 x 4 pixels, close to but not exactly the palette colors
+        blocks = np.array([[[250, 250, 250], [30, 40, 50], [200, 30, 10]],
+                           [[0, 80, 190], [190, 20, 20], [240, 255, 245]]])
+        image = np.repeat(np.repeat(blocks, 4, axis=0), 4, axis=1)
+        indices, _ = quantize(image, 3, use_dither=False, color_index=index)
+        self.assertEqual([[colors[i].name for i in row] for row in indices.tolist()],
+                         [['White', 'Black', 'Red'], ['Blue', 'Red', 'White']])
+        # a flat image of a palette color dithers to that color only
+        flat = np.tile(np.array([[[0x00, 0x55, 0xBF]]]), (6, 6, 1))
+        self.assertEqual(set(quantize(flat, 6, color_index=index)[0].ravel().tolist()), {3})
+
+
+class BundledSetTests(TestCase):
+    """The bundled part lists load with one row per distinct color and piece, as the row by row loader did."""
+
+    path = os.path.join(settings.BASE_DIR, 'lego', 'data', 'default_lego_sets', 'MAS003_RUDY_Partlist.csv')
+
+    def setUp(self):
+        forget_catalog(self)
+
+    def expected_rows(self):
+        # colors, pieces and part lines of the csv read without pandas, the 3 footer lines skipped
+        with open(self.path, newline='') as f:
+            rows = list(csv.DictReader(f))[:-3]
+        materials = {'Solid Colors': 'SO', 'Transparent Colors': 'TR'}
+        colors = {(int(row['BLColorId']), row['ColorName'], int(row['LDrawColorId']), materials[row['ColorCategory']])
+                  for row in rows if row['ElementId']}
+        pieces = {(row['PartName'][:64], int(float(row['Weight'])) if row['Weight'] else None, row['LdrawId'],
+                   row['BLItemNo'] or None, not row['ElementId']) for row in rows}
+        lines = [(row['LdrawId'], int(row['LDrawColorId']) if row['ElementId'] else None,
+                  int(row['ElementId']) if row['ElementId'] else None, int(row['Qty'])) for row in rows]
+        return sorted(colors), sorted(pieces, key=str), sorted(lines, key=str)
+
+    def loaded_rows(self):
+        colors = LegoColor.objects.values_list('bl_color_id', 'bl_color_name', 'ldraw_color_id', 'material')
+        pieces = LegoPiece.objects.values_list('part_name', 'weight', 'ldraw_id', 'bl_item_no', 'custom_piece')
+        lines = LegoPieces.objects.values_list('lego_piece__ldraw_id', 'lego_color__ldraw_color_id', 'element_id',
+                                               'quantity')
+        return sorted(colors), sorted(pieces, key=str), sorted(lines, key=str)
+
+    def test_load(self):
+        lego_sets = populate_sets([(lego_set_name_from_csv(self.path), read_lego_set_csv(self.path))])
+        self.assertEqual([lego_set.name for lego_set in LegoSet.objects.all()], ['MAS003_RUDY'])
+        self.assertEqual(lego_sets[0].pk, LegoSet.objects.get().pk)
+
+        colors, pieces, lines = self.loaded_rows()
+        self.assertEqual((colors, pieces, lines), self.expected_rows())
+        self.assertEqual((len(colors), len(pieces), len(lines)), (10, 44, 60))
+        # names longer than the column are cut
+        self.assertIn('Plate, Modified 1 x 2 with 1 Stud with Groove and Bottom Stud Ho',
+                      [piece[0] for piece in pieces])
+
+        # loading the file again fails on the set name and writes nothing
+        with self.assertRaises(IntegrityError):
+            populate_sets([(lego_set_name_from_csv(self.path), read_lego_set_csv(self.path))])
+        self.assertEqual(LegoSet.objects.count(), 1)
+        self.assertEqual(self.loaded_rows(), (colors, pieces, lines))
+
+
+class SyntheticCatalogTests(TestCase):
+    """Generated catalogs load through the loaders of the bundled data."""
+
+    def test_loads_catalog(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        counts = generate_catalog(directory, pieces=50, colors=20, sets=5, lines=100)
+        sets_dir = os.path.join(directory, 'default_lego_sets')
+
+        load_lego_colors_csv(os.path.join(directory, 'lego_colors.csv'))
+        load_lego_pieces_csv(os.path.join(directory, 'default_lego_pieces', 'synthetic_pieces.csv'))
+        load_lego_sets_csv([os.path.join(sets_dir, name) for name in sorted(os.listdir(sets_dir))])
+
+        self.assertEqual(LegoColor.objects.count(), counts['colors'])
+        self.assertEqual(LegoPiece.objects.count(), counts['pieces'])
+        self.assertEqual(LegoSet.objects.count(), counts['sets'])
+        self.assertEqual(LegoPieces.objects.count(), counts['lines'])
+        # every category, Nature (NA) included, survives the csv
+        self.assertEqual(set(LegoPiece.objects.values_list('category', flat=True)),
+                         set(LegoPiece.LegoPieceCategory.values))
+
+    def test_missing_ldraw_ids(self):
+        path = os.path.join(tempfile.mkdtemp(), 'pieces.csv')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('3001,Brick 2 x 4,BA,\n,Flower Stem,NA,\n,Tree,NA,Fir\n')
+
+        load_lego_pieces_csv(path)
+
+        # both pieces without an LDraw id store NULL, the Nature code NA stays a category
+        self.assertEqual(list(LegoPiece.objects.order_by('pk').values_list('ldraw_id', 'category', 'description')),
+                         [('3001', 'BA', ''), (None, 'NA', ''), (None, 'NA', 'Fir')])
+
+
+class SearchTests(TestCase):
+    """Pieces are found by prefixes and misspellings of their names, the closest matches first."""
+
+    def setUp(self):
+        forget_catalog(self)
+        self.plate = LegoPiece.objects.create(ldraw_id='3020', part_name='Plate 2 x 4')
+        self.plate_modified = LegoPiece.objects.create(ldraw_id='3176', part_name='Plate Modified 3 x 2 with Hole')
+        self.brick = LegoPiece.objects.create(ldraw_id='3001', part_name='Brick 2 x 4',
+                                              description='Brick, the size of two plates stacked')
+        self.tile = LegoPiece.objects.create(ldraw_id='3068b', part_name='Tile 2 x 2')
+
+    def search(self, query, first=20):
+        return [pk for pk, _ in search.get_part_search_index().search(query, first)]
+
+    def test_prefix(self):
+        # only the last token is a prefix, words typed so far match whole
+        self.assertEqual(set(self.search('pla')), {self.plate.pk, self.plate_modified.pk, self.brick.pk})
+        self.assertEqual(self.search('plate mod')[0], self.plate_modified.pk)
+        self.assertEqual(self.search('3068'), [self.tile.pk])
+
+    def test_typo(self):
+        self.assertEqual(self.search('plaet')[:2], [self.plate.pk, self.plate_modified.pk])
+        self.assertEqual(self.search('brikc 2x4')[0], self.brick.pk)
+        # numbers and dimensions only match exactly
+        self.assertEqual(self.search('3021'), [])
+        self.assertEqual(self.search('tile 2x3'), [self.tile.pk])
+
+    def test_ranking(self):
+        # the brick matches both tokens (plate as a prefix of its description), the modified plate only one
+        self.assertEqual(self.search('plate 2 x 4'), [self.plate.pk, self.brick.pk, self.plate_modified.pk])
+        self.assertEqual(self.search('3001'), [self.brick.pk])
+        self.assertEqual(self.search('2x4', first=1), [self.plate.pk])
+
+    def test_refresh(self):
+        self.search('plate')
+        # written pieces are re-read once the catalog version moves on
+        LegoPiece.objects.filter(pk=self.tile.pk).update(part_name='Plate 2 x 2')
+        lego_cache.bump_catalog_version(lego_pieces=[self.tile.pk])
+        self.assertIn(self.tile.pk, self.search('plate 2x2'))
+        self.assertEqual(self.search('tile'), [])
+
+    def test_migration_index(self):
+        # migration 0003 keeps its own copy of the index SQL, it must still match the vector queries build
+        if connection.vendor != 'postgresql':
+            self.skipTest('full text search index of PostgreSQL')
+        from django.contrib.postgres.indexes import GinIndex
+        migration = importlib.import_module('lego.migrations.0003_part_search_index')
+        with connection.schema_editor(collect_sql=True) as schema_editor:
+            schema_editor.add_index(LegoPiece, GinIndex(search.search_vector(), name=search.SEARCH_INDEX_NAME))
+        self.assertEqual(schema_editor.collected_sql, [migration.CREATE_SEARCH_INDEX])
+
+    def test_search_parts_query(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+                if cursor.fetchone() is None:
+                    self.skipTest('pg_trgm is not installed')
+        result = schema.execute('{ searchParts(query: "plate 2 x 4", first: 2) { ldrawId partName } }')
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['searchParts'][0], {'ldrawId': '3020', 'partName': 'Plate 2 x 4'})
+        self.assertEqual(len(result.data['searchParts']), 2)
+
+
+class IdMapTests(TestCase):
+    """Color and part ids translate between schemes and back, ids without a match are reported."""
+
+    def setUp(self):
+        forget_catalog(self)
+        self.red = LegoColor.objects.create(ldraw_color_id=4, bl_color_id=5, lego_id=21, name='Red')
+        self.blue = LegoColor.objects.create(ldraw_color_id=1, bl_color_id=7, lego_id=23, name='Blue')
+        # no BrickLink id
+        self.glitter = LegoColor.objects.create(ldraw_color_id=114, name='Glitter Trans-Dark Pink')
+        self.brick = LegoPiece.objects.create(ldraw_id='3001', bl_item_no='3001', part_name='Brick 2 x 4')
+        self.tile = LegoPiece.objects.create(ldraw_id='3068b', bl_item_no='3068', part_name='Tile 2 x 2')
+
+    def test_round_trip(self):
+        ids, unresolved = id_maps.translate_ids('color', [4, '1', 4], 'ldraw', 'bricklink')
+        self.assertEqual((ids, unresolved), ([5, 7, 5], []))
+        self.assertEqual(id_maps.translate_ids('color', ids, 'bricklink', 'ldraw'), ([4, 1, 4], []))
+        self.assertEqual(id_maps.translate_ids('color', [21, 23], 'lego', 'id'), ([self.red.pk, self.blue.pk], []))
+
+        ids, unresolved = id_maps.translate_ids('part', ['3068b', '3001'], 'ldraw', 'bricklink')
+        self.assertEqual((ids, unresolved), (['3068', '3001'], []))
+        self.assertEqual(id_maps.translate_ids('part', ids, 'bricklink', 'rebrickable'), (['3068b', '3001'], []))
+
+    def test_unresolved(self):
+        # unknown ids, ids that are not valid in their column, and rows without a target id
+        ids, unresolved = id_maps.translate_ids('color', [4, 999, 'red', None, 114], 'ldraw', 'bricklink')
+        self.assertEqual(ids, [5, None, None, None, None])
+        self.assertEqual(unresolved, [999, 'red', None, 114])
+        self.assertEqual(id_maps.translate_ids('part', ['3068', '3068b'], 'ldraw', 'bricklink'),
+                         ([None, '3068'], ['3068']))
+
+    def test_duplicate_ids(self):
+        # duplicate ids resolve to the lowest pk
+        LegoColor.objects.create(ldraw_color_id=4, bl_color_id=6, name='Red (duplicate)')
+        self.assertEqual(id_maps.resolve_ids('color', 'ldraw', [4]), {4: self.red.pk})
+        self.assertEqual(id_maps.translate_ids('color', [4], 'ldraw', 'bricklink'), ([5], []))
+
+    def test_written_rows(self):
+        id_maps.get_id_maps()
+        # rows of the current transaction resolve before the maps catch up
+        plate = LegoPiece.objects.create(ldraw_id='3020', bl_item_no='3020', part_name='Plate 2 x 4')
+        self.assertEqual(id_maps.resolve_ids('part', 'ldraw', ['3020']), {'3020': plate.pk})
+
+        # changed ids are re-read once the catalog version moves on
+        LegoPiece.objects.filter(pk=self.tile.pk).update(bl_item_no='3068b')
+        lego_cache.bump_catalog_version(lego_pieces=[self.tile.pk])
+        self.assertEqual(id_maps.translate_ids('part', ['3068b', '3068'], 'bricklink', 'ldraw'),
+                         (['3068b', None], ['3068']))
+
+    def test_translate_ids_query(self):
+        result = schema.execute('''{
+          translateIds(kind: COLOR, source: LDRAW, target: BRICKLINK, ids: ["4", "1", "999"]) { ids unresolved }
+        }''')
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['translateIds'], {'ids': ['5', '7', None], 'unresolved': ['999']})
+
+        result = schema.execute('{ translateIds(kind: PART, source: LEGO, target: LDRAW, ids: ["3001"]) { ids } }')
+        self.assertEqual(result.errors[0].message, 'part ids have no lego scheme.')
+
+
+class SetAggregateTests(TestCase):
+    """Piece counts, weights and color breakdowns of the part lists are stored on their sets."""
+
+    def setUp(self):
+        forget_catalog(self)
+        self.red = LegoColor.objects.create(ldraw_color_id=4, name='Red')
+        self.blue = LegoColor.objects.create(ldraw_color_id=1, name='Blue')
+        self.brick = LegoPiece.objects.create(ldraw_id='3001', part_name='Brick 2 x 4', weight=2)
+        self.plate = LegoPiece.objects.create(ldraw_id='3020', part_name='Plate 2 x 4', weight=1)
+        # weight unknown
+        self.tile = LegoPiece.objects.create(ldraw_id='3068b', part_name='Tile 2 x 2')
+        self.lego_set = LegoSet.objects.create(name='6020-1')
+        self.empty_set = LegoSet.objects.create(name='6021-1')
+        for piece, color, quantity in ((self.brick, self.red, 4), (self.brick, self.blue, 2), (self.plate, self.red, 3),
+                                       (self.tile, None, 5)):
+            LegoPieces.objects.create(lego_set=self.lego_set, lego_piece=piece, lego_color=color, quantity=quantity)
+
+    def aggregates(self, lego_set):
+        lego_set.refresh_from_db()
+        colors = sorted((row.lego_color_id or 0, row.quantity) for row in lego_set.colors.all())
+        return lego_set.total_pieces, lego_set.unique_pieces, lego_set.unique_parts, lego_set.total_weight, colors
+
+    def test_update(self):
+        self.assertEqual(update_set_aggregates([self.lego_set.pk, self.empty_set.pk]), 2)
+        self.assertEqual(self.aggregates(self.lego_set), (14, 4, 3, 4 * 2 + 2 * 2 + 3 * 1,
+                                                          [(0, 5), (self.red.pk, 7), (self.blue.pk, 2)]))
+        self.assertEqual(self.aggregates(self.empty_set), (0, 0, 0, 0, []))
+
+        # every set at once gives the same rows
+        LegoSet.objects.update(total_pieces=0)
+        LegoSetColor.objects.all().delete()
+        self.assertEqual(update_set_aggregates(), 2)
+        self.assertEqual(self.aggregates(self.lego_set)[0], 14)
+        self.assertEqual(len(self.aggregates(self.lego_set)[4]), 3)
+
+        # emptied part lists drop back to zero
+        LegoPieces.objects.filter(lego_set=self.lego_set).delete()
+        update_set_aggregates([self.lego_set.pk])
+        self.assertEqual(self.aggregates(self.lego_set), (0, 0, 0, 0, []))
+
+    def test_on_commit(self):
+        # saved lines update their set, saved pieces every set using them
+        with self.captureOnCommitCallbacks(execute=True):
+            LegoPieces.objects.create(lego_set=self.empty_set, lego_piece=self.brick, lego_color=self.red, quantity=1)
+        self.assertEqual(self.aggregates(self.empty_set), (1, 1, 1, 2, [(self.red.pk, 1)]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tile.weight = 3
+            self.tile.save()
+        self.assertEqual(self.aggregates(self.lego_set)[3], 15 + 5 * 3)
+        self.assertEqual(self.aggregates(self.empty_set)[3], 2)
+
+    def test_moved_and_deleted_lines(self):
+        update_set_aggregates()
+        line = LegoPieces.objects.get(lego_set=self.lego_set, lego_piece=self.plate)
+        # sets pended by the writes of setUp, whose transaction never commits
+        patcher = mock.patch.object(signals, '_pending_aggregates', threading.local())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # a line moved to another set refreshes both sets, not the whole catalog
+        with mock.patch('lego.signals.update_set_aggregates', wraps=update_set_aggregates) as update, \
+                self.captureOnCommitCallbacks(execute=True):
+            line.lego_set = self.empty_set
+            line.save()
+        update.assert_called_once_with({self.lego_set.pk, self.empty_set.pk})
+        self.assertEqual(self.aggregates(self.lego_set)[:4], (11, 3, 2, 4 * 2 + 2 * 2))
+        self.assertEqual(self.aggregates(self.empty_set), (3, 1, 1, 3, [(self.red.pk, 3)]))
+        self.assertEqual(list(LegoPartUsageSet.objects.filter(lego_piece=self.plate)
+                              .values_list('lego_set_id', flat=True)), [self.empty_set.pk])
+
+        # so does deleting a single line
+        with mock.patch('lego.signals.update_set_aggregates', wraps=update_set_aggregates) as update, \
+                self.captureOnCommitCallbacks(execute=True):
+            line.delete()
+        update.assert_called_once_with({self.empty_set.pk})
+        self.assertEqual(self.aggregates(self.empty_set), (0, 0, 0, 0, []))
+        self.assertFalse(LegoPartUsage.objects.filter(lego_piece=self.plate).exists())
+
+        # and the bulk delete of the admin
+        with self.captureOnCommitCallbacks(execute=True):
+            LegoPiecesAdmin(LegoPieces, admin.site).delete_queryset(None,
+                                                                    LegoPieces.objects.filter(lego_piece=self.brick))
+        self.assertEqual(self.aggregates(self.lego_set), (5, 1, 1, 0, [(0, 5)]))
+
+    def test_colors_query(self):
+        update_set_aggregates()
+        # the sets, then the breakdown of every set with its colors joined
+        with self.assertNumQueries(2):
+            result = schema.execute('''{
+              legoSets(first: 10) { name totalWeight colors { quantity legoColor { name } } }
+            }''')
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['legoSets'][0], {'name': '6020-1', 'totalWeight': 15, 'colors': [
+            {'quantity': 7, 'legoColor': {'name': 'Red'}},
+            {'quantity': 5, 'legoColor': None},
+            {'quantity': 2, 'legoColor': {'name': 'Blue'}},
+        ]})
+        self.assertEqual(result.data['legoSets'][1]['colors'], [])
+
+        # colors do not list the sets using them, partUsage pages those
+        result = schema.execute('{ legoColor(first: 1) { LegoSetColors { quantity } } }')
+        self.assertIn("Cannot query field 'LegoSetColors'", result.errors[0].message)
+
+
+class PartUsageTests(TestCase):
+    """The usage index follows part list writes, nested usage and top sets load for a whole page at once."""
+
+    def setUp(self):
+        forget_catalog(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.red = LegoColor.objects.create(ldraw_color_id=4, bl_color_id=5, name='Red', material='SO')
+        self.blue = LegoColor.objects.create(ldraw_color_id=1, bl_color_id=7, name='Blue', material='SO')
+        self.brick = LegoPiece.objects.create(ldraw_id='3001', bl_item_no='3001', part_name='Brick 2 x 4')
+        self.plate = LegoPiece.objects.create(ldraw_id='3020', bl_item_no='3020', part_name='Plate 2 x 4')
+        # element ids are unique across every part list
+        self.element_ids = iter(range(6000000, 7000000))
+
+    def part_list(self, name, lines):
+        # a part list csv in the format of the bundled sets, lines of (piece, color, quantity)
+        path = os.path.join(self.directory, f'{name}_Partlist.csv')
+        rows = ['BLItemNo,ElementId,LdrawId,PartName,BLColorId,LDrawColorId,ColorName,ColorCategory,Qty,Weight']
+        rows += [f'{piece.bl_item_no},{next(self.element_ids)},{piece.ldraw_id},{piece.part_name},'
+                 f'{color.bl_color_id},{color.ldraw_color_id},{color.name},Solid Colors,{quantity},1'
+                 for piece, color, quantity in lines]
+        rows += [',,,,,,,,,', 'Total qty,Total Weight,,,,,,,,', '0,0,,,,,,,,']
+        with open(path, 'w') as f:
+            f.write('\n'.join(rows) + '\n')
+        return path
+
+    def usage(self):
+        return sorted((piece, color, set_count, quantity) for piece, color, set_count, quantity in
+                      LegoPartUsage.objects.values_list('lego_piece_id', 'lego_color_id', 'set_count',
+                                                        'total_quantity'))
+
+    def test_loaded_synced_deleted(self):
+        brick, plate, red, blue = self.brick.pk, self.plate.pk, self.red.pk, self.blue.pk
+        with self.captureOnCommitCallbacks(execute=True):
+            load_lego_sets_csv([self.part_list('6020', [(self.brick, self.red, 4), (self.plate, self.red, 2)]),
+                                self.part_list('6021', [(self.brick, self.red, 1)])])
+        self.assertEqual(self.usage(), [(brick, red, 2, 5), (plate, red, 1, 2)])
+
+        # the plate moves to blue and the brick quantity changes
+        with self.captureOnCommitCallbacks(execute=True):
+            sync_lego_set_csv(self.part_list('6020', [(self.brick, self.red, 3), (self.plate, self.blue, 2)]))
+        self.assertEqual(self.usage(), [(brick, red, 2, 4), (plate, blue, 1, 2)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            LegoSet.objects.get(name='6020').delete()
+        self.assertEqual(self.usage(), [(brick, red, 1, 1)])
+        self.assertEqual(set(LegoPartUsageSet.objects.values_list('lego_set__name', flat=True)), {'6021'})
+
+    def test_full_refresh(self):
+        lego_sets = [LegoSet.objects.create(name=f'{6020 + i}-1') for i in range(3)]
+        for lego_set in lego_sets:
+            LegoPieces.objects.create(lego_set=lego_set, lego_piece=self.brick, lego_color=self.red, quantity=1)
+        update_part_usage()
+        # every part list changes, only two of them are reported
+        LegoPieces.objects.update(quantity=2)
+
+        with mock.patch.object(aggregates, 'BATCH_SIZE', 1):
+            update_part_usage([lego_sets[0].pk])
+            self.assertEqual(self.usage(), [(self.brick.pk, self.red.pk, 3, 4)])
+            # more than a tenth of the sets changed, the index is rebuilt from every part list
+            update_part_usage([lego_sets[0].pk, lego_sets[1].pk])
+            self.assertEqual(self.usage(), [(self.brick.pk, self.red.pk, 3, 6)])
+
+    def test_nested_usage_queries(self):
+        # three red sets and a blue one, the plate one piece more per set than the brick
+        for i, color in enumerate([self.red, self.red, self.red, self.blue]):
+            lego_set = LegoSet.objects.create(name=f'{6020 + i}-1')
+            for piece, quantity in ((self.brick, i + 1), (self.plate, i + 2)):
+                LegoPieces.objects.create(lego_set=lego_set, lego_piece=piece, lego_color=color, quantity=quantity)
+        update_part_usage()
+
+        # the pieces, then the usage of every piece and the top sets of every usage row, per alias
+        with self.assertNumQueries(5):
+            result = schema.execute('''query($order: LegoPartUsageOrder) {
+              legoPiece(first: 100) {
+                ldrawId
+                partUsage { legoColor { name } setCount topSets(first: 1) { quantity legoSet { name } } }
+                top: partUsage(first: 1, orderBy: $order) { totalQuantity topSets { quantity } }
+              }
+            }''', variable_values={'order': 'TOTAL_QUANTITY'})
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['legoPiece'][0], {
+            'ldrawId': '3001',
+            'partUsage': [
+                {'legoColor': {'name': 'Red'}, 'setCount': 3,
+                 'topSets': [{'quantity': 3, 'legoSet': {'name': '6022-1'}}]},
+                {'legoColor': {'name': 'Blue'}, 'setCount': 1,
+                 'topSets': [{'quantity': 4, 'legoSet': {'name': '6023-1'}}]},
+            ],
+            'top': [{'totalQuantity': 4, 'topSets': [{'quantity': 4}]}],
+        })
+        self.assertEqual(result.data['legoPiece'][1]['partUsage'][0]['topSets'][0]['quantity'], 4)
+
+        # pages are cut per color
+        with self.assertNumQueries(2):
+            result = schema.execute('''{
+              legoColor(first: 10) {
+                name
+                partUsage(first: 1, offset: 1, orderBy: TOTAL_QUANTITY_DESC) { legoPiece { ldrawId } totalQuantity }
+              }
+            }''')
+        self.assertEqual({color['name']: color['partUsage'] for color in result.data['legoColor']},
+                         {'Red': [{'legoPiece': {'ldrawId': '3001'}, 'totalQuantity': 6}],
+                          'Blue': [{'legoPiece': {'ldrawId': '3001'}, 'totalQuantity': 4}]})
+
+        # and per piece joined to the part lists
+        with self.assertNumQueries(3):
+            result = schema.execute('''{
+              allLegoPieces(first: 8) {
+                edges { node { legoPiece { partUsage(first: 1) { topSets { quantity } } } } }
+              }
+            }''')
+        self.assertIsNone(result.errors)
+        self.assertEqual(len(result.data['allLegoPieces']['edges']), 8)
+
+
+class ParallelIngestTests(TransactionTestCase):
+    """Files are parsed in worker processes and committed by one writer, failures are reported per file."""
+
+    def setUp(self):
+        forget_catalog(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def pieces_csv(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_failures_per_file(self):
+        LegoPiece.objects.create(ldraw_id='3005', part_name='Brick 1 x 1')
+        csv_files = [
+            self.pieces_csv('bricks.csv', '3001,Brick 2 x 4,BA,\n3010,Brick 1 x 4,BA,\n'),
+            # a row with more fields than the first, fails to parse
+            self.pieces_csv('broken.csv', '3020,Plate 2 x 4,BA,\n3021,Plate 2 x 3,BA,,extra,fields\n'),
+            # a piece already loaded, fails to write whichever file the workers finish first
+            self.pieces_csv('duplicate.csv', '3005,Brick 1 x 1 (again),BA,\n'),
+            self.pieces_csv('plates.csv', '3024,Plate 1 x 1,BA,\n'),
+        ]
+        output = StringIO()
+        failures = ingest_files(read_lego_pieces_csv, lambda files: populate_pieces(pd.concat(
+            [df for _, df in files], ignore_index=True)), csv_files, workers=2, log=OutputWrapper(output))
+
+        self.assertEqual(sorted(os.path.basename(path) for path in failures), ['broken.csv', 'duplicate.csv'])
+        self.assertIsInstance(failures[csv_files[1]], pd.errors.ParserError)
+        # the batch failed on the duplicate, the other files were retried one by one and committed
+        self.assertEqual(sorted(LegoPiece.objects.values_list('ldraw_id', 'part_name')),
+                         [('3001', 'Brick 2 x 4'), ('3005', 'Brick 1 x 1'), ('3010', 'Brick 1 x 4'),
+                          ('3024', 'Plate 1 x 1')])
+        self.assertEqual(sorted(re.findall(r'Processed File: .*/(\w+\.csv)', output.getvalue())),
+                         ['bricks.csv', 'plates.csv'])
+
+    def test_workers_option(self):
+        for workers in ('-1', 'two'):
+            with self.assertRaisesMessage(CommandError, 'one per core'):
+                call_command('init_default_lego_pieces', '--workers', workers, '--lego_piece_dir', self.directory)
+        self.assertEqual(worker_count('0'), 0)
+        self.assertEqual(worker_count('3'), 3)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class MetricsTests(TestCase):
+    """Requests are profiled into the /metrics histograms, slow ones are logged with their repeated SQL."""
+
+    def setUp(self):
+        CachedGraphQLView.response_cache.clear()
+        self.addCleanup(CachedGraphQLView.response_cache.clear)
+        forget_catalog(self)
+
+    def test_sql_pattern(self):
+        self.assertEqual(metrics.sql_pattern('SELECT 1 FROM t WHERE id IN (%s, %s, %s) LIMIT 21'),
+                         metrics.sql_pattern('SELECT 1 FROM t WHERE id IN (%s) LIMIT 5'))
+
+    def test_repeated_queries(self):
+        profile = metrics.RequestProfile()
+        for pk in (1, 2, 3):
+            profile.add_query(f'SELECT 1 FROM t WHERE id = {pk}', 0.001)
+        profile.add_query('SELECT 1 FROM u', 0.001)
+        self.assertEqual([(pattern, count) for pattern, count, _ in profile.repeated_queries()],
+                         [('SELECT N FROM t WHERE id = N', 3)])
+
+    def test_slow_request(self):
+        lego_set = LegoSet.objects.create(name='6020-1')
+        for i in range(3):
+            piece = LegoPiece.objects.create(ldraw_id=str(3001 + i), part_name=f'Brick {i}')
+            LegoPieces.objects.create(lego_set=lego_set, lego_piece=piece, quantity=1)
+        # refreshed on commit otherwise
+        update_part_usage()
+        query = '{ partUsage(first: 10) { setCount topSets(first: 1) { quantity } } }'
+
+        with mock.patch.object(metrics, 'SLOW_REQUEST_SECONDS', 0), self.assertLogs('lego.metrics') as logs:
+            response = self.client.post('/lego/graphql', json.dumps({'query': query}),
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        # the top sets of every usage row are loaded with the rows, in one statement
+        self.assertIn('resolver LegoPartUsageType.topSets (partUsage.topSets): 3 calls', logs.output[0])
+        self.assertNotIn('repeated SQL', logs.output[0])
+
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('lego_graphql_resolver_calls_count{field="LegoPartUsageType.topSets"}', body)
+        self.assertIn('lego_request_sql_queries_count{route="lego/graphql",cached="false"}', body)
+
+    def test_cached_request(self):
+        query = json.dumps({'query': '{ legoSets(first: 10) { name } }'})
+        for _ in range(2):
+            response = self.client.post('/lego/graphql', query, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+
+        # the second response came from the response cache, without running its resolvers
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('lego_request_duration_seconds_count{route="lego/graphql",cached="true"}', body)
+
+    def test_restricted(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.7').status_code, 403)
+        with mock.patch.object(metrics, 'ALLOWED_NETWORKS', [ipaddress.ip_network('203.0.113.0/24')]):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.7').status_code, 200)
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
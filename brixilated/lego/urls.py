@@ -1,10 +1,18 @@
 from django.urls import path
 from django.views.decorators.csrf import csrf_exempt
 
-from graphene_django.views import GraphQLView
+from lego.metrics import ResolverTimingMiddleware
 from lego.schema import schema
+from lego.views import AsyncGraphQLView, CachedGraphQLView
+from lego.validation import get_validation_rules
 
 
 urlpatterns = [
-    path('graphql', csrf_exempt(GraphQLView.as_view(graphiql=True, schema=schema))),
+    path('graphql', csrf_exempt(CachedGraphQLView.as_view(graphiql=True, schema=schema,
+                                                        validation_rules=get_validation_rules(),
+                                                        middleware=[ResolverTimingMiddleware()]))),
+    # same schema for ASGI servers, requests wait on the event loop instead of a worker thread
+    path('graphql/async', csrf_exempt(AsyncGraphQLView.as_view(graphiql=True, schema=schema,
+                                                              validation_rules=get_validation_rules(),
+                                                              middleware=[ResolverTimingMiddleware()]))),
 ]
\ No newline at end of file
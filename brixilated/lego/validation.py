@@ -0,0 +1,98 @@
+from typing import Optional
+
+from django.conf import settings
+from graphene.validation import depth_limit_validator
+from graphene_django.settings import graphene_settings
+from graphql import GraphQLError, get_named_type, get_nullable_type, is_list_type, specified_rules
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode, IntValueNode, SelectionSetNode
+from graphql.validation import ValidationContext, ValidationRule
+
+
+def query_cost_validator(max_cost: int, default_list_size: int):
+    """
+    Rejects operations whose estimated cost exceeds max_cost. Every resolved object costs 1,
+    and everything below a list or connection is multiplied by its `first`/`last` argument
+    (or default_list_size when no literal page size is given, e.g. a variable).
+    """
+
+    class QueryCostValidator(ValidationRule):
+
+        def __init__(self, context: ValidationContext):
+            super().__init__(context)
+            self.schema = context.schema
+
+        @staticmethod
+        def page_size(node: FieldNode) -> Optional[int]:
+            for argument in node.arguments:
+                if argument.name.value in ('first', 'last') and isinstance(argument.value, IntValueNode):
+                    return int(argument.value.value)
+            return None
+
+        def list_size(self, node: FieldNode) -> int:
+            # first: 0 is an empty page, not a missing one
+            size = self.page_size(node)
+            return default_list_size if size is None else size
+
+        def selection_cost(self, parent_type, selection_set: SelectionSetNode, connection_size: Optional[int],
+                           visited: frozenset) -> int:
+            cost = 0
+            for selection in selection_set.selections:
+                if isinstance(selection, FragmentSpreadNode):
+                    name = selection.name.value
+                    fragment = self.context.get_fragment(name)
+                    if fragment is not None and name not in visited:
+                        fragment_type = self.schema.get_type(fragment.type_condition.name.value)
+                        cost += self.selection_cost(fragment_type, fragment.selection_set, connection_size,
+                                                    visited | {name})
+                elif isinstance(selection, InlineFragmentNode):
+                    fragment_type = parent_type
+                    if selection.type_condition:
+                        fragment_type = self.schema.get_type(selection.type_condition.name.value)
+                    cost += self.selection_cost(fragment_type, selection.selection_set, connection_size, visited)
+                elif isinstance(selection, FieldNode):
+                    cost += self.field_cost(parent_type, selection, connection_size, visited)
+            return cost
+
+        def field_cost(self, parent_type, node: FieldNode, connection_size: Optional[int], visited: frozenset) -> int:
+            name = node.name.value
+            fields = getattr(parent_type, 'fields', {})
+            if name.startswith('__') or name not in fields:
+                return 0
+
+            field_type = fields[name].type
+            named_type = get_named_type(field_type)
+
+            # connections apply their page size to the edges below them
+            size = 1
+            if is_list_type(get_nullable_type(field_type)):
+                if name == 'edges' and connection_size is not None:
+                    size = connection_size
+                else:
+                    size = self.list_size(node)
+            if named_type.name.endswith('Connection'):
+                connection_size = self.list_size(node)
+
+            child_cost = 0
+            if node.selection_set:
+                child_cost = self.selection_cost(named_type, node.selection_set, connection_size, visited)
+            return size * (1 + child_cost)
+
+        def enter_operation_definition(self, node, *_args):
+            root_type = self.schema.get_root_type(node.operation)
+            cost = self.selection_cost(root_type, node.selection_set, None, frozenset())
+            if cost > max_cost:
+                name = node.name.value if node.name else 'anonymous'
+                self.report_error(GraphQLError(
+                    f"'{name}' exceeds maximum query cost of {max_cost} (estimated cost {cost}).", node))
+
+    return QueryCostValidator
+
+
+def get_validation_rules() -> list:
+    limits = getattr(settings, 'LEGO_GRAPHQL', {})
+    return [
+        *specified_rules,
+        depth_limit_validator(max_depth=limits.get('MAX_DEPTH', 10)),
+        query_cost_validator(max_cost=limits.get('MAX_COST', 50000),
+                             default_list_size=graphene_settings.RELAY_CONNECTION_MAX_LIMIT),
+    ]
@@ -1,3 +1,250 @@
-from django.shortcuts import render
+import json
+import asyncio
+import hashlib
+from inspect import isawaitable
+from typing import Any, Optional, Tuple
 
-# Create your views here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed
+from graphene_django.views import GraphQLView, HttpError
+from graphql import ExecutionResult, GraphQLError, OperationDefinitionNode, OperationType, Undefined, execute, \
+    get_operation_ast, parse, validate
+from graphql.execution import ExecutionContext
+from graphql.execution.collect_fields import collect_fields
+from graphql.pyutils import Path
+from graphene_django.settings import graphene_settings
+
+from lego.cache import LRUCache, get_catalog_version
+from lego.metrics import mark_cached, metrics_allowed, render_metrics
+
+PERSISTED_QUERY_KEY = 'lego:persisted_query:{}'
+
+_limits = getattr(settings, 'LEGO_GRAPHQL', {})
+
+
+class CachedGraphQLView(GraphQLView):
+    """
+    GraphQLView that caches parsed and validated documents by query hash, caches the results of
+    read-only queries until the catalog changes (see lego.signals), and accepts automatic
+    persisted queries (extensions.persistedQuery.sha256Hash) in place of the query text.
+    """
+
+    # views are instantiated per request, so the caches live on the class
+    document_cache = LRUCache(max_size=_limits.get('DOCUMENT_CACHE_SIZE', 1024))
+    response_cache = LRUCache(max_size=_limits.get('RESPONSE_CACHE_SIZE', 1024),
+                              ttl=_limits.get('RESPONSE_CACHE_TTL', 300))
+
+    @staticmethod
+    def get_persisted_query_hash(request, data) -> Optional[str]:
+        extensions = request.GET.get('extensions') or data.get('extensions')
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                return None
+        persisted_query = (extensions or {}).get('persistedQuery') or {}
+        return persisted_query.get('sha256Hash')
+
+    def resolve_query(self, request, data, query: str) -> Tuple[Optional[str], Optional[str]]:
+        # returns the query text and its sha256, registering or looking up persisted queries
+        persisted_hash = self.get_persisted_query_hash(request, data)
+        if not query:
+            if persisted_hash is None:
+                return None, None
+            query = cache.get(PERSISTED_QUERY_KEY.format(persisted_hash))
+            if query is None:
+                raise GraphQLError('PersistedQueryNotFound', extensions={'code': 'PERSISTED_QUERY_NOT_FOUND'})
+            return query, persisted_hash
+
+        query_hash = hashlib.sha256(query.encode('utf-8')).hexdigest()
+        if persisted_hash is not None:
+            if persisted_hash != query_hash:
+                raise GraphQLError('Provided sha256Hash does not match query.')
+            cache.set(PERSISTED_QUERY_KEY.format(query_hash), query, timeout=None)
+        return query, query_hash
+
+    def get_document(self, query: str, query_hash: str):
+        # (document, validation errors), None when the query could not be parsed
+        entry = self.document_cache.get(query_hash)
+        if entry is None:
+            try:
+                document = parse(query)
+            except Exception:
+                return None
+            errors = validate(self.schema.graphql_schema, document, self.validation_rules,
+                              graphene_settings.MAX_VALIDATION_ERRORS)
+            entry = (document, errors)
+            self.document_cache.set(query_hash, entry)
+        return entry
+
+    def prepare_query(self, request, data, query: str, operation_name: str):
+        # query text, hash, cached (document, validation errors) and operation of a request
+        query, query_hash = self.resolve_query(request, data, query)
+        entry = self.get_document(query, query_hash) if query else None
+        operation_ast = get_operation_ast(entry[0], operation_name) if entry else None
+        return query, query_hash, entry, operation_ast
+
+    @staticmethod
+    def get_cache_key(query_hash: str, variables: Optional[dict], operation_name: Optional[str]) -> tuple:
+        return (query_hash, json.dumps(variables, sort_keys=True, default=str), operation_name,
+                get_catalog_version())
+
+    def get_execute_options(self, request, variables: Optional[dict], operation_name: Optional[str]) -> dict:
+        execute_options = {
+            'root_value': self.get_root_value(request),
+            'context_value': self.get_context(request),
+            'variable_values': variables,
+            'operation_name': operation_name,
+            'middleware': self.get_middleware(request),
+        }
+        if self.execution_context_class:
+            execute_options['execution_context_class'] = self.execution_context_class
+        return execute_options
+
+    def cache_result(self, key: tuple, result: ExecutionResult) -> None:
+        # errors may be transient, only complete results are reused
+        if not result.errors:
+            self.response_cache.set(key, result)
+
+    def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+        try:
+            query, query_hash, entry, operation_ast = self.prepare_query(request, data, query, operation_name)
+        except GraphQLError as e:
+            return ExecutionResult(data=None, errors=[e])
+
+        if operation_ast is None or operation_ast.operation != OperationType.QUERY:
+            # missing/invalid queries, mutations and subscriptions take the uncached path
+            return super().execute_graphql_request(request, data, query, variables, operation_name,
+                                                   show_graphiql)
+
+        document, validation_errors = entry
+        if validation_errors:
+            return ExecutionResult(data=None, errors=validation_errors)
+
+        key = self.get_cache_key(query_hash, variables, operation_name)
+        result = self.response_cache.get(key)
+        if result is None:
+            try:
+                result = execute(self.schema.graphql_schema, document,
+                                 **self.get_execute_options(request, variables, operation_name))
+            except Exception as e:
+                return ExecutionResult(errors=[e])
+            self.cache_result(key, result)
+        else:
+            mark_cached()
+        return result
+
+
+class ThreadedExecutionContext(ExecutionContext):
+    """
+    Resolves every top-level field of a query in its own worker thread. The resolvers (and the
+    ORM below them) stay synchronous, while independent root fields query the database
+    concurrently and the event loop is never blocked.
+    """
+
+    def execute_operation(self, operation: OperationDefinitionNode, root_value: Any):
+        if operation.operation != OperationType.QUERY:
+            return super().execute_operation(operation, root_value)
+
+        root_type = self.schema.query_type
+        root_fields = collect_fields(self.schema, self.fragments, self.variable_values, root_type,
+                                     operation.selection_set)
+        return self.execute_root_fields(root_type, root_value, root_fields)
+
+    def execute_root_field(self, root_type, root_value: Any, response_name: str, field_nodes: list) -> Any:
+        try:
+            return self.execute_field(root_type, root_value, field_nodes, Path(None, response_name, root_type.name))
+        finally:
+            # worker threads hold their own connections, honour CONN_MAX_AGE like a request would
+            close_old_connections()
+
+    async def execute_root_fields(self, root_type, root_value: Any, fields: dict) -> dict:
+        execute_root_field = sync_to_async(self.execute_root_field, thread_sensitive=False)
+        results = await asyncio.gather(*(execute_root_field(root_type, root_value, response_name, field_nodes)
+                                         for response_name, field_nodes in fields.items()))
+        return {response_name: result for response_name, result in zip(fields, results) if result is not Undefined}
+
+
+class AsyncGraphQLView(CachedGraphQLView):
+    """
+    Async variant of CachedGraphQLView for ASGI servers: queries are executed with
+    ThreadedExecutionContext while the request itself waits on the event loop. Mutations,
+    batches and GraphiQL are handed to the synchronous view in a thread.
+    """
+
+    view_is_async = True
+    execution_context_class = ThreadedExecutionContext
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            if request.method.lower() not in ('get', 'post'):
+                raise HttpError(HttpResponseNotAllowed(['GET', 'POST'],
+                                                       'GraphQL only supports GET and POST requests.'))
+
+            data = self.parse_body(request)
+            if self.batch or (self.graphiql and self.can_display_graphiql(request, data)):
+                return await sync_to_async(super().dispatch)(request, *args, **kwargs)
+
+            result, status_code = await self.get_response_async(request, data)
+            return HttpResponse(status=status_code, content=result, content_type='application/json')
+
+        except HttpError as e:
+            response = e.response
+            response['Content-Type'] = 'application/json'
+            response.content = self.json_encode(request, {'errors': [self.format_error(e)]})
+            return response
+
+    async def get_response_async(self, request, data):
+        query, variables, operation_name, _ = self.get_graphql_params(request, data)
+        execution_result = await self.execute_graphql_request_async(request, data, query, variables,
+                                                                    operation_name)
+
+        response = {}
+        status_code = 200
+        if execution_result.errors:
+            response['errors'] = [self.format_error(e) for e in execution_result.errors]
+        if execution_result.errors and any(not getattr(e, 'path', None) for e in execution_result.errors):
+            status_code = 400
+        else:
+            response['data'] = execution_result.data
+        return self.json_encode(request, response), status_code
+
+    async def execute_graphql_request_async(self, request, data, query, variables, operation_name):
+        try:
+            query, query_hash, entry, operation_ast = self.prepare_query(request, data, query, operation_name)
+        except GraphQLError as e:
+            return ExecutionResult(data=None, errors=[e])
+
+        if operation_ast is None or operation_ast.operation != OperationType.QUERY:
+            return await sync_to_async(super().execute_graphql_request)(request, data, query, variables,
+                                                                        operation_name)
+
+        document, validation_errors = entry
+        if validation_errors:
+            return ExecutionResult(data=None, errors=validation_errors)
+
+        # reading the catalog version may query the database, which the event loop must not do
+        key = await sync_to_async(self.get_cache_key)(query_hash, variables, operation_name)
+        result = self.response_cache.get(key)
+        if result is None:
+            try:
+                result = execute(self.schema.graphql_schema, document,
+                                 **self.get_execute_options(request, variables, operation_name))
+                if isawaitable(result):
+                    result = await result
+            except Exception as e:
+                return ExecutionResult(errors=[e])
+            self.cache_result(key, result)
+        else:
+            mark_cached()
+        return result
+
+
+def metrics(request):
+    # histograms of lego.metrics for Prometheus, of this server process only
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')